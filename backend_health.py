@@ -0,0 +1,88 @@
+import random
+import threading
+import time
+
+UP = "up"
+SUSPECT = "suspect"  # Not confirmed up: just started, or one failure since it was last up
+DOWN = "down"
+GIVING_UP = "giving-up"  # Down for longer than give_up_after, only retried every max_delay
+
+class BackendHealth:
+    # Cached connection state of one backend, kept by the subscription listener and by command sends,
+    # so neither has to probe a backend to know it is down. Failed attempts back off exponentially
+    # with jitter, which keeps a few dead hosts from turning into a constant connect storm.
+    # on_change(state) is called outside the lock from whichever thread reported the change.
+    def __init__(self, initial_delay=0.5, max_delay=30.0, give_up_after=60.0, jitter=0.2, on_change=None):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.give_up_after = give_up_after
+        self.jitter = jitter  # Delays are spread by +/- this fraction so backends do not retry in step
+        self.on_change = on_change
+        self.state = SUSPECT
+        self.failures = 0  # Consecutive failed attempts
+        self.down_since = None
+        self.last_seen = None  # time.time() of the last success
+        self.next_attempt = 0.0  # time.monotonic() before which nobody should try to connect
+        self.lock = threading.Lock()
+
+    def success(self):
+        with self.lock:
+            previous = self.state
+            self.state = UP
+            self.failures = 0
+            self.down_since = None
+            self.last_seen = time.time()
+            self.next_attempt = 0.0
+        if previous != UP:
+            self.changed(UP)
+
+    def failure(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            if self.state in (DOWN, GIVING_UP) and now < self.next_attempt:
+                return  # Another caller already reported this outage and scheduled the retry
+            previous = self.state
+            self.failures += 1
+            if self.down_since is None:
+                self.down_since = now
+            if self.state == UP:
+                self.state = SUSPECT
+            elif now - self.down_since >= self.give_up_after:
+                self.state = GIVING_UP
+            else:
+                self.state = DOWN
+            if self.state == GIVING_UP:
+                delay = self.max_delay
+            else:
+                delay = min(self.max_delay, self.initial_delay * 2 ** (self.failures - 1))
+            self.next_attempt = now + delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+            state = self.state
+        if state != previous:
+            self.changed(state)
+
+    def reset(self):
+        # Forget the backoff, e.g. after the backend's address changed
+        with self.lock:
+            previous = self.state
+            self.state = SUSPECT
+            self.failures = 0
+            self.down_since = None
+            self.next_attempt = 0.0
+        if previous != SUSPECT:
+            self.changed(SUSPECT)
+
+    def due(self, now=None):
+        return (time.monotonic() if now is None else now) >= self.next_attempt
+
+    def usable(self, now=None):
+        # Whether a command should be sent now: yes unless the backend is known to be down and its
+        # retry is not due yet, in which case the send fails right away instead of timing out
+        return self.state in (UP, SUSPECT) or self.due(now)
+
+    def retry_in(self, now=None):
+        return max(0.0, self.next_attempt - (time.monotonic() if now is None else now))
+
+    def changed(self, state):
+        if self.on_change is not None:
+            self.on_change(state)
@@ -1,172 +1,934 @@
+import argparse
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import queue
+import select
+import signal
 import socket
+import struct
 import sys
 import threading
 import time
-from datetime import datetime
+from command_table import CommandTable
+from latency_stats import LatencyStats
+from log_pipeline import LogPipeline, DEBUG, INFO, WARNING, ERROR
+from prefork import HELLO_TIMEOUT, Supervisor, WorkerRouter, handoff_path, state_path
+from sessions import SessionManager
+from timer_wheel import TimerWheel
+from traffic_log import FROM_BACKEND, TO_BACKEND, TrafficRecorder
+from tcp_common import (MessageType, MESSAGE_NAMES, ACTIVATION_STRUCT, CLOCK_STRUCT, BodyStream, FrameReader,
+                        ProtocolError, body_bytes, buffer_sizes, encode_frame, read_frame_async,
+                        read_frame_sock_async)
+from transports import SHM_SUPPORTED, TRANSPORTS, accept_connection, listen, unix_path
 
-def get_timestamp():
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]  # Include milliseconds
+SUBSCRIBER_SEND_TIMEOUT = 2.0  # Seconds a push may wait for a subscriber that stopped reading before it is dropped
+FINAL_WAIT = 0.01  # Seconds before a scheduled START/END that activate_at takes over
+PRECISE_SWITCH_INTERVAL = 0.00005  # GIL switch interval for the final wait with precise_activation
+
+class SubscriberWriter:
+    # Sends one threaded subscriber's pushes in order from its own thread, so whoever pushes (a connection
+    # thread, the timer wheel) never waits on a controller that stopped reading.
+    # on_failure(error) runs on the writer thread when a send fails or times out.
+    def __init__(self, connection, on_failure):
+        self.connection = connection
+        self.on_failure = on_failure
+        self.frames = queue.SimpleQueue()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name="subscriber", daemon=True)
+        self.thread.start()
+
+    def write(self, frame):
+        self.frames.put(frame)
+
+    def stop(self):
+        # Frames not sent yet are dropped; pushes are retransmitted and the state resent on resubscription
+        self.stopped = True
+        self.frames.put(None)
+
+    def run(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None or self.stopped:
+                return
+            try:
+                self.connection.sendall(frame)
+            except OSError as e:
+                if not self.stopped:
+                    self.on_failure(e)
+                return
 
 class BackendProcess:
-    def __init__(self, ports):
+    def __init__(self, ports, log=None, transports=("tcp",), socket_dir=None, router=None, state_path=None,
+                 takeover=False, record_path=None, memory_cap=None, data_dir=None, precise_activation=False):
         self.ports = ports  # List of two ports
         self.host = 'localhost'
+        self.transports = transports  # Each port is served over every transport listed here
+        self.socket_dir = socket_dir  # Where unix and shm listening sockets are created
         self.running = False
-        self.is_started = False
-        self.event_timer = None
-        self.last_client_addr = None
+        self.log = log if log is not None else LogPipeline()  # Formats and writes off the hot path
+        self.timers = TimerWheel(log=self.log)  # Single scheduler thread for all backend timers
+        self.sessions = SessionManager(self.timers, self.send_ready_message, self.deliver,
+                                       log=self.log)  # One per controller
+        self.stats = LatencyStats()  # One-way latency and sequence gaps per controller and message type
+        # Command handlers by message type; register more on this table to add commands
+        self.commands = CommandTable(fallback=self.unknown_command)
+        self.commands.register(MessageType.START, self.on_start)
+        self.commands.register(MessageType.END, self.on_end)
+        self.commands.register(MessageType.EVENT, self.on_event)
+        self.commands.register(MessageType.ERROR, self.on_error)
+        self.commands.register(MessageType.CONNECTION_FAIL, self.on_connection_fail)
+        self.commands.register(MessageType.DATA, self.on_data)
+        self.record_path = record_path
+        self.memory_cap = memory_cap  # Buffer bytes per connection; larger bodies are streamed (None: defaults)
+        self.data_dir = data_dir  # Where DATA bodies are stored, one file per controller
+        self.recorder = None  # TrafficRecorder capturing every frame in and out, for replay_traffic.py
+        self.subscribers_lock = threading.Lock()  # Guards session.subscribers and push order
+        self.send_timeout = SUBSCRIBER_SEND_TIMEOUT
+        self.activation_lock = threading.Condition(threading.RLock())  # Guards session.activations and the queue
+        self.activation_queue = []  # Heap of (time_ns, order, session, started) for the activation thread
+        self.activation_order = itertools.count()
+        self.activation_thread = None
+        self.precise_activation = precise_activation  # Real-time priority and a short GIL switch interval
+        self.realtime_warned = False
         self.server_sockets = [None, None]  # Store server sockets
+        self.loop = None  # Event loop when running in asyncio mode
+        self.loop_thread_id = None
+        self.router = router  # Set in a prefork worker; sessions are partitioned between the workers
+        self.state_path = state_path  # Where a prefork worker leaves its sessions for its replacement
+        self.takeover = takeover  # Started to replace a running worker: wait for its sessions
+        self.handing_over = False  # Set when this worker is being replaced rather than stopped
+        self.draining = False
+        self.listeners = []
+        self.active_connections = 0
+        self.parked = []  # Connections stopped between frames, waiting to be handed to the replacement
+        self.connections_changed = threading.Condition()
+        self.wake_read, self.wake_write = os.pipe() if router is not None else (None, None)
         
     def start_server(self):
-        print(f"[{get_timestamp()}] Backend starting on ports {self.ports[0]}, {self.ports[1]}")
+        self.log.info("Backend starting on ports %s, %s", self.ports[0], self.ports[1])
+        self.timers.start()
+        self.prepare()
+        if self.router is not None:
+            threading.Thread(target=self.receive_handoffs, daemon=True).start()
         
-        # Create and start server threads for each port
+        # Create and start server threads for each port and transport
         server_threads = []
-        for i in range(2):
-            thread = threading.Thread(target=self.run_server, args=(i,))
-            thread.daemon = True
-            thread.start()
-            server_threads.append(thread)
+        for transport in self.transports:
+            for i in range(2):
+                thread = threading.Thread(target=self.run_server, args=(i, transport))
+                thread.daemon = True
+                thread.start()
+                server_threads.append(thread)
         
         # Wait for all threads to complete
         for thread in server_threads:
             thread.join()
     
-    def run_server(self, socket_index):
+    def run_server(self, socket_index, transport="tcp"):
+        if not self.listens_on(transport):
+            return
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-                server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                server_socket.bind((self.host, self.ports[socket_index]))
-                server_socket.listen()
-                self.server_sockets[socket_index] = server_socket
-                
-                print(f"[{get_timestamp()}] Listening for connections on port {self.ports[socket_index]}...")
+            with listen(transport, self.host, self.ports[socket_index], self.socket_dir,
+                        reuse_port=self.router is not None) as server_socket:
+                self.listeners.append(server_socket)
+                if transport == "tcp":
+                    self.server_sockets[socket_index] = server_socket
+                    self.log.info("Listening for connections on port %s...", self.ports[socket_index])
+                else:
+                    self.log.info("Listening for %s connections on %s...", transport,
+                                  unix_path(transport, self.ports[socket_index], self.socket_dir))
                 
                 while True:
                     try:
                         client_socket, addr = server_socket.accept()
-                        if socket_index == 0:  # Only store client address from first socket
-                            self.last_client_addr = addr
-                        with client_socket:
-                            message = client_socket.recv(1024).decode()
-                            self.handle_message(message, addr)
+                        if transport != "tcp":
+                            addr = (transport, 0)  # Unix sockets have no peer address
+                        # Controllers keep pooled connections open, so serve each one on its own thread
+                        client_thread = threading.Thread(target=self.handle_client,
+                                                         args=(socket_index, client_socket, addr, transport))
+                        client_thread.daemon = True
+                        client_thread.start()
                     except KeyboardInterrupt:
-                        print(f"\n[{get_timestamp()}] Server on port {self.ports[socket_index]} shutting down...")
+                        self.log.info("Server on port %s shutting down...", self.ports[socket_index])
                         break
                     except Exception as e:
-                        print(f"[{get_timestamp()}] Error on port {self.ports[socket_index]}: {str(e)}")
+                        if self.draining:
+                            break
+                        self.log.error("Error on port %s: %s", self.ports[socket_index], e)
         except Exception as e:
-            print(f"[{get_timestamp()}] Server error on port {self.ports[socket_index]}: {str(e)}")
+            self.log.error("Server error on port %s: %s", self.ports[socket_index], e)
     
-    def send_ready_message(self):
-        timestamp = get_timestamp()
-        print(f"[{timestamp}] Event timer completed. Sending READY message to control app")
-        
+    def listens_on(self, transport):
+        # Unix sockets cannot be shared between workers; the first worker accepts them and hands them out
+        return self.router is None or transport == "tcp" or self.router.index == 0
+
+    def prepare(self):
+        # Runs before the first connection is accepted
+        if self.router is not None:
+            self.load_sessions()
+        if self.record_path:
+            self.recorder = TrafficRecorder(self.record_path)
+        if self.router is not None:
+            self.router.start()
+
+    def load_sessions(self):
+        # Prefork: pick up the sessions the previous worker with this index left behind
+        deadline = time.monotonic() + 10.0
+        while self.takeover and not os.path.exists(self.state_path) and time.monotonic() < deadline:
+            time.sleep(0.02)
+        if self.state_path and os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                entries = json.load(f)
+            os.unlink(self.state_path)
+            self.sessions.import_state(entries)
+            for entry in entries:
+                for started, at_ns in entry.get("activations", ()):
+                    self.schedule_activation(self.sessions.get(entry["controller_id"]), started, at_ns)
+            self.log.info("Worker %s took over %s session(s)", self.router.index, len(entries))
+
+    def shutdown(self):
+        # Closes the capture. A prefork worker being replaced also stops accepting, lets every connection
+        # finish the frame it is on, saves the sessions, then passes the connections to the replacement,
+        # which loads the sessions first.
+        if self.router is not None:
+            self.router.stop()
+        if not self.handing_over:
+            self.close_recorder()
+            return
+        self.draining = True
+        for server_socket in self.listeners:
+            try:
+                server_socket.shutdown(socket.SHUT_RDWR)  # Wakes the accept() call
+            except OSError:
+                pass
+        os.write(self.wake_write, b"\0")
+        with self.connections_changed:
+            self.connections_changed.wait_for(lambda: self.active_connections == 0, 2.0)
+        self.close_recorder()  # The replacement continues the capture once the state file is there
+        self.timers.stop()
+        # READY frames still waiting for an ACK are sent again by the replacement
+        for session in list(self.sessions.sessions.values()):
+            if any(frame[8] == MessageType.READY for frame in session.unacked.frames()):
+                session.ready_pending = True
+        entries = self.sessions.export_state()
+        with open(self.state_path + ".tmp", "w") as f:
+            json.dump(entries, f)
+        os.replace(self.state_path + ".tmp", self.state_path)
+        for client_socket, socket_index, addr, controller_id in self.parked:
+            if not self.router.hand_off(self.router.index, client_socket, socket_index, addr, controller_id):
+                self.log.warning("Replacement worker unreachable, closing connection from %s", controller_id)
+            client_socket.close()
+        self.log.info("Worker %s handed over %s session(s) and %s connection(s)", self.router.index,
+                      len(entries), len(self.parked))
+
+    def close_recorder(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.log.info("Captured %s frames to %s", self.recorder.records, self.record_path)
+
+    def wait_frame(self, poller):
+        # Prefork: blocks until the next frame starts arriving; False once the worker is draining
+        poller.poll()
+        return not self.draining
+
+    def track_connection(self, delta):
+        with self.connections_changed:
+            self.active_connections += delta
+            self.connections_changed.notify_all()
+
+    def read_first_frame(self, client_socket):
+        # Prefork routing and subscriptions need the HELLO; a controller that sends nothing goes by address
+        client_socket.settimeout(HELLO_TIMEOUT)
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(1.0)  # Increase timeout for reliability
-                s.connect((self.last_client_addr[0], self.last_client_addr[1]))
-                s.sendall("READY".encode())
-                print(f"[{timestamp}] READY message sent successfully")
+            frame = FrameReader(client_socket, memory_cap=self.memory_cap).read_frame()
+            return frame, frame is None
+        except TimeoutError:
+            return None, False
+        finally:
+            client_socket.settimeout(None)
+
+    def route(self, socket_index, connection, addr, frame):
+        # Returns (controller id, frame still to process) if this worker owns the session,
+        # otherwise hands the connection to the worker that does and returns None
+        controller_id, pending = self.first_identity(addr, frame)
+        owner = self.router.owner(controller_id)
+        if owner == self.router.index:
+            return controller_id, pending
+        if pending is not None and isinstance(pending[3], BodyStream):
+            self.log.warning("Connection from %s opened with a streamed body, expected HELLO", addr)
+            return None
+        if not self.router.hand_off(owner, connection, socket_index, addr, controller_id, pending):
+            self.log.warning("Worker %s unreachable, dropping connection from %s", owner, controller_id)
+        return None
+
+    def first_identity(self, addr, frame):
+        # (controller id, frame still to process) of a connection whose first frame was read ahead
+        if frame is not None and frame[1] == MessageType.HELLO:
+            return body_bytes(frame[3]).decode(), None
+        return addr[0], frame
+
+    def receive_handoffs(self):
+        while True:
+            try:
+                client_socket, socket_index, addr, controller_id, pending = self.router.receive()
+            except OSError:
+                return  # Handoff socket closed on shutdown
+            client_thread = threading.Thread(target=self.serve_connection,
+                                             args=(socket_index, client_socket, addr, controller_id, pending))
+            client_thread.daemon = True
+            client_thread.start()
+
+    def start_async_server(self):
+        self.log.info("Backend starting (asyncio) on ports %s, %s", self.ports[0], self.ports[1])
+        self.timers.start()
+        asyncio.run(self.serve_async())
+
+    async def serve_async(self):
+        # Both ports and all of their clients share one event loop
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.running = True
+        servers = []
+        self.prepare()
+        if self.router is not None:
+            self.router.sock.setblocking(False)
+            self.loop.add_reader(self.router.sock.fileno(), self.adopt_handoffs)
+        try:
+            for transport in self.transports:
+                for i, port in enumerate(self.ports):
+                    if self.router is not None:
+                        if self.listens_on(transport):
+                            servers.append(self.accept_async(i, transport))
+                        continue
+                    handler = lambda reader, writer, i=i: self.handle_client_async(i, reader, writer)
+                    if transport == "tcp":
+                        server = await asyncio.start_server(handler, self.host, port, reuse_address=True,
+                                                            backlog=1024)
+                        self.log.info("Listening for connections on port %s...", port)
+                    elif transport == "unix":
+                        path = unix_path(transport, port, self.socket_dir)
+                        server = await asyncio.start_unix_server(handler, path, backlog=1024)
+                        self.log.info("Listening for unix connections on %s...", path)
+                    else:
+                        raise ValueError(f"The asyncio server does not support the {transport} transport")
+                    servers.append(server)
+            await asyncio.gather(*(server if asyncio.iscoroutine(server) else server.serve_forever()
+                                   for server in servers))
+        finally:
+            for server in servers:
+                if not asyncio.iscoroutine(server):
+                    server.close()
+            if self.router is not None and self.router.sock is not None:
+                self.loop.remove_reader(self.router.sock.fileno())
+            self.running = False
+            self.loop = None
+
+    async def accept_async(self, socket_index, transport):
+        # Prefork workers accept on raw sockets so the HELLO can be read without buffering anything after it
+        with listen(transport, self.host, self.ports[socket_index], self.socket_dir, backlog=1024,
+                    reuse_port=True) as server_socket:
+            server_socket.setblocking(False)
+            self.log.info("Listening for %s connections on port %s...", transport, self.ports[socket_index])
+            while True:
+                client_socket, addr = await self.loop.sock_accept(server_socket)
+                if transport != "tcp":
+                    addr = (transport, 0)  # Unix sockets have no peer address
+                self.loop.create_task(self.route_async(socket_index, client_socket, addr))
+
+    async def route_async(self, socket_index, client_socket, addr):
+        try:
+            frame = await asyncio.wait_for(read_frame_sock_async(self.loop, client_socket), HELLO_TIMEOUT)
+            closed = frame is None
+        except asyncio.TimeoutError:
+            frame, closed = None, False
+        except (OSError, ProtocolError) as e:
+            self.log.warning("Connection from %s closed: %s", addr, e)
+            frame, closed = None, True
+        # A handoff to a restarting worker may wait, so keep it off the event loop
+        routed = None if closed else await self.loop.run_in_executor(None, self.route, socket_index,
+                                                                     client_socket, addr, frame)
+        if routed is None:
+            client_socket.close()
+            return
+        reader, writer = await asyncio.open_connection(sock=client_socket)
+        await self.handle_client_async(socket_index, reader, writer, addr, *routed)
+
+    def adopt_handoffs(self):
+        # Event loop reader callback for connections other workers passed to this one
+        while True:
+            try:
+                client_socket, socket_index, addr, controller_id, pending = self.router.receive()
+            except (BlockingIOError, OSError):
+                return
+            self.loop.create_task(self.adopt_async(socket_index, client_socket, addr, controller_id, pending))
+
+    async def adopt_async(self, socket_index, client_socket, addr, controller_id, pending):
+        reader, writer = await asyncio.open_connection(sock=client_socket)
+        await self.handle_client_async(socket_index, reader, writer, addr, controller_id, pending)
+
+    async def handle_client_async(self, socket_index, reader, writer, addr=None, controller_id=None, pending=None):
+        if addr is None:
+            addr = writer.get_extra_info("peername") or ("unix", 0)  # Unix sockets have no peer address
+        if controller_id is None:
+            controller_id = addr[0]  # Until the controller identifies itself with HELLO
+            if socket_index == 0:
+                # Subscribe under the HELLO identity, see handle_client
+                try:
+                    frame = await asyncio.wait_for(read_frame_async(reader, *buffer_sizes(self.memory_cap)),
+                                                   HELLO_TIMEOUT)
+                    if frame is None:
+                        writer.close()
+                        return
+                    controller_id, pending = self.first_identity(addr, frame)
+                except asyncio.TimeoutError:
+                    pass
+                except (OSError, ProtocolError) as e:
+                    self.log.warning("Connection from %s closed: %s", addr, e)
+                    writer.close()
+                    return
+        if socket_index == 0:  # First port connections subscribe to pushed events
+            self.add_subscriber(self.sessions.get(controller_id), writer)
+        try:
+            if pending is not None:
+                controller_id = self.process_frame(socket_index, writer, controller_id, pending, addr)
+            while True:
+                frame = await read_frame_async(reader, *buffer_sizes(self.memory_cap))
+                if frame is None:
+                    break
+                controller_id = self.process_frame(socket_index, writer, controller_id, frame, addr)
         except Exception as e:
-            print(f"[{timestamp}] Failed to send READY message: {str(e)}")
-            # Try to resend after 1 second if failed
-            print(f"[{timestamp}] Will retry sending READY message in 1 second")
-            self.event_timer = threading.Timer(1.0, self.send_ready_message)
-            self.event_timer.start()
+            self.log.warning("Connection from %s closed: %s", addr, e)
+        finally:
+            if socket_index == 0:
+                self.remove_subscriber(self.sessions.get(controller_id), writer)
+            writer.close()
+
+    def handle_client(self, socket_index, client_socket, addr, transport="tcp"):
+        try:
+            client_socket = accept_connection(transport, client_socket)
+        except OSError as e:
+            self.log.warning("Failed to set up %s connection: %s", transport, e)
+            client_socket.close()
             return
-        
-        self.event_timer = None
+        controller_id = addr[0]  # Until the controller identifies itself with HELLO
+        pending = None
+        if self.router is not None or socket_index == 0:
+            # A subscription made under the address would get a session, and a state snapshot, of its own
+            try:
+                frame, closed = self.read_first_frame(client_socket)
+                if closed:
+                    routed = None
+                elif self.router is not None:
+                    routed = self.route(socket_index, client_socket, addr, frame)
+                else:
+                    routed = self.first_identity(addr, frame)
+            except (OSError, ProtocolError) as e:
+                self.log.warning("Connection from %s closed: %s", addr, e)
+                routed = None
+            if routed is None:
+                client_socket.close()
+                return
+            controller_id, pending = routed
+        self.serve_connection(socket_index, client_socket, addr, controller_id, pending)
+
+    def serve_connection(self, socket_index, client_socket, addr, controller_id, pending=None):
+        # pending is a frame read before the connection got here, during prefork routing
+        if socket_index == 0:  # First port connections subscribe to pushed events
+            self.add_subscriber(self.sessions.get(controller_id), client_socket)
+        parked = False
+        poller = None
+        if self.router is not None:
+            poller = select.poll()
+            poller.register(client_socket, select.POLLIN)
+            poller.register(self.wake_read, select.POLLIN)
+        self.track_connection(1)
+        try:
+            if pending is not None:
+                controller_id = self.process_frame(socket_index, client_socket, controller_id, pending, addr)
+            frame_reader = FrameReader(client_socket, memory_cap=self.memory_cap)
+            while True:
+                if poller is not None and not self.wait_frame(poller):
+                    parked = True
+                    break
+                frame = frame_reader.read_frame()
+                if frame is None:
+                    break
+                controller_id = self.process_frame(socket_index, client_socket, controller_id, frame, addr)
+        except Exception as e:
+            self.log.warning("Connection from %s closed: %s", addr, e)
+        finally:
+            if socket_index == 0:
+                # A parked connection changes hands, so its last push must be out first
+                self.remove_subscriber(self.sessions.get(controller_id), client_socket, wait=parked)
+            if parked:
+                self.parked.append((client_socket, socket_index, addr, controller_id))
+            else:
+                client_socket.close()
+            self.track_connection(-1)
+
+    def process_frame(self, socket_index, connection, controller_id, frame, addr):
+        # Returns the connection's controller identity, which HELLO may change
+        timestamp, message_type, sequence_number, body = frame
+        if self.recorder is not None:
+            # Streamed bodies are not captured, only their frame header
+            self.recorder.record_frame(socket_index, TO_BACKEND, controller_id, timestamp, message_type,
+                                       sequence_number, b"" if isinstance(body, BodyStream) else body)
+        if message_type == MessageType.HELLO:
+            return self.identify(socket_index, connection, controller_id, body)
+        if message_type == MessageType.CLOCK:
+            # Clock offset probe, answered at once with its TimeStamp and when it was read here
+            self.send_reply(socket_index, connection, controller_id,
+                            encode_frame(MessageType.CLOCK, CLOCK_STRUCT.pack(timestamp, time.time_ns()),
+                                         sequence_number))
+            return controller_id
+        session = self.sessions.get(controller_id)
+        if message_type == MessageType.ACK:
+            self.finish_body(body)
+            session.unacked.ack(sequence_number)
+            return controller_id
+        # Sequence 0 is unsequenced: no dedup and no ACK
+        if sequence_number and not session.received.accept(sequence_number):
+            # Retransmission after a lost ACK: acknowledge again but apply it only once
+            self.log.info("Duplicate %s #%s from %s ignored", MESSAGE_NAMES.get(message_type, str(message_type)),
+                          sequence_number, controller_id)
+            self.finish_body(body)
+            self.send_ack(socket_index, connection, controller_id, sequence_number)
+            return controller_id
+        self.stats.record_one_way(controller_id, MESSAGE_NAMES.get(message_type, str(message_type)), timestamp)
+        self.stats.observe_sequence(controller_id, sequence_number)
+        self.handle_message(message_type, body, socket_index, addr, session)
+        self.finish_body(body)
+        if sequence_number:
+            self.send_ack(socket_index, connection, controller_id, sequence_number)
+        return controller_id
+
+    def finish_body(self, body):
+        # The next frame starts after this one's body, however much of it the handler read
+        if isinstance(body, BodyStream):
+            body.skip()
+
+    def send_ack(self, socket_index, connection, controller_id, sequence_number):
+        # Acknowledge on the connection the frame came in on, where the controller is waiting for it
+        self.send_reply(socket_index, connection, controller_id,
+                        encode_frame(MessageType.ACK, sequence_number=sequence_number))
+
+    def send_reply(self, socket_index, connection, controller_id, frame):
+        if self.recorder is not None:
+            self.recorder.record(socket_index, FROM_BACKEND, controller_id, frame)
+        if self.loop is not None:
+            connection.write(frame)
+            return
+        try:
+            connection.sendall(frame)
+        except OSError as e:
+            self.log.warning("Failed to reply to %s: %s", controller_id, e)
+
+    def identify(self, socket_index, connection, controller_id, body):
+        # Rebind the connection to the session of the controller named in HELLO
+        new_id = body_bytes(body).decode()
+        if socket_index == 0 and new_id != controller_id:
+            self.remove_subscriber(self.sessions.get(controller_id), connection)
+            self.add_subscriber(self.sessions.get(new_id), connection)
+        return new_id
+
+    def add_subscriber(self, session, connection):
+        # Bring the new subscriber up to date, including a READY nobody has received yet
+        # The state snapshot is repeated on every subscription, so only READY is kept for retransmission.
+        # Asyncio writers buffer; a plain socket gets a SubscriberWriter that gives up after send_timeout.
+        writer = connection
+        if self.loop is None:
+            seconds = int(self.send_timeout)
+            connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                                  struct.pack("@ll", seconds, int((self.send_timeout - seconds) * 1e6)))
+            writer = SubscriberWriter(connection, lambda e: self.drop_subscriber(session, connection, e))
+        with self.subscribers_lock:
+            session.subscribers[connection] = writer
+            self.write_subscriber(session, writer,
+                                  self.encode_push(session, MessageType.STATE_CHANGED, bytes([session.is_started])))
+            if session.ready_pending:
+                session.ready_pending = False
+                frame = self.encode_push(session, MessageType.READY)
+                self.track(session, frame)
+                self.write_subscriber(session, writer, frame)
+
+    def remove_subscriber(self, session, connection, wait=False):
+        with self.subscribers_lock:
+            writer = session.subscribers.pop(connection, None)
+        if self.loop is None and writer is not None:
+            writer.stop()
+            if wait:
+                writer.thread.join()
+
+    def drop_subscriber(self, session, connection, error):
+        # Gone, or not reading for send_timeout. Part of a frame may have been sent, so the connection
+        # cannot be used for anything else; the controller reconnects and gets the retransmissions.
+        self.log.warning("Dropping subscriber %s: %s", session.controller_id, error)
+        with self.subscribers_lock:
+            session.subscribers.pop(connection, None)
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def write_subscriber(self, session, writer, frame):
+        # Called with subscribers_lock held, which keeps pushes in sequence order; never blocks
+        if self.recorder is not None:
+            self.recorder.record(0, FROM_BACKEND, session.controller_id, frame)
+        writer.write(frame)
+
+    def encode_push(self, session, message_type, body=b""):
+        # Pushed frames carry their own per-session sequence so controllers can spot gaps.
+        # Called with subscribers_lock held, so every push gets a number of its own.
+        session.push_sequence += 1
+        return encode_frame(message_type, body, session.push_sequence)
+
+    def track(self, session, frame):
+        # Keep a pushed frame for retransmission until the controller ACKs its sequence number
+        if not session.unacked.add(session.push_sequence, frame):
+            self.log.warning("Retransmit window for %s full, #%s sent without retransmission",
+                             session.controller_id, session.push_sequence)
+
+    def publish(self, session, message_type, body=b""):
+        # Push an event to the session's controller; returns True if it was subscribed.
+        # Frames pushed to a subscriber are retransmitted until ACKed, also across a resubscription.
+        # Numbered and queued under one lock, so pushes from different threads go out in sequence order.
+        with self.subscribers_lock:
+            if not session.subscribers:
+                return False
+            frame = self.encode_push(session, message_type, body)
+            self.track(session, frame)
+            if self.loop is None or threading.get_ident() == self.loop_thread_id:
+                self.write_subscribers(session, frame)
+            else:
+                self.loop.call_soon_threadsafe(self.publish_frame, session, frame)
+        return True
+
+    def deliver(self, session, frame):
+        # Callable from any thread, including the timer wheel for retransmissions
+        if self.loop is not None and threading.get_ident() != self.loop_thread_id:
+            self.loop.call_soon_threadsafe(self.publish_frame, session, frame)
+        else:
+            self.publish_frame(session, frame)
+
+    def publish_frame(self, session, frame):
+        with self.subscribers_lock:
+            self.write_subscribers(session, frame)
+
+    def write_subscribers(self, session, frame):
+        # Queued for each subscriber, so a subscriber that stopped reading only holds up its own pushes
+        for writer in session.subscribers.values():
+            self.write_subscriber(session, writer, frame)
+
+    def set_started(self, session, started, at_ns=None):
+        # A scheduled activation is confirmed even if the state does not change, with its time after the state
+        session.ready_pending = False
+        if session.is_started != started or at_ns is not None:
+            session.is_started = started
+            self.publish(session, MessageType.STATE_CHANGED,
+                         bytes([started]) + (ACTIVATION_STRUCT.pack(at_ns) if at_ns is not None else b""))
     
-    def handle_message(self, message, addr):
-        timestamp = get_timestamp()
-        port = addr[1]  # 클라이언트의 포트
-        backend_port = self.ports[0] if port == 9090 else self.ports[1]  # 백엔드의 포트
-        print(f"[{timestamp}] Message from {addr} on backend port {backend_port}: {message}")
-        print(f"[{timestamp}] Current state: {'STARTED' if self.is_started else 'NOT STARTED'}")
+    def send_ready_message(self, session):
+        self.log.info("Event timer completed for %s. Pushing READY message", session.controller_id)
         
-        if message.startswith("CONNECTION_FAIL:"):
-            # Reset state to NOT STARTED when connection failure is detected
-            failed_backends = message.split(":")[1].split(",")
-            print(f"[{timestamp}] Connection failure detected on port {backend_port} from backends: {failed_backends}")
-            print(f"[{timestamp}] Resetting state to NOT STARTED")
-            self.is_started = False
-            # Cancel any pending event timer
-            if self.event_timer and self.event_timer.is_alive():
-                self.event_timer.cancel()
-                self.event_timer = None
-            return
-            
-        if message == "ERROR":
-            # Reset state to NOT STARTED when error message is received
-            print(f"[{timestamp}] Error message received, resetting state to NOT STARTED")
-            self.is_started = False
+        if self.publish(session, MessageType.READY):
+            self.log.info("READY message sent successfully")
+        else:
+            # Delivered as soon as the controller subscribes
+            self.log.info("Controller not subscribed, READY will be sent on subscription")
+            session.ready_pending = True
+    
+    def handle_message(self, message_type, body, socket_index, addr, session):
+        self.log.info("Message from %s %s on backend port %s: %s", session.controller_id, addr,
+                      self.ports[socket_index], MESSAGE_NAMES.get(message_type, str(message_type)))
+        self.log.info("Current state: %s", "STARTED" if session.is_started else "NOT STARTED")
+        self.commands.dispatch(message_type, session, body, socket_index, addr)
+
+    def unknown_command(self, message_type, session, body, socket_index, addr):
+        self.log.warning("No handler for message type %s from %s", message_type, session.controller_id)
+
+    def on_connection_fail(self, session, body, socket_index, addr):
+        # Reset state to NOT STARTED when connection failure is detected
+        failed_backends = body_bytes(body).decode().split(",")
+        self.log.warning("Connection failure detected on port %s from backends: %s", self.ports[socket_index],
+                         failed_backends)
+        self.log.info("Resetting state to NOT STARTED")
+        self.cancel_activations(session)
+        self.set_started(session, False)
+        # Cancel any pending event timer
+        self.timers.cancel(session.event_timer)
+
+    def on_error(self, session, body, socket_index, addr):
+        # Reset state to NOT STARTED when error message is received
+        self.log.warning("Error message received, resetting state to NOT STARTED")
+        self.cancel_activations(session)
+        self.set_started(session, False)
+        # Cancel any pending event timer
+        self.timers.cancel(session.event_timer)
+
+    def on_start(self, session, body, socket_index, addr):
+        at_ns = self.activation_time(body)
+        if at_ns is not None:
+            self.schedule_activation(session, True, at_ns)
+        else:
+            self.cancel_activations(session)
+            self.start_capture(session)
+
+    def on_end(self, session, body, socket_index, addr):
+        at_ns = self.activation_time(body)
+        if at_ns is not None:
+            self.schedule_activation(session, False, at_ns)
+        else:
+            self.cancel_activations(session)
+            self.end_capture(session)
+
+    def start_capture(self, session, at_ns=None):
+        # at_ns is the time of the scheduled START being applied
+        was_started = session.is_started
+        self.set_started(session, True, at_ns)
+        self.log.info("Already in STARTED state" if was_started else "State changed to: STARTED")
+
+    def end_capture(self, session, at_ns=None):
+        was_started = session.is_started
+        self.set_started(session, False, at_ns)
+        if was_started:
+            self.log.info("State changed to: NOT STARTED")
             # Cancel any pending event timer
-            if self.event_timer and self.event_timer.is_alive():
-                self.event_timer.cancel()
-                self.event_timer = None
-            return
-            
-        if message == "START":
-            if not self.is_started:
-                self.is_started = True
-                print(f"[{timestamp}] State changed to: STARTED")
-            else:
-                print(f"[{timestamp}] Already in STARTED state")
-        elif message == "END":
-            if self.is_started:
-                self.is_started = False
-                print(f"[{timestamp}] State changed to: NOT STARTED")
-                # Cancel any pending event timer
-                if self.event_timer and self.event_timer.is_alive():
-                    self.event_timer.cancel()
-                    self.event_timer = None
+            self.timers.cancel(session.event_timer)
+        else:
+            self.log.info("Already in NOT STARTED state")
+
+    def activation_time(self, body):
+        # START/END may carry when to switch, on this backend's clock; None means now
+        body = body_bytes(body)
+        return ACTIVATION_STRUCT.unpack(body)[0] if len(body) == ACTIVATION_STRUCT.size else None
+
+    def schedule_activation(self, session, started, at_ns):
+        # Pending activations apply in time order. One scheduled for a later time queues behind the
+        # earlier ones, and replaces those scheduled for the same time or after it.
+        self.log.info("%s for %s scheduled in %s s", "START" if started else "END", session.controller_id,
+                      f"{(at_ns - time.time_ns()) / 1e9:.3f}")
+        with self.activation_lock:
+            session.activations = [pending for pending in session.activations if pending[1] < at_ns]
+            session.activations.append((started, at_ns))
+            heapq.heappush(self.activation_queue, (at_ns, next(self.activation_order), session, started))
+            if self.activation_thread is None:
+                self.activation_thread = threading.Thread(target=self.run_activations, name="activations",
+                                                          daemon=True)
+                self.activation_thread.start()
+            self.activation_lock.notify()
+
+    def run_activations(self):
+        # One thread applies every scheduled START/END, in time order. It waits on the condition until
+        # FINAL_WAIT before the next one, then on its own in activate_at.
+        while True:
+            with self.activation_lock:
+                while True:
+                    if not self.activation_queue:
+                        self.activation_lock.wait()
+                        continue
+                    at_ns, _, session, started = self.activation_queue[0]
+                    if (started, at_ns) not in session.activations:
+                        heapq.heappop(self.activation_queue)  # Cancelled or replaced
+                        continue
+                    remaining = (at_ns - time.time_ns()) / 1e9
+                    if remaining <= FINAL_WAIT:
+                        heapq.heappop(self.activation_queue)
+                        break
+                    self.activation_lock.wait(remaining - FINAL_WAIT)
+            self.activate_at(session, started, at_ns)
+
+    def activate_at(self, session, started, at_ns):
+        # A thread waking from sleep waits for the GIL, which a busy connection thread only gives up every
+        # 5 ms. With precise_activation the final wait runs at real-time priority with a short switch
+        # interval, so the activation is within a fraction of a millisecond of its time.
+        if self.precise_activation:
+            switch_interval = sys.getswitchinterval()
+            sys.setswitchinterval(PRECISE_SWITCH_INTERVAL)
+            realtime = self.set_realtime(True)
+        try:
+            while (remaining := (at_ns - time.time_ns()) / 1e9) > 0:
+                time.sleep(remaining)
+        finally:
+            if self.precise_activation:
+                sys.setswitchinterval(switch_interval)
+                if realtime:
+                    self.set_realtime(False)
+        with self.activation_lock:
+            if (started, at_ns) not in session.activations:
+                return  # Cancelled or replaced during the final wait
+            session.activations.remove((started, at_ns))
+            lag = time.time_ns() - at_ns
+            if started:
+                self.start_capture(session, at_ns)
             else:
-                print(f"[{timestamp}] Already in NOT STARTED state")
-        elif message == "EVENT":
-            if self.is_started:
-                print(f"[{timestamp}] Event received while STARTED")
-                # Cancel existing timer if there is one
-                if self.event_timer and self.event_timer.is_alive():
-                    self.event_timer.cancel()
-                
-                # Start new 30-second timer
-                print(f"[{timestamp}] Starting 30-second event timer")
-                self.event_timer = threading.Timer(30.0, self.send_ready_message)
-                self.event_timer.start()
-                
-                # Send acknowledgment of event receipt
-                try:
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                        s.settimeout(0.5)
-                        s.connect((addr[0], addr[1]))
-                        s.sendall("EVENT_RECEIVED".encode())
-                        print(f"[{timestamp}] Event receipt acknowledgment sent")
-                except Exception as e:
-                    print(f"[{timestamp}] Failed to send event acknowledgment: {str(e)}")
+                self.end_capture(session, at_ns)
+        name = "START" if started else "END"
+        self.stats.record(session.controller_id, name, "activation_lag", lag)
+        self.log.info("Scheduled %s for %s applied %s ms after its time", name, session.controller_id,
+                      f"{lag / 1e6:.3f}")
+
+    def set_realtime(self, enabled):
+        # Real-time priority for the calling thread, so the kernel runs it as soon as its sleep ends rather
+        # than after other threads' time slices. Needs CAP_SYS_NICE or an RLIMIT_RTPRIO allowance.
+        try:
+            if enabled:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(1))
             else:
-                print(f"[{timestamp}] Event ignored - not in STARTED state")
+                os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+            return True
+        except (AttributeError, OSError) as e:
+            if enabled and not self.realtime_warned:
+                self.realtime_warned = True
+                self.log.warning("Scheduled START/END run without real-time priority: %s", e)
+            return False
+
+    def cancel_activations(self, session):
+        # Their queue entries are skipped when they come up
+        with self.activation_lock:
+            session.activations = []
+
+    def on_event(self, session, body, socket_index, addr):
+        if session.is_started:
+            self.log.info("Event received while STARTED")
+            session.ready_pending = False
+            # Start new 30-second timer, replacing any pending one
+            self.log.info("Starting 30-second event timer")
+            self.timers.reschedule(session.event_timer, 30.0)
+            # Receipt is acknowledged by the ACK for this frame, on the connection it came in on
+        else:
+            self.log.info("Event ignored - not in STARTED state")
+
+    def on_data(self, session, body, socket_index, addr):
+        # Stored as <data_dir>/<controller id>.data, written as it streams in and then swapped in whole
+        started = time.perf_counter()
+        if self.data_dir is None:
+            size = sum(len(chunk) for chunk in body.chunks()) if isinstance(body, BodyStream) else len(body)
+            self.log.info("DATA from %s: %s bytes, discarded (no --data-dir)", session.controller_id, size)
+            return
+        path = os.path.join(self.data_dir, session.controller_id.replace(os.sep, "_") + ".data")
+        try:
+            with open(path + ".tmp", "wb") as f:
+                size = body.copy_to(f) if isinstance(body, BodyStream) else f.write(body)
+            os.replace(path + ".tmp", path)
+        except Exception:
+            # A body cut off or over the limit leaves the previous file and no partial one
+            try:
+                os.unlink(path + ".tmp")
+            except OSError:
+                pass
+            raise
+        self.log.info("DATA from %s: %s bytes stored in %s (%s ms)", session.controller_id, size, path,
+                      f"{(time.perf_counter() - started) * 1e3:.1f}")
+
+LOG_LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python backend_process.py <port1> <port2>")
-        print("Example: python backend_process.py 9090 9091")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Backend process serving START/END/EVENT control messages")
+    parser.add_argument("ports", type=int, nargs=2, help="first (status) and second (command) port")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="serve all connections from one asyncio event loop")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="info")
+    parser.add_argument("--log-sample", type=int, default=1,
+                        help="keep 1 of every N records below warning level")
+    parser.add_argument("--log-binary", metavar="PATH", help="also write a compact binary log to PATH")
+    parser.add_argument("--quiet", action="store_true", help="disable console log output")
+    parser.add_argument("--transport", dest="transports", action="append", choices=TRANSPORTS,
+                        help="serve over this transport, may be repeated (default tcp); "
+                             "unix and shm are for controllers on the same host")
+    parser.add_argument("--socket-dir", metavar="DIR",
+                        help="directory for the unix and shm listening sockets (default: system temp dir)")
+    parser.add_argument("--stats-interval", type=float, metavar="SECONDS",
+                        help="periodically log latency percentiles, sequence gaps and command handler times")
+    parser.add_argument("--connection-memory", type=int, metavar="BYTES",
+                        help="buffer memory per connection; larger message bodies are streamed through it "
+                             "(default 192 KiB)")
+    parser.add_argument("--data-dir", metavar="DIR", help="store DATA payloads here, one file per controller")
+    parser.add_argument("--record", metavar="PATH",
+                        help="capture every frame to PATH for replay_traffic.py (appends to an existing capture)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the ports with SO_REUSEPORT (Linux); "
+                             "SIGHUP to the supervisor restarts them one at a time")
+    parser.add_argument("--precise-activation", action="store_true",
+                        help="wait out scheduled START/END at real-time priority, with a short GIL switch "
+                             "interval for the last 10 ms")
+    parser.add_argument("--worker-index", type=int, help=argparse.SUPPRESS)  # Set by the supervisor
+    parser.add_argument("--takeover", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
     
     try:
-        ports = [int(sys.argv[1]), int(sys.argv[2])]
+        ports = args.ports
         for port in ports:
             if port < 1024 or port > 65535:
                 raise ValueError("Port must be between 1024 and 65535")
+        transports = args.transports or ["tcp"]
+        if "shm" in transports and not SHM_SUPPORTED:
+            raise ValueError("the shm transport is only supported on x86-64, use unix")
+        if args.use_async and "shm" in transports:
+            raise ValueError("the shm transport needs the threaded server, drop --async")
+        if args.workers < 1:
+            raise ValueError("--workers must be at least 1")
+        if args.workers > 1 and "shm" in transports:
+            raise ValueError("shm connections cannot be handed between workers, use unix with --workers")
+        if args.connection_memory is not None and args.connection_memory < 4096:
+            raise ValueError("--connection-memory must be at least 4096 bytes")
+        if args.data_dir is not None and not os.path.isdir(args.data_dir):
+            raise ValueError(f"--data-dir {args.data_dir} is not a directory")
     except ValueError as e:
         print("Error: {}".format(str(e)))
         sys.exit(1)
     
-    backend = BackendProcess(ports)
+    binary_path = args.log_binary
+    record_path = args.record
+    if args.worker_index is not None:
+        # Binary records cannot be interleaved, so each worker writes its own files
+        binary_path = binary_path and f"{binary_path}.worker{args.worker_index}"
+        record_path = record_path and f"{record_path}.worker{args.worker_index}"
+    log = LogPipeline(level=LOG_LEVELS[args.log_level], sample_rate=args.log_sample,
+                      console=not args.quiet, binary_path=binary_path)
+    if args.workers > 1 and args.worker_index is None:
+        # Supervisor: the workers run this same command line with their index added
+        command = lambda index, takeover: [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + [
+            "--worker-index", str(index)] + (["--takeover"] if takeover else [])
+        supervisor = Supervisor(args.workers, command, lambda index: handoff_path(ports[0], index, args.socket_dir),
+                                lambda index: state_path(ports[0], index, args.socket_dir), log)
+        try:
+            supervisor.run()
+        finally:
+            log.close()
+        return
+
+    router = None
+    if args.worker_index is not None:
+        router = WorkerRouter(args.worker_index, args.workers, ports[0], args.socket_dir)
+    backend = BackendProcess(ports, log=log, transports=transports, socket_dir=args.socket_dir, router=router,
+                             state_path=router and state_path(ports[0], router.index, args.socket_dir),
+                             takeover=args.takeover, record_path=record_path,
+                             memory_cap=args.connection_memory, data_dir=args.data_dir,
+                             precise_activation=args.precise_activation)
+    def stop(signum, frame):
+        # SIGHUP (prefork workers only): hand over to the replacement the supervisor started, SIGTERM: stop.
+        # Either way the main thread leaves through the finally below, which closes the capture.
+        backend.handing_over = signum == signal.SIGHUP
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+    if router is not None:
+        signal.signal(signal.SIGHUP, stop)
+    if args.stats_interval:
+        backend.stats.start_periodic_dump(args.stats_interval, lambda line: log.info("%s", line),
+                                          reports=(backend.commands.format_report,))
     try:
-        backend.start_server()
+        if args.use_async:
+            backend.start_async_server()
+        else:
+            backend.start_server()
     except KeyboardInterrupt:
         print("\nBackend process terminated by user")
+    finally:
+        backend.shutdown()
+        log.close()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
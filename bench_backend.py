@@ -0,0 +1,305 @@
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from latency_stats import LatencyHistogram
+from tcp_common import MessageType, MESSAGE_NAMES, FrameReader, encode_frame
+from prefork import handoff_path
+from transports import TRANSPORTS, connect
+
+DEFAULT_MIX = "START=4,END=4,EVENT=2,ERROR=1,CONNECTION_FAIL=1"
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        name, weight = item.split("=")
+        mix[MessageType[name.strip()]] = float(weight)
+    return mix
+
+def wait_for_backend(backend, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with connect(backend, 1, 0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Backend on port {backend['ports'][1]} did not come up within {timeout} s")
+
+def child_pids(pid):
+    # Worker processes of a prefork backend
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                    children.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            pass
+    return children
+
+def wait_for_workers(backend, count, timeout=10.0):
+    # Each worker binds its handoff socket once it is serving
+    deadline = time.monotonic() + timeout
+    paths = [handoff_path(backend["ports"][0], index) for index in range(count)] if count > 1 else []
+    while not all(os.path.exists(path) for path in paths):
+        if time.monotonic() >= deadline:
+            raise RuntimeError(f"Backend workers on port {backend['ports'][0]} did not come up within {timeout} s")
+        time.sleep(0.05)
+
+def process_usage(pid):
+    # Summed over the process and its workers
+    usages = [single_process_usage(p) for p in [pid] + child_pids(pid)]
+    if any(usage["cpu_seconds"] is None for usage in usages):
+        return {"cpu_seconds": None, "threads": None, "sockets": None}
+    return {key: sum(usage[key] for usage in usages) for key in usages[0]}
+
+def single_process_usage(pid):
+    # CPU seconds, thread count and open sockets of a local process, read from /proc (Linux only)
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / ticks
+        threads = int(fields[17])
+        sockets = sum(1 for fd in os.listdir(f"/proc/{pid}/fd")
+                      if os.readlink(f"/proc/{pid}/fd/{fd}").startswith("socket:"))
+        return {"cpu_seconds": cpu_seconds, "threads": threads, "sockets": sockets}
+    except (OSError, IndexError, ValueError):
+        return {"cpu_seconds": None, "threads": None, "sockets": None}
+
+class SimulatedController(threading.Thread):
+    # One controller: a command connection, a subscription, and a local model of the session state.
+    # Every message is timed from sendall to its ACK, which the backend sends once the handler has run;
+    # those that change the state are also timed to the STATE_CHANGED push.
+    def __init__(self, controller_id, backend, mix, rate, duration, seed):
+        super().__init__(name=controller_id, daemon=True)
+        self.controller_id = controller_id
+        self.backend = backend  # Registry-style entry: host, ports and transport
+        self.mix_types = list(mix)
+        self.mix_weights = list(mix.values())
+        self.rate = rate  # Messages per second, 0 = as fast as possible
+        self.duration = duration
+        self.random = random.Random(seed)
+        self.ack_histograms = {message_type: LatencyHistogram() for message_type in mix}
+        self.state_histograms = {message_type: LatencyHistogram() for message_type in mix}
+        self.sent = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def connect(self):
+        hello = encode_frame(MessageType.HELLO, self.controller_id.encode())
+        self.subscription = connect(self.backend, 0, 2.0)
+        self.subscription.sendall(hello)
+        self.commands = connect(self.backend, 1, 2.0)
+        self.commands.sendall(hello)
+        self.reader = FrameReader(self.subscription)
+        self.command_reader = FrameReader(self.commands)
+        # Discard the state snapshots sent on subscription
+        time.sleep(0.2)
+        self.subscription.setblocking(False)
+        try:
+            while self.subscription.recv(65536):
+                pass
+        except BlockingIOError:
+            pass
+        self.subscription.settimeout(1.0)
+
+    def wait_for_state(self, started):
+        while True:
+            frame = self.reader.read_frame()
+            if frame is None:
+                raise ConnectionError("Subscription closed")
+            _, message_type, sequence_number, body = frame
+            if sequence_number:
+                self.subscription.sendall(encode_frame(MessageType.ACK, sequence_number=sequence_number))
+            if message_type == MessageType.STATE_CHANGED and bool(body[0]) == started:
+                return
+
+    def wait_for_ack(self, sequence_number):
+        while True:
+            frame = self.command_reader.read_frame()
+            if frame is None:
+                raise ConnectionError("Command connection closed")
+            _, message_type, acked, _ = frame
+            if message_type == MessageType.ACK and acked == sequence_number:
+                return
+
+    def run(self):
+        try:
+            self.connect()
+        except OSError:
+            self.errors += 1
+            return
+        started = False
+        sequence_number = 0
+        interval = 1.0 / self.rate if self.rate else 0
+        next_send = time.perf_counter()
+        end = next_send + self.duration
+        while True:
+            now = time.perf_counter()
+            if now >= end:
+                break
+            if interval:
+                if now < next_send:
+                    time.sleep(next_send - now)
+                next_send += interval
+            message_type = self.random.choices(self.mix_types, self.mix_weights)[0]
+            body = b"bench" if message_type == MessageType.CONNECTION_FAIL else b""
+            expected = started
+            if message_type == MessageType.START:
+                expected = True
+            elif message_type in (MessageType.END, MessageType.ERROR, MessageType.CONNECTION_FAIL):
+                expected = False
+            sequence_number += 1
+            sent_at = time.perf_counter_ns()
+            try:
+                self.commands.sendall(encode_frame(message_type, body, sequence_number))
+                self.wait_for_ack(sequence_number)
+                self.ack_histograms[message_type].record(time.perf_counter_ns() - sent_at)
+                self.sent += 1
+                if expected != started:
+                    self.wait_for_state(expected)
+                    self.state_histograms[message_type].record(time.perf_counter_ns() - sent_at)
+                    started = expected
+            except socket.timeout:
+                self.timeouts += 1
+            except (OSError, ConnectionError):
+                self.errors += 1
+                break
+        self.commands.close()
+        self.subscription.close()
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def run_benchmark(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    mix = parse_mix(args.mix)
+    backends = []
+    for i in range(args.backends):
+        ports = [args.base_port + 2 * i, args.base_port + 2 * i + 1]
+        command = [sys.executable, os.path.join(here, "backend_process.py"), str(ports[0]), str(ports[1]), "--quiet"]
+        if args.use_async:
+            command.append("--async")
+        if args.transport != "tcp":
+            command += ["--transport", args.transport]
+        if args.workers > 1:
+            command += ["--workers", str(args.workers)]
+        backends.append(({"host": "localhost", "ports": ports, "transport": args.transport},
+                         subprocess.Popen(command, stdout=subprocess.DEVNULL)))
+    try:
+        for backend, _ in backends:
+            wait_for_backend(backend)
+            wait_for_workers(backend, args.workers)
+        usage_before = [process_usage(process.pid) for _, process in backends]
+
+        controllers = [SimulatedController(f"bench-{os.getpid()}-{i}", backends[i % len(backends)][0],
+                                           mix, args.rate, args.duration, args.seed + i)
+                       for i in range(args.controllers)]
+        start = time.perf_counter()
+        for controller in controllers:
+            controller.start()
+        # Sample while loaded, since idle connections are closed at the end
+        time.sleep(min(args.duration / 2, 1.0))
+        usage_loaded = [process_usage(process.pid) for _, process in backends]
+        for controller in controllers:
+            controller.join()
+        elapsed = time.perf_counter() - start
+        usage_after = [process_usage(process.pid) for _, process in backends]
+    finally:
+        for _, process in backends:
+            process.terminate()
+            process.wait()
+
+    def latency(histograms):
+        summaries = {}
+        for message_type in mix:
+            merged = LatencyHistogram()
+            for controller in controllers:
+                merged.merge(histograms(controller)[message_type])
+            if merged.count:
+                summaries[MESSAGE_NAMES[message_type]] = {key: value / 1e3 if key != "count" else value
+                                                          for key, value in merged.summary().items()}
+        return summaries
+
+    sent = sum(controller.sent for controller in controllers)
+    cpu_seconds = None
+    if all(u["cpu_seconds"] is not None for u in usage_before + usage_after):
+        cpu_seconds = sum(a["cpu_seconds"] - b["cpu_seconds"] for a, b in zip(usage_after, usage_before))
+    return {
+        "config": {"backends": args.backends, "controllers": args.controllers, "rate": args.rate,
+                   "duration": args.duration, "mix": args.mix, "async": args.use_async,
+                   "transport": args.transport, "workers": args.workers, "seed": args.seed},
+        "environment": {"revision": git_revision(), "python": platform.python_version(),
+                        "platform": platform.platform(), "cpus": os.cpu_count()},
+        "messages_sent": sent,
+        "messages_per_second": sent / elapsed if elapsed else 0,
+        "timeouts": sum(controller.timeouts for controller in controllers),
+        "errors": sum(controller.errors for controller in controllers),
+        "ack_latency_us": latency(lambda controller: controller.ack_histograms),
+        "state_latency_us": latency(lambda controller: controller.state_histograms),
+        "backend_cpu_seconds": cpu_seconds,
+        "backend_threads": [u["threads"] for u in usage_loaded],
+        "backend_sockets": [u["sockets"] for u in usage_loaded],
+    }
+
+def print_result(result, baseline=None):
+    print(f"Sent {result['messages_sent']} messages: {result['messages_per_second']:.0f} msgs/s, "
+          f"timeouts={result['timeouts']} errors={result['errors']}")
+    if baseline:
+        change = result["messages_per_second"] / baseline["messages_per_second"] - 1 if baseline["messages_per_second"] else 0
+        print(f"  vs baseline ({baseline['environment'].get('revision')}): {change:+.1%} msgs/s")
+    for key, title in (("ack_latency_us", "sent to ACK"), ("state_latency_us", "sent to STATE_CHANGED")):
+        print(f"  {title}:")
+        baseline_latency = baseline.get(key, {}) if baseline else {}
+        for name, summary in sorted(result[key].items()):
+            line = (f"    {name:<16} n={summary['count']:<7} p50={summary['p50']:.0f}us "
+                    f"p99={summary['p99']:.0f}us p999={summary['p999']:.0f}us max={summary['max']:.0f}us")
+            if name in baseline_latency:
+                line += f" (p99 was {baseline_latency[name]['p99']:.0f}us)"
+            print(line)
+    print(f"  backend cpu={result['backend_cpu_seconds']} s threads={result['backend_threads']} "
+          f"sockets={result['backend_sockets']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator and benchmark for backend_process.py")
+    parser.add_argument("--backends", type=int, default=1, help="local backend processes to start")
+    parser.add_argument("--controllers", type=int, default=8, help="simulated controllers")
+    parser.add_argument("--rate", type=float, default=0, help="messages/s per controller, 0 = unthrottled")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds to run")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"message weights (default {DEFAULT_MIX})")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="run backends in asyncio mode")
+    parser.add_argument("--transport", choices=TRANSPORTS, default="tcp",
+                        help="how the simulated controllers reach the local backends")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes per backend (prefork mode)")
+    parser.add_argument("--base-port", type=int, default=19090)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", metavar="PATH", help="write results as JSON")
+    parser.add_argument("--compare", metavar="PATH", help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_result(result, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+if __name__ == "__main__":
+    main()
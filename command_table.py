@@ -0,0 +1,73 @@
+import threading
+import time
+from latency_stats import LatencyHistogram
+
+class Command:
+    # One registered handler with its call count, failures and handler time
+    __slots__ = ("name", "handler", "count", "errors", "histogram")
+
+    def __init__(self, name, handler):
+        self.name = name
+        self.handler = handler
+        self.count = 0
+        self.errors = 0
+        self.histogram = LatencyHistogram()
+
+class CommandTable:
+    # Handlers indexed by the MessageType byte of the frame header, so dispatch is one list lookup
+    # however many commands are registered. Handlers get whatever dispatch is called with, the body
+    # still being a view into the connection's receive buffer.
+    def __init__(self, fallback=None):
+        self.slots = [None] * 256  # MessageType is one byte on the wire
+        self.fallback = fallback  # (message_type, *args) for types nobody registered
+        self.unknown = 0
+        self.lock = threading.Lock()  # Connection threads dispatch concurrently
+
+    def register(self, message_type, handler, name=None):
+        # Replaces any handler already registered for message_type
+        if not 0 <= message_type < len(self.slots):
+            raise ValueError(f"Message type {message_type} does not fit in the header")
+        self.slots[message_type] = Command(name or getattr(message_type, "name", str(message_type)), handler)
+
+    def unregister(self, message_type):
+        self.slots[message_type] = None
+
+    def dispatch(self, message_type, *args):
+        # Returns False if no handler is registered for message_type
+        command = self.slots[message_type]
+        if command is None:
+            with self.lock:
+                self.unknown += 1
+            if self.fallback is not None:
+                self.fallback(message_type, *args)
+            return False
+        started = time.perf_counter_ns()
+        try:
+            command.handler(*args)
+        except Exception:
+            with self.lock:
+                command.errors += 1
+            raise
+        elapsed = time.perf_counter_ns() - started
+        with self.lock:
+            command.count += 1
+            command.histogram.record(elapsed)
+        return True
+
+    def snapshot(self):
+        # {name: {"count", "errors", handler time summary...}} for every registered command
+        with self.lock:
+            return {command.name: dict(command.histogram.summary(), count=command.count, errors=command.errors)
+                    for command in self.slots if command is not None}
+
+    def format_report(self):
+        lines = []
+        for name, summary in sorted(self.snapshot().items()):
+            if not summary["count"] and not summary["errors"]:
+                continue
+            lines.append(f"command {name}: n={summary['count']} errors={summary['errors']} "
+                         f"p50={summary['p50'] / 1e3:.1f}us p99={summary['p99'] / 1e3:.1f}us "
+                         f"max={summary['max'] / 1e3:.1f}us")
+        if self.unknown:
+            lines.append(f"command unknown: n={self.unknown}")
+        return lines
@@ -1,29 +1,69 @@
 import sys
+import time
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QPushButton, QVBoxLayout, 
                            QWidget, QMessageBox, QLabel, QGridLayout, QLineEdit,
-                           QGroupBox, QFormLayout)
-from PyQt5.QtCore import Qt, QTimer
-import socket
-import threading
-import time
+                           QGroupBox, QFormLayout, QTableView, QHeaderView, QScrollArea,
+                           QFrame, QAbstractItemView)
+from PyQt5.QtCore import (Qt, QTimer, QThread, QObject, QMetaObject, QSortFilterProxyModel,
+                          pyqtSignal, pyqtSlot)
+from backend_health import GIVING_UP
+from controller_core import ControllerCore, load_backends
+from status_model import SORT_ROLE, BackendStatusModel
+from tcp_common import MessageType, MESSAGE_NAMES
+
+class NetworkWorker(QObject):
+    # Lives on its own QThread, runs ControllerCore calls for the GUI and relays its events as signals
+    message_sent = pyqtSignal(int, list)  # message type, per-backend (sent, elapsed, error)
+    connection_changed = pyqtSignal(int, bool)  # backend index, subscription connected
+    connection_lost = pyqtSignal()
+    ready_received = pyqtSignal(int)  # backend index
+    state_changed = pyqtSignal(int, bool)  # backend index, started
+    controls_changed = pyqtSignal(bool, bool)  # toggle on, event button enabled
+    health_changed = pyqtSignal(int, str)  # backend index, backend_health state
+
+    def __init__(self, core):
+        super().__init__()
+        self.core = core
+        core.add_listener(self.on_core_event)
+
+    def on_core_event(self, event, *args):
+        # Signals are queued to the GUI thread whichever thread the core called from
+        getattr(self, event).emit(*args)
+
+    @pyqtSlot()
+    def start(self):
+        self.core.start()
+
+    @pyqtSlot()
+    def toggle(self):
+        self.core.toggle()
+
+    @pyqtSlot()
+    def send_event(self):
+        self.core.send_event()
+
+    @pyqtSlot(int, str)
+    def set_host(self, index, host):
+        self.core.set_host(index, host)
+
+    @pyqtSlot()
+    def shutdown(self):
+        self.core.stop()
 
 class ControlApp(QMainWindow):
-    def __init__(self):
+    # Requests to the network worker; queued across threads by Qt
+    toggle_requested = pyqtSignal()
+    event_requested = pyqtSignal()
+    host_changed = pyqtSignal(int, str)
+
+    def __init__(self, backends=None, synchronized=False):
         super().__init__()
         self.setWindowTitle("Control Panel")
         
-        # TCP/IP settings for two backends with two sockets each
-        self.backends = [
-            {"host": "localhost", "ports": [9090, 9091], "name": "Backend 1", 
-             "reconnect_start": 0, "is_reconnecting": False, "ready": False,
-             "sockets": [None, None]},  # Store socket objects
-            {"host": "localhost", "ports": [9092, 9093], "name": "Backend 2",
-             "reconnect_start": 0, "is_reconnecting": False, "ready": False,
-             "sockets": [None, None]}   # Store socket objects
-        ]
+        # Control logic lives in ControllerCore; this window only mirrors its state
+        self.core = ControllerCore(backends, synchronized=synchronized)
+        self.backends = self.core.backends
         self.is_toggle_on = False
-        self.RECONNECT_TIMEOUT = 60  # 1 minute timeout for reconnection
-        self.event_sent = False  # Track if event was sent and waiting for READY
         
         # Create central widget and layout
         central_widget = QWidget()
@@ -74,20 +114,38 @@ class ControlApp(QMainWindow):
         """)
         config_layout.addWidget(self.apply_btn, len(self.backends), 0, 1, 4)
         
-        config_group.setLayout(config_layout)
+        # Scrolls once there are more backends than fit
+        config_widget = QWidget()
+        config_widget.setLayout(config_layout)
+        config_scroll = QScrollArea()
+        config_scroll.setWidget(config_widget)
+        config_scroll.setWidgetResizable(True)
+        config_scroll.setFrameShape(QFrame.NoFrame)
+        config_group_layout = QVBoxLayout()
+        config_group_layout.addWidget(config_scroll)
+        config_group.setLayout(config_group_layout)
         main_layout.addWidget(config_group)
         
         # Create control group
         control_group = QGroupBox("Control Panel")
         control_layout = QGridLayout()
         
-        # Create status labels
-        self.status_labels = []
-        for i, backend in enumerate(self.backends):
-            label = QLabel(f"{backend['name']}: Not Connected")
-            label.setStyleSheet("color: red; font-size: 32px;")
-            control_layout.addWidget(label, 0, i, alignment=Qt.AlignCenter)
-            self.status_labels.append(label)
+        # Status table: one row per backend, sortable by any column, repainted only when rows change
+        self.status_model = BackendStatusModel(self.backends, max_rate=10, parent=self)
+        status_proxy = QSortFilterProxyModel(self)
+        status_proxy.setSourceModel(self.status_model)
+        status_proxy.setSortRole(SORT_ROLE)
+        self.status_view = QTableView()
+        self.status_view.setModel(status_proxy)
+        self.status_view.setSortingEnabled(True)
+        self.status_view.sortByColumn(0, Qt.AscendingOrder)
+        self.status_view.setSelectionMode(QAbstractItemView.NoSelection)
+        self.status_view.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.status_view.verticalHeader().hide()
+        self.status_view.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.status_view.setStyleSheet("font-size: 32px;")
+        self.status_view.verticalHeader().setDefaultSectionSize(48)
+        control_layout.addWidget(self.status_view, 0, 0)
         
         # Create buttons with larger font
         self.toggle_btn = QPushButton("Start")
@@ -129,8 +187,8 @@ class ControlApp(QMainWindow):
         self.event_btn.clicked.connect(self.send_event)
         
         # Add buttons to layout
-        control_layout.addWidget(self.toggle_btn, 1, 0, 1, 2, alignment=Qt.AlignCenter)
-        control_layout.addWidget(self.event_btn, 2, 0, 1, 2, alignment=Qt.AlignCenter)
+        control_layout.addWidget(self.toggle_btn, 1, 0, alignment=Qt.AlignCenter)
+        control_layout.addWidget(self.event_btn, 2, 0, alignment=Qt.AlignCenter)
         
         control_group.setLayout(control_layout)
         main_layout.addWidget(control_group)
@@ -144,10 +202,23 @@ class ControlApp(QMainWindow):
         self.timer = QTimer()
         self.timer.timeout.connect(self.enable_event_button)
         
-        # Create timer for checking backend status
-        self.status_timer = QTimer()
-        self.status_timer.timeout.connect(self.check_backend_status)
-        self.status_timer.start(1000)  # Check every 1 second
+        # Start network worker thread; the GUI thread never touches sockets
+        self.network_thread = QThread()
+        self.network_worker = NetworkWorker(self.core)
+        self.network_worker.moveToThread(self.network_thread)
+        self.toggle_requested.connect(self.network_worker.toggle)
+        self.event_requested.connect(self.network_worker.send_event)
+        self.host_changed.connect(self.network_worker.set_host)
+        self.network_worker.message_sent.connect(self.on_message_sent)
+        self.network_worker.connection_changed.connect(self.on_connection_changed)
+        self.network_worker.connection_lost.connect(self.on_connection_lost)
+        self.network_worker.state_changed.connect(self.on_state_changed)
+        self.network_worker.controls_changed.connect(self.on_controls_changed)
+        self.network_worker.health_changed.connect(self.on_health_changed)
+        self.network_worker.ready_received.connect(self.on_ready_received)
+        # Backends push READY and state changes over the subscription, no status polling needed
+        self.network_thread.started.connect(self.network_worker.start)
+        self.network_thread.start()
         
         # Set window style
         self.setStyleSheet("""
@@ -170,57 +241,34 @@ class ControlApp(QMainWindow):
         
         self.event_btn.setEnabled(True)  # Enable event button in initial state
         
-    def check_backend_status(self):
-        # 첫 번째 포트(9090)만 사용하여 상태 및 READY 메시지 확인
-        for i, backend in enumerate(self.backends):
-            try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.settimeout(0.5)
-                    s.connect((backend["host"], backend["ports"][0]))  # 첫 번째 포트만 사용
-                    s.setblocking(False)
-                    try:
-                        message = s.recv(1024).decode()
-                        if message == "READY":
-                            backend["ready"] = True
-                            if all(b["ready"] for b in self.backends) and self.event_sent:
-                                self.event_btn.setEnabled(True)
-                                self.event_sent = False
-                    except:
-                        pass
-                    
-                    # 연결 성공 시 상태 업데이트
-                    self.status_labels[i].setText(f"{backend['name']}: Connected")
-                    self.status_labels[i].setStyleSheet("color: green; font-size: 32px;")
-            except Exception:
-                # Connection failed
-                if not backend["is_reconnecting"]:
-                    backend["is_reconnecting"] = True
-                    backend["reconnect_start"] = time.time()
-                    self.status_labels[i].setText(f"{backend['name']}: Reconnecting...")
-                    self.status_labels[i].setStyleSheet("color: orange; font-size: 32px;")
-        
-        # If any server is reconnecting during start stage, change to start state
-        if any(backend["is_reconnecting"] for backend in self.backends) and self.is_toggle_on:
-            self.toggle_btn.setText("Start")
-            self.toggle_btn.setStyleSheet("""
-                QPushButton {
-                    font-size: 32px;
-                    font-weight: bold;
-                    padding: 5px;
-                    background-color: #4CAF50;
-                    color: white;
-                    border-radius: 5px;
-                }
-                QPushButton:hover {
-                    background-color: #45a049;
-                }
-            """)
-            self.is_toggle_on = False
-            self.event_btn.setEnabled(False)  # Enable event button when connection is lost
-            # Send ERROR message to any connected backends
-            self.send_tcp_message("ERROR")
-            QMessageBox.warning(self, "Connection Lost", 
-                "Connection lost to one or more backends.\nSystem reset to 'Start' state.")
+    def on_connection_changed(self, i, connected):
+        if connected:
+            # 연결 성공 시 상태 업데이트
+            self.status_model.update(i, status="connected", last_seen=time.time())
+        else:
+            # Connection failed
+            self.status_model.update(i, status="reconnecting")
+
+    def on_health_changed(self, i, state):
+        # Down for over a minute: still retried, but only every 30 seconds
+        if state == GIVING_UP:
+            self.status_model.update(i, status="unreachable")
+
+    def on_ready_received(self, i):
+        self.status_model.update(i, last_seen=time.time())
+
+    def on_connection_lost(self):
+        # The core has already reset to the Start state and sent ERROR to the remaining backends
+        QMessageBox.warning(self, "Connection Lost", 
+            "Connection lost to one or more backends.\nSystem reset to 'Start' state.")
+
+    def on_controls_changed(self, is_toggle_on, event_enabled):
+        self.set_toggle_state(is_toggle_on)
+        self.event_btn.setEnabled(event_enabled)
+
+    def on_state_changed(self, i, started):
+        print(f"{self.backends[i]['name']} state: {'STARTED' if started else 'NOT STARTED'}")
+        self.status_model.update(i, started=started, last_seen=time.time())
         
     def apply_configuration(self):
         for i, backend in enumerate(self.backends):
@@ -230,8 +278,9 @@ class ControlApp(QMainWindow):
                 if not ip:
                     raise ValueError(f"{backend['name']}: IP address cannot be empty")
                 
-                # Update backend configuration
-                self.backends[i]['host'] = ip
+                # Update backend configuration on the network worker
+                self.host_changed.emit(i, ip)
+                self.status_model.update(i, host=ip)
                 
             except ValueError as e:
                 QMessageBox.warning(self, "Configuration Error", str(e))
@@ -247,115 +296,88 @@ class ControlApp(QMainWindow):
             (screen.height() - size.height()) // 2
         )
         
-    def send_tcp_message(self, message):
-        success = True
+    def on_message_sent(self, message_type, results):
         failed_backends = []
-        
-        for i, backend in enumerate(self.backends):
-            try:
-                # 두 번째 포트(9091)로만 메시지 전송
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect((backend["host"], backend["ports"][1]))  # 두 번째 포트 사용
-                s.sendall(message.encode())
-                
-                self.status_labels[i].setText(f"{backend['name']}: Connected")
-                self.status_labels[i].setStyleSheet("color: green; font-size: 32px;")
-            except Exception as e:
-                success = False
+        for i, (backend, (sent, elapsed, error)) in enumerate(zip(self.backends, results)):
+            print(f"{MESSAGE_NAMES[message_type]} -> {backend['name']}: "
+                  f"{'sent' if sent else error} in {elapsed * 1000:.1f} ms")
+            if sent:
+                self.status_model.update(i, status="connected", last_seen=time.time(), latency=elapsed * 1000)
+            else:
                 failed_backends.append(backend["name"])
-                self.status_labels[i].setText(f"{backend['name']}: Not Connected")
-                self.status_labels[i].setStyleSheet("color: red; font-size: 32px;")
+                self.status_model.update(i, status="unreachable" if backend["health"].state == GIVING_UP
+                                         else "not_connected")
         
-        if not success:
+        if failed_backends:
             QMessageBox.warning(self, "Connection Warning", 
                               f"Failed to send message to: {', '.join(failed_backends)}")
         
-        return success, failed_backends
+        if message_type in (MessageType.START, MessageType.END):
+            self.toggle_btn.setEnabled(True)
+        elif message_type == MessageType.EVENT and not failed_backends:
+            print("Event sent, waiting for READY messages from all backends")
+
+    def set_toggle_state(self, is_on):
+        if is_on:
+            self.toggle_btn.setText("End")
+            self.toggle_btn.setStyleSheet("""
+                QPushButton {
+                    font-size: 32px;
+                    font-weight: bold;
+                    padding: 5px;
+                    background-color: #ff9999;
+                    color: white;
+                    border-radius: 5px;
+                }
+                QPushButton:hover {
+                    background-color: #ff8080;
+                }
+            """)
+        else:
+            self.toggle_btn.setText("Start")
+            self.toggle_btn.setStyleSheet("""
+                QPushButton {
+                    font-size: 32px;
+                    font-weight: bold;
+                    padding: 5px;
+                    background-color: #4CAF50;
+                    color: white;
+                    border-radius: 5px;
+                }
+                QPushButton:hover {
+                    background-color: #45a049;
+                }
+            """)
+        self.is_toggle_on = is_on
     
     def toggle_action(self):
-        if not self.is_toggle_on:  # Sending START
-            success, failed_backends = self.send_tcp_message("START")
-            if success:
-                self.toggle_btn.setText("End")
-                self.toggle_btn.setStyleSheet("""
-                    QPushButton {
-                        font-size: 32px;
-                        font-weight: bold;
-                        padding: 5px;
-                        background-color: #ff9999;
-                        color: white;
-                        border-radius: 5px;
-                    }
-                    QPushButton:hover {
-                        background-color: #ff8080;
-                    }
-                """)
-                self.is_toggle_on = True
-                self.event_btn.setEnabled(False)  # Disable event button after successful START
-            else:
-                # If START fails, notify other backend
-                if len(failed_backends) < len(self.backends):
-                    failure_message = f"CONNECTION_FAIL:{','.join(failed_backends)}"
-                    self.send_tcp_message(failure_message)
-                
-                self.toggle_btn.setText("Start")
-                self.toggle_btn.setStyleSheet("""
-                    QPushButton {
-                        font-size: 32px;
-                        font-weight: bold;
-                        padding: 5px;
-                        background-color: #4CAF50;
-                        color: white;
-                        border-radius: 5px;
-                    }
-                    QPushButton:hover {
-                        background-color: #45a049;
-                    }
-                """)
-                self.is_toggle_on = False
-                self.event_btn.setEnabled(True)  # Enable event button if START fails
-        else:  # Sending END
-            success, _ = self.send_tcp_message("END")
-            if success:
-                self.toggle_btn.setText("Start")
-                self.toggle_btn.setStyleSheet("""
-                    QPushButton {
-                        font-size: 32px;
-                        font-weight: bold;
-                        padding: 5px;
-                        background-color: #4CAF50;
-                        color: white;
-                        border-radius: 5px;
-                    }
-                    QPushButton:hover {
-                        background-color: #45a049;
-                    }
-                """)
-                self.is_toggle_on = False
-                self.event_btn.setEnabled(True)  # Enable event button when END is sent
+        # Block repeated clicks until the worker reports back
+        self.toggle_btn.setEnabled(False)
+        self.toggle_requested.emit()
     
     def send_event(self):
-        # Reset ready state for all backends
-        for backend in self.backends:
-            backend["ready"] = False
-        
-        success, _ = self.send_tcp_message("EVENT")
-        if success:
-            self.event_sent = True  # Mark that we're waiting for READY messages
-            self.event_btn.setEnabled(False)  # Disable button while waiting for READY
-            print("Event sent, waiting for READY messages from all backends")
+        self.event_btn.setEnabled(False)  # Disable button while the EVENT is in flight
+        self.event_requested.emit()
     
     def enable_event_button(self):
         self.event_btn.setEnabled(True)
         self.timer.stop()
 
+    def closeEvent(self, event):
+        QMetaObject.invokeMethod(self.network_worker, "shutdown", Qt.BlockingQueuedConnection)
+        self.network_thread.quit()
+        self.network_thread.wait()
+        super().closeEvent(event)
+
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     
     # Set application style
     app.setStyle('Fusion')
     
-    window = ControlApp()
+    # Optional backend registry file, e.g. python control_app.py backends.json; --sync makes START/END
+    # take effect on all backends at the same time
+    args = [arg for arg in sys.argv[1:] if arg != "--sync"]
+    window = ControlApp(load_backends(args[0] if args else None), synchronized="--sync" in sys.argv)
     window.show()
-    sys.exit(app.exec_()) 
\ No newline at end of file
+    sys.exit(app.exec_())
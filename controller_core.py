@@ -0,0 +1,764 @@
+import concurrent.futures
+import errno
+import json
+import os
+import queue
+import selectors
+import socket
+import sys
+import threading
+import time
+from backend_health import BackendHealth
+from delivery import DedupWindow
+from latency_stats import LatencyStats
+from tcp_common import (MessageType, MESSAGE_NAMES, ACTIVATION_STRUCT, CLOCK_STRUCT, MAX_BODY_LENGTH, FrameReader,
+                        ProtocolError, StreamedFrame, body_bytes, encode_frame)
+from transports import SHM_SUPPORTED, TRANSPORTS, connect, has_buffered, wait_readable
+
+DEFAULT_BACKENDS = [
+    {"name": "Backend 1", "host": "localhost", "ports": [9090, 9091]},
+    {"name": "Backend 2", "host": "localhost", "ports": [9092, 9093]},
+]
+
+def load_backends(path=None):
+    # Backend registry: JSON list of {"name", "host", "ports": [status_port, command_port]}, optionally
+    # with "transport" ("tcp", or "unix"/"shm" for a backend on this host) and "socket_dir".
+    # "health" is the cached connection state that reconnects and command sends go by.
+    # "clock_offset" is the backend's clock minus ours in ns, as last measured, and "clock_delay" the
+    # round trip of that measurement. "activation" is the time (backend clock) of the synchronized
+    # START/END it took and has not confirmed yet.
+    entries = DEFAULT_BACKENDS
+    if path is not None:
+        with open(path) as f:
+            entries = json.load(f)
+    
+    backends = []
+    for i, entry in enumerate(entries):
+        ports = [int(port) for port in entry["ports"]]
+        if len(ports) != 2:
+            raise ValueError(f"Backend {i + 1}: expected two ports, got {len(ports)}")
+        transport = entry.get("transport", "tcp")
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Backend {i + 1}: unknown transport {transport!r}, expected one of {', '.join(TRANSPORTS)}")
+        if transport == "shm" and not SHM_SUPPORTED:
+            raise ValueError(f"Backend {i + 1}: the shm transport is only supported on x86-64, use unix")
+        backends.append({"host": entry.get("host", "localhost"), "ports": ports,
+                         "transport": transport, "socket_dir": entry.get("socket_dir"),
+                         "name": entry.get("name", f"Backend {i + 1}"),
+                         "health": BackendHealth(), "clock_offset": None, "clock_delay": None, "activation": None,
+                         "ready": False, "started": False, "connected": None,
+                         "sockets": [None, None]})  # Store socket objects
+    return backends
+
+class ConnectionPool:
+    # Keeps one long-lived connection per backend/port in backend["sockets"]
+    def __init__(self, timeout=0.5, max_workers=32, hello=None, initial_rto=0.05, max_rto=0.4):
+        self.timeout = timeout
+        self.hello = hello  # Frame sent first on every new connection to identify the controller
+        self.initial_rto = initial_rto  # Wait for an ACK before the first resend, doubled up to max_rto
+        self.max_rto = max_rto
+        self.lock = threading.Lock()
+        self.backend_locks = {}
+        self.readers = {}  # FrameReader per pooled socket, for ACKs coming back on it
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                              thread_name_prefix="fan-out")
+
+    def backend_lock(self, backend):
+        # One lock per backend so different backends can be served in parallel
+        with self.lock:
+            return self.backend_locks.setdefault(id(backend), threading.Lock())
+
+    @staticmethod
+    def is_alive(sock):
+        # Peek without blocking: b'' means the peer closed, no data means still open
+        try:
+            sock.setblocking(False)
+            try:
+                return sock.recv(1, socket.MSG_PEEK) != b""
+            finally:
+                sock.setblocking(True)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def get(self, backend, port_index):
+        sock = backend["sockets"][port_index]
+        if sock is not None:
+            if self.is_alive(sock):
+                sock.settimeout(self.timeout)
+                return sock
+            self.close(backend, port_index)
+
+        sock = connect(backend, port_index, self.timeout)
+        backend["sockets"][port_index] = sock
+        self.readers[sock] = FrameReader(sock)
+        if self.hello is not None:
+            sock.sendall(self.hello)
+        return sock
+
+    @staticmethod
+    def write(sock, data):
+        # data is an encoded frame or a StreamedFrame, whose body goes out from its file or buffer
+        if isinstance(data, StreamedFrame):
+            data.send(sock)
+        else:
+            sock.sendall(data)
+
+    def send(self, backend, port_index, data):
+        with self.backend_lock(backend):
+            try:
+                self.write(self.get(backend, port_index), data)
+            except OSError:
+                # Pooled connection went stale after the liveness check, reconnect once
+                self.close(backend, port_index)
+                self.write(self.get(backend, port_index), data)
+
+    def send_reliable(self, backend, port_index, data, sequence_number, until, cancelled):
+        # Stop-and-wait: resend the same frame with backoff until its ACK arrives, the time.monotonic()
+        # deadline until passes or the caller gives up and sets the cancelled event.
+        # The backend drops frames it has already processed, so a resend never takes effect twice.
+        # A streamed frame is only resent on a new connection: its ACK waits for the whole body to be
+        # processed, and resending megabytes to a backend that is still busy with them would not help.
+        rto = self.initial_rto
+        streamed = isinstance(data, StreamedFrame)
+        lock = self.backend_lock(backend)
+        if not lock.acquire(timeout=max(0, until - time.monotonic())):
+            raise TimeoutError(f"#{sequence_number} not sent, backend busy until the deadline")
+        try:
+            while not cancelled.is_set():
+                sock = self.get(backend, port_index)  # A refused connect fails right away
+                try:
+                    self.write(sock, data)
+                    if self.wait_ack(sock, sequence_number, until if streamed else min(until, time.monotonic() + rto)):
+                        return
+                except (OSError, ProtocolError):
+                    # Connection dropped with the frame or its ACK in flight, resend on a new one
+                    self.close(backend, port_index)
+                if time.monotonic() >= until:
+                    break
+                rto = min(rto * 2, self.max_rto)
+            raise TimeoutError(f"no ACK for #{sequence_number} before the deadline")
+        finally:
+            lock.release()
+
+    def wait_ack(self, sock, sequence_number, until):
+        # Skips late ACKs of earlier frames; returns False if the matching ACK does not arrive in time
+        reader = self.readers[sock]
+        while True:
+            if not wait_readable(sock, max(0, until - time.monotonic())):
+                return False
+            frame = reader.read_frame()
+            if frame is None:
+                raise ConnectionError("Connection closed while waiting for ACK")
+            _, message_type, acked, _ = frame
+            if message_type == MessageType.ACK and acked == sequence_number:
+                return True
+
+    def measure_clock(self, backend, samples=8):
+        # NTP-style, over the command connection: t0 is the probe's header TimeStamp, t1 and t2 when the
+        # backend read it and replied, t3 when the reply got back. The sample with the shortest round
+        # trip is kept, as the offset is off by at most half of it. Returns (offset, round trip) in ns.
+        best = None
+        with self.backend_lock(backend):
+            for _ in range(samples):
+                sock = self.get(backend, 1)
+                t0 = time.time_ns()
+                try:
+                    sock.sendall(encode_frame(MessageType.CLOCK, timestamp=t0))
+                    t1, t2, t3 = self.wait_clock(sock, t0, time.monotonic() + self.timeout)
+                except (OSError, ProtocolError):
+                    self.close(backend, 1)
+                    raise
+                delay = (t3 - t0) - (t2 - t1)
+                if best is None or delay < best[1]:
+                    best = ((t1 - t0) + (t2 - t3)) // 2, delay
+        return best
+
+    def wait_clock(self, sock, t0, until):
+        # Returns (t1, t2, t3) of the reply to the probe sent at t0, skipping late replies and ACKs
+        reader = self.readers[sock]
+        while True:
+            if not wait_readable(sock, max(0, until - time.monotonic())):
+                raise TimeoutError("no reply to clock probe")
+            frame = reader.read_frame()
+            t3 = time.time_ns()
+            if frame is None:
+                raise ConnectionError("Connection closed while waiting for clock reply")
+            t2, message_type, _, body = frame
+            if message_type == MessageType.CLOCK and len(body) == CLOCK_STRUCT.size:
+                echoed, t1 = CLOCK_STRUCT.unpack(body)
+                if echoed == t0:
+                    return t1, t2, t3
+
+    def close(self, backend, port_index=None):
+        indexes = range(len(backend["sockets"])) if port_index is None else [port_index]
+        for i in indexes:
+            sock = backend["sockets"][i]
+            backend["sockets"][i] = None
+            if sock is not None:
+                self.readers.pop(sock, None)
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+
+    def close_all(self, backends):
+        for backend in backends:
+            with self.backend_lock(backend):
+                self.close(backend)
+
+    def run_parallel(self, func, backends, deadline):
+        # Runs func(backend) for every backend at once under one overall deadline.
+        # Returns (result, elapsed seconds) per backend in order; result is None past the deadline.
+        start = time.perf_counter()
+        def timed(backend):
+            result = func(backend)
+            return result, time.perf_counter() - start
+        futures = [self.executor.submit(timed, backend) for backend in backends]
+        done, _ = concurrent.futures.wait(futures, timeout=deadline)
+        return [future.result() if future in done else (None, deadline) for future in futures]
+
+    def fan_out(self, backends, port_index, data, deadline, sequence_number=0):
+        # Returns (sent, elapsed seconds, error) per backend; sequenced frames count as sent once ACKed.
+        # A backend known to be down fails at once until its next retry is due, instead of using up
+        # the deadline; the outcome of every attempt updates its health.
+        # data may be a function of the backend, for frames that differ per backend; a ValueError
+        # from it fails that backend without counting against its health.
+        # Resends stop at the deadline, also for sends that had to wait for a worker or the backend lock.
+        until = time.monotonic() + deadline
+        cancelled = threading.Event()
+        def send_one(backend):
+            try:
+                frame = data(backend) if callable(data) else data
+            except ValueError as e:
+                return False, str(e)
+            health = backend.get("health")
+            if health is not None and not health.usable():
+                return False, f"{health.state}, next retry in {health.retry_in():.1f} s"
+            try:
+                if sequence_number:
+                    self.send_reliable(backend, port_index, frame, sequence_number, until, cancelled)
+                else:
+                    self.send(backend, port_index, frame)
+            except Exception as e:
+                if health is not None:
+                    health.failure()
+                return False, str(e)
+            if health is not None:
+                health.success()
+            return True, None
+        results = []
+        parallel = self.run_parallel(send_one, backends, deadline)
+        cancelled.set()
+        for result, elapsed in parallel:
+            sent, error = result if result is not None else (False, "deadline exceeded")
+            results.append((sent, elapsed, error))
+        return results
+
+class SubscriptionListener:
+    # Holds one persistent connection per backend on its first port and reports pushed frames.
+    # Missing connections are retried when the backend's health says so, with backoff.
+    # Callbacks run on the listener thread: on_frame(index, timestamp, message_type, sequence_number, body)
+    # and on_connection(index, connected)
+    def __init__(self, backends, on_frame, on_connection, connect_timeout=0.5, hello=None):
+        self.backends = backends
+        self.hello = hello
+        self.on_frame = on_frame
+        self.on_connection = on_connection
+        self.connect_timeout = connect_timeout
+        self.next_attempt = 0  # Earliest backoff retry or connect deadline, time.monotonic()
+        self.selector = selectors.DefaultSelector()
+        self.connections = [None] * len(backends)
+        self.connected = [None] * len(backends)  # None until the first attempt finishes
+        self.received = [DedupWindow() for _ in backends]  # Pushed sequence numbers already reported
+        self.commands = queue.SimpleQueue()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, None)
+        self.running = False
+        self.thread = threading.Thread(target=self.run, name="subscriptions", daemon=True)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup_send.send(b"\0")
+        self.thread.join()
+
+    def reconnect(self, index):
+        self.commands.put(index)
+        self.wakeup_send.send(b"\0")
+
+    def run(self):
+        while self.running:
+            now = time.monotonic()
+            if now >= self.next_attempt:
+                self.connect_missing(now)
+            timeout = None if self.next_attempt == float("inf") else max(0, self.next_attempt - time.monotonic())
+            for key, _ in self.selector.select(timeout=timeout):
+                if key.data is None:
+                    self.process_commands()
+                else:
+                    index, state = key.data
+                    if state == "connecting":
+                        self.finish_connect(index, key.fileobj)
+                    else:
+                        self.read(index)
+            self.expire_connects(time.monotonic())
+        for index in range(len(self.connections)):
+            self.close(index)
+        self.selector.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+
+    def process_commands(self):
+        try:
+            while self.wakeup_recv.recv(512):
+                pass
+        except BlockingIOError:
+            pass
+        while not self.commands.empty():
+            index = self.commands.get()
+            self.close(index)
+            self.backends[index]["health"].reset()
+            self.set_connected(index, False)
+        # Reconnect right away instead of waiting for the backoff
+        self.connect_missing(time.monotonic())
+
+    def connect_missing(self, now):
+        # Non-blocking connects so one unreachable host never delays pushes from the others
+        for index, backend in enumerate(self.backends):
+            if self.connections[index] is not None or not backend["health"].due(now):
+                continue
+            if backend["transport"] != "tcp":
+                # Local transports connect or fail right away, nothing to wait for
+                try:
+                    sock = connect(backend, 0, self.connect_timeout)
+                except OSError:
+                    self.failed(index)
+                    continue
+                self.connections[index] = (sock, None, None)
+                self.selector.register(sock, selectors.EVENT_WRITE, (index, "connecting"))
+                self.finish_connect(index, sock)
+                continue
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                result = sock.connect_ex((backend["host"], backend["ports"][0]))  # 첫 번째 포트 사용
+            except OSError:
+                sock.close()
+                self.failed(index)
+                continue
+            if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                sock.close()
+                self.failed(index)
+                continue
+            self.connections[index] = (sock, None, now + self.connect_timeout)
+            self.selector.register(sock, selectors.EVENT_WRITE, (index, "connecting"))
+        self.next_attempt = self.next_wakeup()
+
+    def next_wakeup(self):
+        # Earliest backoff retry of a missing connection or deadline of a pending connect
+        times = []
+        for backend, connection in zip(self.backends, self.connections):
+            if connection is None:
+                times.append(backend["health"].next_attempt)
+            elif connection[2] is not None:
+                times.append(connection[2])
+        return min(times, default=float("inf"))
+
+    def finish_connect(self, index, sock):
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+            self.close(index)
+            self.failed(index)
+            return
+        if self.backends[index]["transport"] == "shm":
+            sock.setblocking(False)  # Frames land in the ring whole, and a non-blocking reader gets woken for each
+        else:
+            sock.setblocking(True)
+            sock.settimeout(1.0)  # Bounds the wait for the rest of a partially received frame
+        if self.hello is not None:
+            try:
+                sock.sendall(self.hello)
+            except OSError:
+                self.close(index)
+                self.failed(index)
+                return
+        self.connections[index] = (sock, FrameReader(sock), None)
+        self.selector.modify(sock, selectors.EVENT_READ, (index, "connected"))
+        self.backends[index]["health"].success()
+        self.set_connected(index, True)
+
+    def expire_connects(self, now):
+        for index, connection in enumerate(self.connections):
+            if connection is not None and connection[2] is not None and now >= connection[2]:
+                self.close(index)
+                self.failed(index)
+
+    def read(self, index):
+        # A shared-memory connection can hold several frames behind one wake-up, so read them all
+        while self.read_frame(index) and has_buffered(self.connections[index][0]):
+            pass
+
+    def read_frame(self, index):
+        # Returns False once there is nothing more to read or the connection was closed
+        try:
+            frame = self.connections[index][1].read_frame()
+        except BlockingIOError:
+            return False  # Doorbell for frames that were already read
+        except (OSError, ValueError, ProtocolError):
+            frame = None
+        if frame is None:
+            self.close(index)
+            self.failed(index)
+            return False
+        timestamp, message_type, sequence_number, body = frame
+        try:
+            body = body_bytes(body)
+        except (OSError, ProtocolError):
+            self.close(index)
+            self.failed(index)
+            return False
+        if sequence_number:
+            if sequence_number == 1:
+                self.received[index].reset()  # Backend started a new session for us, e.g. after a restart
+            new = self.received[index].accept(sequence_number)
+            try:
+                # ACK duplicates too, the backend keeps resending until one gets through
+                self.connections[index][0].sendall(encode_frame(MessageType.ACK, sequence_number=sequence_number))
+            except OSError:
+                pass  # The next read notices the closed connection
+            if not new:
+                return True
+        self.on_frame(index, timestamp, message_type, sequence_number, body)
+        return True
+
+    def close(self, index):
+        connection = self.connections[index]
+        self.connections[index] = None
+        if connection is not None:
+            self.selector.unregister(connection[0])
+            connection[0].close()
+
+    def failed(self, index):
+        # A connect attempt failed or the connection dropped: back off before the next attempt
+        health = self.backends[index]["health"]
+        health.failure()
+        self.next_attempt = min(self.next_attempt, health.next_attempt)
+        self.set_connected(index, False)
+
+    def set_connected(self, index, connected):
+        if self.connected[index] != connected:
+            self.connected[index] = connected
+            self.on_connection(index, connected)
+
+class ControllerCore:
+    # GUI-independent controller: backend state, START/END toggle, EVENT/READY gating and the
+    # CONNECTION_FAIL/ERROR broadcasts. Listeners are called as listener(event, *args) from
+    # whichever thread produced the event:
+    #   message_sent(message_type, results), connection_changed(index, connected),
+    #   connection_lost(), ready_received(index), state_changed(index, started),
+    #   controls_changed(is_toggle_on, event_enabled), health_changed(index, health state)
+    # With synchronized set, START and END are two-phase: every backend gets the same activation time,
+    # start_lead seconds ahead and converted to its own clock, and they all switch at that time.
+    def __init__(self, backends=None, deadline=1.0, stats_interval=None, synchronized=False, start_lead=None):
+        self.backends = backends if backends is not None else load_backends()
+        self.deadline = deadline  # Overall limit for one fan-out to all backends
+        self.synchronized = synchronized
+        # Long enough for the fan-out to reach every backend that will ACK before the deadline
+        self.start_lead = start_lead if start_lead is not None else deadline
+        self.activation_ns = None  # Our clock's time of the last synchronized START or END
+        self.is_toggle_on = False
+        self.event_enabled = True
+        self.event_sent = False  # Track if event was sent and waiting for READY
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.listeners = []
+        self.stats = LatencyStats()  # Send time, push one-way latency and READY round trip per backend
+        self.stats_interval = stats_interval
+        self.event_sent_ns = [None] * len(self.backends)
+        # Backends keep one session per controller identity. Sequence numbers restart at 1 with every
+        # instance, so the identity must not repeat: another core in this process, or a reused pid, would
+        # have its first commands dropped as duplicates of the previous instance's.
+        self.controller_id = f"{socket.gethostname()}-{os.getpid()}-{os.urandom(4).hex()}"
+        hello = encode_frame(MessageType.HELLO, self.controller_id.encode())
+        self.pool = ConnectionPool(timeout=0.5, hello=hello)
+        self.sequence_number = 0
+        self.listener = SubscriptionListener(self.backends, self.on_pushed_frame, self.on_connection,
+                                             hello=hello)
+        for index, backend in enumerate(self.backends):
+            backend["health"].on_change = lambda state, index=index: self.notify("health_changed", index, state)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def notify(self, event, *args):
+        for listener in self.listeners:
+            listener(event, *args)
+
+    def start(self):
+        self.listener.start()
+        if self.stats_interval:
+            self.stats.start_periodic_dump(self.stats_interval)
+
+    def stop(self):
+        self.stats.stop_periodic_dump()
+        self.listener.stop()
+        self.pool.close_all(self.backends)
+        self.pool.executor.shutdown(wait=False)
+
+    def send(self, message_type, body=b"", compress=False, activation_ns=None):
+        # Fans the message out to every backend; returns the names of backends that failed.
+        # body may also be a path or binary file, sent from disk without reading it into memory;
+        # compress deflates the body if that makes it smaller.
+        # activation_ns (our clock) replaces the body of a START/END with when the backend should switch.
+        with self.lock:
+            self.sequence_number += 1
+            sequence_number = self.sequence_number
+        if activation_ns is not None:
+            def frame(backend):
+                if backend.get("clock_offset") is None:
+                    raise ValueError("clock offset not measured")
+                backend["activation"] = activation_ns + backend["clock_offset"]
+                return encode_frame(message_type, ACTIVATION_STRUCT.pack(backend["activation"]), sequence_number)
+        elif isinstance(body, (bytes, bytearray)) and len(body) <= MAX_BODY_LENGTH:
+            frame = encode_frame(message_type, body, sequence_number, compress=compress)
+        else:
+            frame = StreamedFrame(message_type, body, sequence_number, compress)
+        sent_ns = time.time_ns()
+        try:
+            # 두 번째 포트(9091)로만 메시지 전송 (풀에 유지된 연결 재사용)
+            results = self.pool.fan_out(self.backends, 1, frame, self.deadline, sequence_number)
+        finally:
+            if isinstance(frame, StreamedFrame):
+                frame.close()
+        message_name = MESSAGE_NAMES.get(message_type, str(message_type))
+        failed_backends = []
+        for index, (backend, (sent, elapsed, _)) in enumerate(zip(self.backends, results)):
+            if sent:
+                self.stats.record(backend["name"], message_name, "send", elapsed * 1e9)
+                if message_type == MessageType.EVENT:
+                    self.event_sent_ns[index] = sent_ns
+            else:
+                failed_backends.append(backend["name"])
+                backend["activation"] = None  # Cancelled by the CONNECTION_FAIL or ERROR that follows
+        self.notify("message_sent", message_type, results)
+        return failed_backends
+
+    def measure_clocks(self):
+        # Measures every backend's clock offset; returns the names of backends that could not be measured
+        def measure(backend):
+            measured = None
+            if backend["health"].usable():
+                try:
+                    measured = self.pool.measure_clock(backend)
+                except (OSError, ProtocolError):
+                    backend["health"].failure()
+                else:
+                    backend["health"].success()
+            # Without an offset the backend gets no synchronized START/END
+            backend["clock_offset"], backend["clock_delay"] = measured or (None, None)
+            return measured is not None
+        results = self.pool.run_parallel(measure, self.backends, self.deadline)
+        return [backend["name"] for backend, (measured, _) in zip(self.backends, results) if not measured]
+
+    def activation_time(self):
+        # None unless synchronized; else fresh offsets are measured and the switch is set start_lead ahead
+        if not self.synchronized:
+            self.activation_ns = None
+            return None
+        self.measure_clocks()
+        self.activation_ns = time.time_ns() + int(self.start_lead * 1e9)
+        return self.activation_ns
+
+    def start_capture(self):
+        failed_backends = self.send(MessageType.START, activation_ns=self.activation_time())
+        if not failed_backends:
+            self.set_controls(True, False)  # Disable event button after successful START
+            return True, failed_backends
+        
+        # If START fails, notify other backend; this also cancels a synchronized START still pending
+        if len(failed_backends) < len(self.backends):
+            self.send(MessageType.CONNECTION_FAIL, ','.join(failed_backends).encode())
+        self.set_controls(False, True)  # Enable event button if START fails
+        return False, failed_backends
+
+    def end_capture(self):
+        failed_backends = self.send(MessageType.END, activation_ns=self.activation_time())
+        if not failed_backends:
+            self.set_controls(False, True)  # Enable event button when END is sent
+        return not failed_backends, failed_backends
+
+    def toggle(self):
+        return self.end_capture() if self.is_toggle_on else self.start_capture()
+
+    def send_event(self):
+        with self.lock:
+            # Reset ready state for all backends
+            for backend in self.backends:
+                backend["ready"] = False
+            self.set_controls(self.is_toggle_on, False)  # Disabled while waiting for READY
+        failed_backends = self.send(MessageType.EVENT)
+        with self.lock:
+            if not failed_backends:
+                self.event_sent = True  # Mark that we're waiting for READY messages
+            else:
+                self.set_controls(self.is_toggle_on, True)
+        return not failed_backends, failed_backends
+
+    def send_error(self):
+        return self.send(MessageType.ERROR)
+
+    def send_data(self, source, compress=False):
+        # DATA payload (bytes, path or binary file) for every backend, streamed from disk if it is a file
+        failed_backends = self.send(MessageType.DATA, source, compress)
+        return not failed_backends, failed_backends
+
+    def set_controls(self, is_toggle_on, event_enabled):
+        with self.lock:
+            if (self.is_toggle_on, self.event_enabled) == (is_toggle_on, event_enabled):
+                return
+            self.is_toggle_on = is_toggle_on
+            self.event_enabled = event_enabled
+        self.notify("controls_changed", is_toggle_on, event_enabled)
+
+    def set_host(self, index, host):
+        backend = self.backends[index]
+        if backend["host"] != host:
+            self.pool.close_all([backend])
+            backend["host"] = host
+            self.listener.reconnect(index)
+
+    def on_pushed_frame(self, index, timestamp, message_type, sequence_number, body):
+        name = self.backends[index]["name"]
+        now = time.time_ns()
+        self.stats.record_one_way(name, MESSAGE_NAMES.get(message_type, str(message_type)), timestamp, now)
+        self.stats.observe_sequence(name, sequence_number)
+        if message_type == MessageType.READY:
+            event_sent_ns = self.event_sent_ns[index]
+            if event_sent_ns is not None:
+                self.event_sent_ns[index] = None
+                self.stats.record(name, "READY", "round_trip", now - event_sent_ns)
+            with self.lock:
+                self.backends[index]["ready"] = True
+                if all(b["ready"] for b in self.backends) and self.event_sent:
+                    self.event_sent = False
+                    self.set_controls(self.is_toggle_on, True)
+                self.changed.notify_all()
+            self.notify("ready_received", index)
+        elif message_type == MessageType.STATE_CHANGED and body:
+            self.backends[index]["started"] = bool(body[0])
+            if len(body) == 1 + ACTIVATION_STRUCT.size:
+                # Confirms a synchronized START/END; the push left this long after the agreed time
+                activation = ACTIVATION_STRUCT.unpack_from(body, 1)[0]
+                self.stats.record(name, "STATE_CHANGED", "activation_lag", timestamp - activation)
+                with self.lock:
+                    if self.backends[index]["activation"] == activation:
+                        self.backends[index]["activation"] = None
+                    self.changed.notify_all()
+            self.notify("state_changed", index, bool(body[0]))
+
+    def on_connection(self, index, connected):
+        backend = self.backends[index]
+        with self.lock:
+            backend["connected"] = connected
+            # If any server is reconnecting during start stage, change to start state
+            lost = not connected and self.is_toggle_on
+            if lost:
+                self.set_controls(False, False)
+            self.changed.notify_all()
+        self.notify("connection_changed", index, connected)
+        if lost:
+            self.notify("connection_lost")
+            # Send ERROR message to any connected backends, off the listener thread
+            self.pool.executor.submit(self.send_error)
+
+    def wait_connected(self, timeout=None):
+        # Waits until every backend's subscription has connected or failed at least once
+        with self.changed:
+            return self.changed.wait_for(lambda: all(b["connected"] is not None for b in self.backends), timeout)
+
+    def wait_activation(self):
+        # Until every backend that took the last synchronized START/END has confirmed it, or the deadline
+        # after its time; returns the names of backends that have not
+        if self.activation_ns is None:
+            return []
+        timeout = max(0, self.activation_ns - time.time_ns()) / 1e9 + self.deadline
+        with self.changed:
+            self.changed.wait_for(lambda: all(b["activation"] is None for b in self.backends), timeout)
+            return [b["name"] for b in self.backends if b["activation"] is not None]
+
+    def wait_ready(self, timeout=None):
+        with self.changed:
+            return self.changed.wait_for(lambda: all(b["ready"] for b in self.backends), timeout)
+
+    def status(self):
+        return [{"name": b["name"], "host": b["host"], "ports": b["ports"], "connected": b["connected"],
+                 "health": b["health"].state, "retry_in": round(b["health"].retry_in(), 1),
+                 "clock_offset": b["clock_offset"], "clock_delay": b["clock_delay"],
+                 "started": b["started"], "ready": b["ready"]} for b in self.backends]
+
+COMMANDS = ("start", "end", "toggle", "event", "error", "data", "wait-ready", "status", "clock")
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Headless controller for backend processes")
+    parser.add_argument("commands", nargs="+", choices=COMMANDS, metavar="COMMAND",
+                        help=f"run in order: {', '.join(COMMANDS)}")
+    parser.add_argument("--backends", metavar="PATH", help="backend registry JSON (default: two local backends)")
+    parser.add_argument("--deadline", type=float, default=1.0, help="overall send deadline in seconds")
+    parser.add_argument("--timeout", type=float, default=60.0, help="wait-ready timeout in seconds")
+    parser.add_argument("--data", metavar="PATH", help="file sent by the data command")
+    parser.add_argument("--compress", action="store_true", help="zlib-compress the data command's payload")
+    parser.add_argument("--sync", action="store_true",
+                        help="START/END take effect on every backend at the same time, --start-lead from now")
+    parser.add_argument("--start-lead", type=float, metavar="SECONDS", help="default: --deadline")
+    args = parser.parse_args()
+    if "data" in args.commands and args.data is None:
+        parser.error("the data command needs --data PATH")
+
+    core = ControllerCore(load_backends(args.backends), deadline=args.deadline, synchronized=args.sync,
+                          start_lead=args.start_lead)
+    core.start()
+    ok = True
+    try:
+        for command in args.commands:
+            if command == "status":
+                core.wait_connected(core.listener.connect_timeout * 2)
+                print(json.dumps(core.status()))
+                continue
+            if command == "clock":
+                failed_backends = core.measure_clocks()
+                success = not failed_backends
+                for backend in core.backends:
+                    if backend["clock_offset"] is not None:
+                        print(f"{backend['name']}: offset {backend['clock_offset'] / 1e6:+.3f} ms, "
+                              f"round trip {backend['clock_delay'] / 1e6:.3f} ms")
+            elif command == "wait-ready":
+                success, failed_backends = core.wait_ready(args.timeout), []
+                if not success:
+                    failed_backends = [b["name"] for b in core.backends if not b["ready"]]
+            elif command == "error":
+                failed_backends = core.send_error()
+                success = not failed_backends
+            elif command == "data":
+                success, failed_backends = core.send_data(args.data, args.compress)
+            else:
+                action = {"start": core.start_capture, "end": core.end_capture,
+                          "toggle": core.toggle, "event": core.send_event}[command]
+                success, failed_backends = action()
+                if success and command != "event":
+                    failed_backends = core.wait_activation()
+                    success = not failed_backends
+            print(f"{command}: {'ok' if success else 'failed'}"
+                  + (f" ({', '.join(failed_backends)})" if failed_backends else ""))
+            ok = ok and success
+    finally:
+        core.stop()
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import threading
+
+class DedupWindow:
+    # Receiver side: highest sequence number seen plus a bitmask of the ones just below it,
+    # so a retransmitted frame is recognised even if newer frames arrived in between
+    __slots__ = ("size", "highest", "mask")
+
+    def __init__(self, size=64):
+        self.size = size
+        self.highest = 0
+        self.mask = 0  # Bit n set = highest - n was seen
+
+    def accept(self, sequence_number):
+        # True the first time a sequence number is seen, False for duplicates
+        if sequence_number > self.highest:
+            shift = sequence_number - self.highest
+            self.mask = ((self.mask << shift) | 1) & ((1 << self.size) - 1) if shift < self.size else 1
+            self.highest = sequence_number
+            return True
+        offset = self.highest - sequence_number
+        if offset >= self.size:
+            return False  # Too old to tell apart, treated as a duplicate
+        bit = 1 << offset
+        if self.mask & bit:
+            return False
+        self.mask |= bit
+        return True
+
+    def reset(self):
+        self.highest = 0
+        self.mask = 0
+
+class RetransmitWindow:
+    # Sender side: frames waiting for an ACK, resent with exponential backoff from a TimerWheel.
+    # resend(frame) is called on the wheel thread and should not block.
+    def __init__(self, timers, resend, capacity=64, initial_rto=0.5, max_rto=8.0, max_attempts=8, log=None):
+        self.timers = timers
+        self.resend = resend
+        self.capacity = capacity
+        self.initial_rto = initial_rto
+        self.max_rto = max_rto
+        self.max_attempts = max_attempts
+        self.log = log
+        self.pending = {}  # sequence number -> [frame, timer, rto, attempts]
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, sequence_number, frame):
+        # Returns False when the window is full; the caller sends the frame without retransmission
+        with self.lock:
+            if len(self.pending) >= self.capacity:
+                return False
+            timer = self.timers.timer(self.expire, sequence_number)
+            self.pending[sequence_number] = [frame, timer, self.initial_rto, 1]
+        self.timers.reschedule(timer, self.initial_rto)
+        return True
+
+    def frames(self):
+        with self.lock:
+            return [entry[0] for entry in self.pending.values()]
+
+    def ack(self, sequence_number):
+        with self.lock:
+            entry = self.pending.pop(sequence_number, None)
+        if entry is None:
+            return False  # Duplicate ACK or a frame that was never tracked
+        self.timers.cancel(entry[1])
+        return True
+
+    def expire(self, sequence_number):
+        with self.lock:
+            entry = self.pending.get(sequence_number)
+            if entry is None:
+                return
+            if entry[3] >= self.max_attempts:
+                del self.pending[sequence_number]
+                gave_up = True
+            else:
+                gave_up = False
+                entry[2] = min(entry[2] * 2, self.max_rto)
+                entry[3] += 1
+        if gave_up:
+            if self.log is not None:
+                self.log.warning("No ACK for #%s after %s attempts, giving up", sequence_number, entry[3])
+            return
+        self.resend(entry[0])
+        self.timers.reschedule(entry[1], entry[2])
+
+    def clear(self):
+        with self.lock:
+            entries = list(self.pending.values())
+            self.pending.clear()
+        for entry in entries:
+            self.timers.cancel(entry[1])
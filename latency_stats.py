@@ -0,0 +1,158 @@
+import array
+import threading
+import time
+
+class LatencyHistogram:
+    # Log-linear (HDR-style) buckets over nanoseconds: fixed memory, ~1% relative precision
+    __slots__ = ("precision_bits", "half", "counts", "count", "total", "min", "max")
+
+    def __init__(self, precision_bits=7, max_value=1 << 42):
+        self.precision_bits = precision_bits
+        self.half = 1 << (precision_bits - 1)
+        self.counts = array.array("Q", bytes(8 * (self.index_of(max_value) + 1)))
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def index_of(self, value):
+        shift = value.bit_length() - self.precision_bits
+        if shift <= 0:
+            return value
+        return shift * self.half + (value >> shift)
+
+    def value_at(self, index):
+        # Midpoint of the bucket's value range
+        if index < 2 * self.half:
+            return index
+        shift = index // self.half - 1
+        return ((index - shift * self.half) << shift) + (1 << (shift - 1))
+
+    def record(self, value):
+        value = max(0, int(value))
+        index = min(self.index_of(value), len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, bucket_count in enumerate(other.counts):
+            self.counts[index] += bucket_count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        if not self.count:
+            return 0
+        target = max(1, int(self.count * q / 100.0 + 0.5))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= target:
+                return min(self.value_at(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "min": self.min or 0,
+            "mean": self.total // self.count if self.count else 0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "p999": self.percentile(99.9),
+            "max": self.max,
+        }
+
+class SequenceTracker:
+    # Counts gaps (skipped sequence numbers) and reorders/duplicates for one stream
+    __slots__ = ("expected", "gaps", "reorders")
+
+    def __init__(self):
+        self.expected = None
+        self.gaps = 0
+        self.reorders = 0
+
+    def observe(self, sequence_number):
+        # Sequence 1 starts a new stream (new session or restarted peer)
+        if self.expected is not None and sequence_number != 1:
+            if sequence_number > self.expected:
+                self.gaps += sequence_number - self.expected
+            elif sequence_number < self.expected:
+                self.reorders += 1
+                return
+        self.expected = sequence_number + 1
+
+class LatencyStats:
+    # Histograms keyed by (peer, message name, kind), e.g. ("Backend 1", "START", "one_way")
+    def __init__(self):
+        self.histograms = {}
+        self.sequences = {}
+        self.lock = threading.Lock()
+        self.dump_thread = None
+        self.dump_stop = threading.Event()
+
+    def record(self, peer, message, kind, latency_ns):
+        key = (peer, message, kind)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+            histogram.record(latency_ns)
+
+    def record_one_way(self, peer, message, sent_timestamp_ns, received_timestamp_ns=None):
+        # Cross-host values are only as good as clock sync; negative results are clamped to 0
+        if received_timestamp_ns is None:
+            received_timestamp_ns = time.time_ns()
+        self.record(peer, message, "one_way", received_timestamp_ns - sent_timestamp_ns)
+
+    def observe_sequence(self, peer, sequence_number):
+        with self.lock:
+            tracker = self.sequences.get(peer)
+            if tracker is None:
+                tracker = self.sequences[peer] = SequenceTracker()
+            tracker.observe(sequence_number)
+
+    def snapshot(self):
+        # Query API: {"latency": {(peer, message, kind): summary}, "sequence": {peer: {...}}}
+        with self.lock:
+            return {
+                "latency": {key: histogram.summary() for key, histogram in self.histograms.items()},
+                "sequence": {peer: {"gaps": tracker.gaps, "reorders": tracker.reorders}
+                             for peer, tracker in self.sequences.items()},
+            }
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.sequences.clear()
+
+    def format_report(self):
+        snapshot = self.snapshot()
+        lines = []
+        for (peer, message, kind), summary in sorted(snapshot["latency"].items()):
+            lines.append(f"{peer} {message} {kind}: n={summary['count']} "
+                         f"p50={summary['p50'] / 1e6:.3f}ms p99={summary['p99'] / 1e6:.3f}ms "
+                         f"p999={summary['p999'] / 1e6:.3f}ms max={summary['max'] / 1e6:.3f}ms")
+        for peer, counts in sorted(snapshot["sequence"].items()):
+            lines.append(f"{peer} sequence: gaps={counts['gaps']} reorders={counts['reorders']}")
+        return lines
+
+    def start_periodic_dump(self, interval, write=print, reports=()):
+        # reports: more format_report-style callables whose lines follow these
+        def run():
+            while not self.dump_stop.wait(interval):
+                for report in (self.format_report, *reports):
+                    for line in report():
+                        write(line)
+        self.dump_thread = threading.Thread(target=run, name="latency-dump", daemon=True)
+        self.dump_thread.start()
+
+    def stop_periodic_dump(self):
+        self.dump_stop.set()
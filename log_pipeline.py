@@ -0,0 +1,159 @@
+import atexit
+import collections
+import re
+import struct
+import sys
+import threading
+import time
+from datetime import datetime
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+
+# Binary log records: a format string is defined once, then referenced by id
+FORMAT_RECORD = struct.Struct("<BHI")  # kind 0, format id, format length
+LOG_RECORD = struct.Struct("<BQBHBI")  # kind 1, timestamp ns, level, format id, arg count, args length
+ARG_SEPARATOR = "\x1f"
+CONVERSION = re.compile(r"%[#0 +-]*(?:\d+)?(?:\.\d+)?[hlL]?([a-zA-Z%])")
+
+def format_time(timestamp_ns):
+    return datetime.fromtimestamp(timestamp_ns / 1e9).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+def text_format(fmt):
+    # Binary records keep their args as text: the format is stored with every conversion turned into %s,
+    # and each arg is rendered by its own conversion ("%.3f", "%d") when it is written
+    conversions = [match.group(0) for match in CONVERSION.finditer(fmt) if match.group(1) != "%"]
+    return CONVERSION.sub(lambda match: match.group(0) if match.group(1) == "%" else "%s", fmt), conversions
+
+def format_record(timestamp_ns, fmt, args):
+    message = fmt % args if args else fmt
+    return f"[{format_time(timestamp_ns)}] {message}"
+
+class LogPipeline:
+    # Callers only append (timestamp, level, format, args) to a bounded ring buffer;
+    # formatting and I/O happen on a background writer thread.
+    def __init__(self, level=INFO, capacity=65536, sample_rate=1, console=True, binary_path=None,
+                 flush_interval=0.05):
+        self.level = level
+        self.capacity = capacity
+        self.sample_rate = sample_rate  # Keep 1 of every N records below WARNING, per format string
+        self.sample_counts = collections.Counter()
+        self.console = console
+        self.buffer = collections.deque(maxlen=capacity)
+        self.dropped = 0
+        self.flush_interval = flush_interval
+        self.binary_file = open(binary_path, "ab") if binary_path else None
+        self.format_ids = {}
+        self.stopped = threading.Event()
+        self.flushed = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def log(self, level, fmt, *args):
+        if level < self.level:
+            return
+        if self.sample_rate > 1 and level < WARNING:
+            count = self.sample_counts[fmt]
+            self.sample_counts[fmt] = count + 1
+            if count % self.sample_rate:
+                return
+        if len(self.buffer) >= self.capacity:
+            self.dropped += 1  # Oldest record is overwritten
+        self.buffer.append((time.time_ns(), level, fmt, args))
+
+    def debug(self, fmt, *args):
+        self.log(DEBUG, fmt, *args)
+
+    def info(self, fmt, *args):
+        self.log(INFO, fmt, *args)
+
+    def warning(self, fmt, *args):
+        self.log(WARNING, fmt, *args)
+
+    def error(self, fmt, *args):
+        self.log(ERROR, fmt, *args)
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.drain()
+        self.drain()
+
+    def drain(self):
+        lines = []
+        while self.buffer:
+            timestamp_ns, level, fmt, args = self.buffer.popleft()
+            if self.console:
+                lines.append(format_record(timestamp_ns, fmt, args))
+            if self.binary_file is not None:
+                self.write_binary(timestamp_ns, level, fmt, args)
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            lines.append(f"[{format_time(time.time_ns())}] Log buffer full, dropped {dropped} record(s)")
+        if lines:
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
+        if self.binary_file is not None:
+            self.binary_file.flush()
+        with self.flushed:
+            self.flushed.notify_all()
+
+    def write_binary(self, timestamp_ns, level, fmt, args):
+        entry = self.format_ids.get(fmt)
+        if entry is None:
+            stored, conversions = text_format(fmt)
+            entry = self.format_ids[fmt] = len(self.format_ids), conversions
+            encoded = stored.encode()
+            self.binary_file.write(FORMAT_RECORD.pack(0, entry[0], len(encoded)) + encoded)
+        format_id, conversions = entry
+        if len(conversions) != len(args):
+            conversions = ["%s"] * len(args)  # Does not match the format; the reader shows the args as they are
+        encoded = ARG_SEPARATOR.join(conversion % (arg,) for conversion, arg in zip(conversions, args)).encode()
+        self.binary_file.write(LOG_RECORD.pack(1, timestamp_ns, level, format_id, len(args), len(encoded)) + encoded)
+
+    def flush(self, timeout=1.0):
+        # Wait for the writer to catch up, e.g. before an interactive prompt
+        with self.flushed:
+            self.flushed.wait(timeout)
+
+    def close(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.thread.join()
+        if self.binary_file is not None:
+            self.binary_file.close()
+
+def read_binary_log(path):
+    # Yields (timestamp_ns, level, formatted message) from a binary log
+    formats = {}
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset < len(data):
+        if data[offset] == 0:
+            _, format_id, length = FORMAT_RECORD.unpack_from(data, offset)
+            offset += FORMAT_RECORD.size
+            formats[format_id] = data[offset:offset + length].decode()
+        else:
+            _, timestamp_ns, level, format_id, arg_count, length = LOG_RECORD.unpack_from(data, offset)
+            offset += LOG_RECORD.size
+            fmt = formats[format_id]
+            args = tuple(data[offset:offset + length].decode().split(ARG_SEPARATOR)) if arg_count else ()
+            try:
+                message = fmt % args if args else fmt
+            except (TypeError, ValueError):
+                message = f"{fmt} {args}"  # Written before formats were stored as text, or args did not match
+            yield timestamp_ns, level, message
+        offset += length
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python log_pipeline.py <binary_log>")
+        sys.exit(1)
+    for timestamp_ns, level, message in read_binary_log(sys.argv[1]):
+        print(f"[{format_time(timestamp_ns)}] {LEVEL_NAMES.get(level, level)} {message}")
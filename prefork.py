@@ -0,0 +1,182 @@
+import array
+import json
+import os
+import signal
+import socket
+import subprocess
+import time
+import zlib
+from tcp_common import HEADER_SIZE, HEADER_STRUCT
+from transports import unix_path
+
+HELLO_TIMEOUT = 0.5  # How long a new connection gets to send HELLO before it is routed by address
+
+def owner_of(controller_id, count):
+    # Stable across processes, unlike hash()
+    return zlib.crc32(controller_id.encode()) % count
+
+def handoff_path(port, index, socket_dir=None):
+    return unix_path(f"worker{index}", port, socket_dir)
+
+def state_path(port, index, socket_dir=None):
+    return unix_path(f"worker{index}.state", port, socket_dir)
+
+class WorkerRouter:
+    # One per worker process. Every session lives in the worker that owns its controller id, so a
+    # connection accepted by another worker is passed over (file descriptor and all) to the owner.
+    def __init__(self, index, count, port, socket_dir=None, handoff_timeout=5.0):
+        self.index = index
+        self.count = count
+        self.handoff_timeout = handoff_timeout  # Covers the owner being restarted
+        self.paths = [handoff_path(port, i, socket_dir) for i in range(count)]
+        self.sock = None
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def start(self):
+        # Binding the handoff socket also tells the supervisor this worker is up
+        path = self.paths[self.index]
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+
+    def stop(self):
+        # Handoffs to this index wait for the next worker to bind; sending still works
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.paths[self.index])
+            except FileNotFoundError:
+                pass
+
+    def owner(self, controller_id):
+        return owner_of(controller_id, self.count)
+
+    def hand_off(self, index, connection, socket_index, addr, controller_id, pending=None):
+        # pending is a frame already read from the connection that the owner still has to process.
+        # Returns False if the owner could not be reached within handoff_timeout.
+        info = {"socket_index": socket_index, "addr": list(addr), "controller_id": controller_id, "pending": None}
+        if pending is not None:
+            timestamp, message_type, sequence_number, body = pending
+            info["pending"] = (HEADER_STRUCT.pack(timestamp, message_type, sequence_number, len(body))
+                               + bytes(body)).hex()
+        payload = json.dumps(info).encode()
+        deadline = time.monotonic() + self.handoff_timeout
+        while True:
+            try:
+                # Not socket.send_fds, which drops its address argument
+                self.sender.sendmsg([payload], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                                 array.array("i", [connection.fileno()]))], 0, self.paths[index])
+                return True
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(0.05)
+
+    def receive(self):
+        # Returns (socket, socket_index, addr, controller_id, pending frame) for one handed-over connection
+        while True:
+            data, fds, _, _ = socket.recv_fds(self.sock, 65536, 1)
+            if fds:
+                break
+        info = json.loads(data)
+        pending = None
+        if info["pending"] is not None:
+            frame = bytes.fromhex(info["pending"])
+            pending = HEADER_STRUCT.unpack_from(frame)[:3] + (memoryview(frame)[HEADER_SIZE:],)
+        return (socket.socket(fileno=fds[0]), info["socket_index"], tuple(info["addr"]), info["controller_id"],
+                pending)
+
+class Supervisor:
+    # Starts the worker processes, restarts any that exit and, on SIGHUP, replaces them one at a time
+    # so the ports never stop accepting. SIGTERM or Ctrl-C stops all workers.
+    # A worker sent SIGHUP hands its sessions and connections to the replacement started with takeover set.
+    def __init__(self, count, worker_command, ready_path, state_path, log):
+        self.count = count
+        self.worker_command = worker_command  # (index, takeover) -> argv of a worker process
+        self.ready_path = ready_path  # index -> path that exists once the worker is serving
+        self.state_path = state_path  # index -> where a stopping worker saves its sessions
+        self.log = log
+        self.processes = [None] * count
+        self.started_at = [0.0] * count
+        self.stopping = False
+        self.restart_requested = False
+
+    def start_worker(self, index, takeover=False):
+        path = self.ready_path(index)
+        if not takeover and os.path.exists(path):
+            os.unlink(path)  # Left behind by a worker that crashed
+        self.processes[index] = subprocess.Popen(self.worker_command(index, takeover))
+        self.started_at[index] = time.monotonic()
+
+    def wait_ready(self, index, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while not os.path.exists(self.ready_path(index)):
+            if self.processes[index].poll() is not None or time.monotonic() >= deadline:
+                return False
+            time.sleep(0.02)
+        return True
+
+    def stop_worker(self, index, process=None, sig=signal.SIGTERM, timeout=5.0):
+        process = process or self.processes[index]
+        if process is None or process.poll() is not None:
+            return
+        process.send_signal(sig)
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.log.warning("Worker %s did not stop within %s s, killing it", index, timeout)
+            process.kill()
+            process.wait()
+
+    def rolling_restart(self):
+        for index in range(self.count):
+            old = self.processes[index]
+            if old.poll() is not None:
+                continue  # Restarted by the run loop
+            # The old worker exits once the new one has taken its connections
+            self.start_worker(index, takeover=True)
+            self.stop_worker(index, old, signal.SIGHUP, timeout=10.0)
+            if not self.wait_ready(index):
+                self.log.error("Worker %s did not come back up", index)
+        self.log.info("Rolling restart of %s workers finished", self.count)
+
+    def remove_state(self):
+        # Sessions are only carried over within one supervisor's lifetime
+        for index in range(self.count):
+            try:
+                os.unlink(self.state_path(index))
+            except FileNotFoundError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda *args: setattr(self, "restart_requested", True))
+        signal.signal(signal.SIGTERM, lambda *args: setattr(self, "stopping", True))
+        self.remove_state()
+        for index in range(self.count):
+            self.start_worker(index)
+        for index in range(self.count):
+            self.wait_ready(index)
+        self.log.info("%s workers serving (supervisor pid %s, SIGHUP restarts them one at a time)",
+                      self.count, os.getpid())
+        try:
+            while not self.stopping:
+                time.sleep(0.2)
+                if self.restart_requested:
+                    self.restart_requested = False
+                    self.rolling_restart()
+                for index, process in enumerate(self.processes):
+                    code = process.poll()
+                    if code is None:
+                        continue
+                    self.log.warning("Worker %s exited with code %s, restarting", index, code)
+                    if time.monotonic() - self.started_at[index] < 1.0:
+                        time.sleep(1.0)  # Do not spin on a worker that fails at startup
+                    self.start_worker(index)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for index in range(self.count):
+                self.stop_worker(index)
+            self.remove_state()
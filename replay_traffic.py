@@ -0,0 +1,179 @@
+import argparse
+import heapq
+import sys
+import threading
+import time
+from latency_stats import LatencyHistogram
+from tcp_common import MessageType, MESSAGE_NAMES, FrameReader, ProtocolError, encode_frame
+from traffic_log import TO_BACKEND, TrafficLog, parse_time
+from transports import TRANSPORTS, connect
+
+class ReplayConnection:
+    # One recorded controller connection, re-created against the target backend. A reader thread
+    # counts ACKs and acknowledges the backend's pushes, as the controller would have.
+    def __init__(self, replayer, backend, controller_id, port_index, timeout):
+        self.replayer = replayer
+        self.port_index = port_index
+        self.sock = connect(backend, port_index, timeout)
+        self.sock.settimeout(None)
+        self.send_lock = threading.Lock()
+        self.sent_at = {}  # sequence number -> perf_counter_ns of the last send, until its ACK
+        self.send(encode_frame(MessageType.HELLO, controller_id.encode()))
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.thread.start()
+
+    def send(self, frame, sequence_number=0):
+        with self.send_lock:
+            if sequence_number:
+                self.sent_at[sequence_number] = time.perf_counter_ns()
+            self.sock.sendall(frame)
+
+    def read(self):
+        reader = FrameReader(self.sock)
+        try:
+            while True:
+                frame = reader.read_frame()
+                if frame is None:
+                    return
+                _, message_type, sequence_number, _ = frame
+                if message_type == MessageType.ACK:
+                    with self.send_lock:
+                        sent_at = self.sent_at.pop(sequence_number, None)
+                    self.replayer.acked(sent_at)
+                else:
+                    self.replayer.pushed(message_type)
+                    if sequence_number:
+                        self.send(encode_frame(MessageType.ACK, sequence_number=sequence_number))
+        except (OSError, ProtocolError):
+            pass
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class Replayer:
+    # Re-sends the frames controllers sent in a capture to a live backend, on the capture's schedule scaled
+    # by speed (2.0 = twice as fast, 0 = as fast as possible). Recorded HELLOs and ACKs are not replayed:
+    # each connection identifies itself when it is opened and acknowledges the pushes it actually gets.
+    # Sequence numbers are kept, so retransmissions in the capture are duplicates for the backend too.
+    def __init__(self, backend, speed=1.0, tag="", timeout=1.0):
+        self.backend = backend  # Registry-style entry: host, ports and transport
+        self.speed = speed
+        self.tag = tag  # Appended to controller ids, so a capture can be replayed twice against one backend
+        self.timeout = timeout
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.acks = 0
+        self.pushes = {}
+        self.lag = LatencyHistogram()  # How far behind the capture's schedule each frame went out
+        self.ack_latency = LatencyHistogram()
+
+    def acked(self, sent_at):
+        with self.lock:
+            self.acks += 1
+            if sent_at is not None:
+                self.ack_latency.record(time.perf_counter_ns() - sent_at)
+
+    def pushed(self, message_type):
+        name = MESSAGE_NAMES.get(message_type, str(message_type))
+        with self.lock:
+            self.pushes[name] = self.pushes.get(name, 0) + 1
+
+    def connection(self, controller_id, port_index):
+        key = (controller_id, port_index)
+        connection = self.connections.get(key)
+        if connection is None:
+            connection = self.connections[key] = ReplayConnection(self, self.backend, controller_id + self.tag,
+                                                                  port_index, self.timeout)
+        return connection
+
+    def run(self, records):
+        first_ns = None
+        start = time.perf_counter_ns()
+        sequenced = 0
+        for capture_ns, port_index, direction, peer, _, message_type, sequence_number, body in records:
+            if direction != TO_BACKEND:
+                continue
+            if message_type in (MessageType.HELLO, MessageType.ACK):
+                # Not replayed, but a subscription may carry nothing else: open the connection here
+                if message_type == MessageType.HELLO:
+                    peer = bytes(body).decode()
+                if (peer, port_index) not in self.connections:
+                    try:
+                        self.connection(peer, port_index)
+                    except OSError as e:
+                        print(f"Replay to {peer} port {port_index} failed: {e}")
+                continue
+            if first_ns is None:
+                first_ns = capture_ns
+            if self.speed:
+                due = start + (capture_ns - first_ns) / self.speed
+                delay = due - time.perf_counter_ns()
+                if delay > 0:
+                    time.sleep(delay / 1e9)
+                self.lag.record(time.perf_counter_ns() - due)
+            try:
+                connection = self.connection(peer, port_index)
+                connection.send(encode_frame(message_type, bytes(body), sequence_number), sequence_number)
+            except OSError as e:
+                print(f"Replay to {peer} port {port_index} failed: {e}")
+                self.connections.pop((peer, port_index), None)
+                continue
+            self.sent += 1
+            sequenced += bool(sequence_number)
+        # Give the last frames time to be acknowledged
+        deadline = time.monotonic() + self.timeout
+        while self.acks < sequenced and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return (time.perf_counter_ns() - start) / 1e9
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a traffic capture against a backend")
+    parser.add_argument("ports", type=int, nargs=2, help="target backend's first and second port")
+    parser.add_argument("captures", nargs="+", metavar="CAPTURE",
+                        help="file written by backend_process.py --record; the files of prefork workers are merged")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--transport", choices=TRANSPORTS, default="tcp")
+    parser.add_argument("--socket-dir", metavar="DIR")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="1 = real time, N = N times faster, 0 = as fast as possible")
+    parser.add_argument("--start", help="'+SECONDS' after the first record or 'YYYY-MM-DD HH:MM:SS[.fff]'")
+    parser.add_argument("--end", help="same formats as --start")
+    parser.add_argument("--tag", default="", help="suffix for the replayed controller ids")
+    args = parser.parse_args()
+
+    logs = [TrafficLog(path) for path in args.captures]
+    first_times = [t for t in (log.first_time() for log in logs) if t is not None]
+    if not first_times:
+        print("Empty capture")
+        sys.exit(0)
+    start_ns, end_ns = parse_time(args.start, min(first_times)), parse_time(args.end, min(first_times))
+    backend = {"host": args.host, "ports": args.ports, "transport": args.transport, "socket_dir": args.socket_dir}
+    replayer = Replayer(backend, speed=args.speed, tag=args.tag)
+    try:
+        elapsed = replayer.run(heapq.merge(*(log.records(start_ns, end_ns) for log in logs),
+                                           key=lambda record: record[0]))
+    except KeyboardInterrupt:
+        elapsed = None
+    finally:
+        replayer.close()
+        for log in logs:
+            log.close()
+    print(f"Replayed {replayer.sent} frames over {len(replayer.connections)} connections"
+          + (f" in {elapsed:.3f} s ({replayer.sent / elapsed:.0f} frames/s)" if elapsed else ""))
+    print(f"  ACKs={replayer.acks} pushes={replayer.pushes}")
+    for name, histogram in (("schedule lag", replayer.lag), ("ACK latency", replayer.ack_latency)):
+        if histogram.count:
+            summary = histogram.summary()
+            print(f"  {name:<12} p50={summary['p50'] / 1e3:.0f}us p99={summary['p99'] / 1e3:.0f}us "
+                  f"max={summary['max'] / 1e3:.0f}us")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import threading
+import time
+from delivery import DedupWindow, RetransmitWindow
+
+class Session:
+    # One record per controller; __slots__ keeps thousands of them small
+    __slots__ = ("controller_id", "is_started", "event_timer", "ready_pending", "subscribers", "last_seen",
+                 "push_sequence", "received", "unacked", "activations")
+
+    def __init__(self, controller_id, event_timer):
+        self.controller_id = controller_id
+        self.is_started = False
+        self.event_timer = event_timer
+        self.ready_pending = False  # READY waiting for this controller to subscribe
+        self.subscribers = {}  # This controller's connections on the first port, with what writes to each
+        self.last_seen = time.monotonic()
+        self.push_sequence = 0  # Sequence number of the last frame pushed to this controller
+        self.received = DedupWindow()  # Command sequence numbers already processed
+        self.unacked = None  # Pushed frames waiting for the controller's ACK
+        self.activations = []  # (started, time_ns) of each START/END scheduled for later, in time order
+
+class SessionManager:
+    # Sessions keyed by controller identity, each with its own state, event timer and READY target
+    def __init__(self, timers, ready_callback, resend_callback, idle_timeout=300.0, log=None):
+        self.timers = timers
+        self.log = log
+        self.ready_callback = ready_callback  # Called with the session when its event timer fires
+        self.resend_callback = resend_callback  # Called with the session and a frame to retransmit
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.eviction_timer = timers.timer(self.evict_idle)
+        timers.reschedule(self.eviction_timer, idle_timeout / 4)
+
+    def get(self, controller_id):
+        with self.lock:
+            session = self.sessions.get(controller_id)
+            if session is None:
+                session = Session(controller_id, None)
+                session.event_timer = self.timers.timer(self.ready_callback, session)
+                session.unacked = RetransmitWindow(self.timers, lambda frame, s=session: self.resend_callback(s, frame),
+                                                   log=self.log)
+                self.sessions[controller_id] = session
+            session.last_seen = time.monotonic()
+            return session
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def export_state(self):
+        # Plain data a replacement process can pick the sessions up from; connections are not included
+        with self.lock:
+            return [{"controller_id": session.controller_id, "is_started": session.is_started,
+                     "ready_pending": session.ready_pending, "push_sequence": session.push_sequence,
+                     "event_remaining": self.timers.remaining(session.event_timer),
+                     "received": [session.received.highest, session.received.mask],
+                     "activations": [list(pending) for pending in session.activations]}
+                    for session in self.sessions.values()]
+
+    def import_state(self, entries):
+        for entry in entries:
+            session = self.get(entry["controller_id"])
+            session.is_started = entry["is_started"]
+            session.ready_pending = entry["ready_pending"]
+            session.push_sequence = entry["push_sequence"]
+            session.received.highest, session.received.mask = entry["received"]
+            if entry["event_remaining"] is not None:
+                self.timers.reschedule(session.event_timer, entry["event_remaining"])
+
+    def evict_idle(self):
+        # Sessions with no subscription and no traffic for idle_timeout are dropped
+        cutoff = time.monotonic() - self.idle_timeout
+        with self.lock:
+            idle = [session for session in self.sessions.values()
+                    if not session.subscribers and session.last_seen < cutoff]
+            for session in idle:
+                self.timers.cancel(session.event_timer)
+                session.unacked.clear()
+                del self.sessions[session.controller_id]
+        if idle and self.log is not None:
+            self.log.info("Evicted %s idle session(s): %s", len(idle), ", ".join(s.controller_id for s in idle))
+        self.timers.reschedule(self.eviction_timer, self.idle_timeout / 4)
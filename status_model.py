@@ -0,0 +1,92 @@
+import time
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QTimer
+from PyQt5.QtGui import QBrush, QColor
+
+COLUMNS = ("Backend", "Host", "Status", "Capture", "Last seen", "Latency")
+SORT_ROLE = Qt.UserRole  # Raw values the proxy model sorts by, e.g. latency as a number
+
+# Status text and color, built once instead of a stylesheet per update (which re-polishes the widget)
+STATUSES = {
+    "not_connected": ("Not Connected", QBrush(QColor("red"))),
+    "connected": ("Connected", QBrush(QColor("green"))),
+    "reconnecting": ("Reconnecting...", QBrush(QColor("orange"))),
+    "unreachable": ("Unreachable", QBrush(QColor("red"))),
+}
+
+class BackendStatusModel(QAbstractTableModel):
+    # One row per backend. update() only records the change and marks the row dirty; a single-shot
+    # timer repaints the dirty rows at most max_rate times a second, so a burst of events from many
+    # backends costs one repaint and nothing is repainted while nothing changes.
+    def __init__(self, backends, max_rate=10, parent=None):
+        super().__init__(parent)
+        self.rows = [{"name": backend["name"], "host": backend["host"], "status": "not_connected",
+                      "started": False, "last_seen": None, "latency": None} for backend in backends]
+        self.dirty = set()
+        self.repaints = 0
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(int(1000 / max_rate))
+        self.timer.timeout.connect(self.flush)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return COLUMNS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        row = self.rows[index.row()]
+        column = COLUMNS[index.column()]
+        if role == Qt.DisplayRole:
+            if column == "Backend":
+                return row["name"]
+            if column == "Host":
+                return row["host"]
+            if column == "Status":
+                return STATUSES[row["status"]][0]
+            if column == "Capture":
+                return "Started" if row["started"] else "Not started"
+            if column == "Last seen":
+                return time.strftime("%H:%M:%S", time.localtime(row["last_seen"])) if row["last_seen"] else "-"
+            return f"{row['latency']:.1f} ms" if row["latency"] is not None else "-"
+        if role == Qt.ForegroundRole and column == "Status":
+            return STATUSES[row["status"]][1]
+        if role == SORT_ROLE:
+            if column == "Status":
+                return STATUSES[row["status"]][0]
+            if column == "Capture":
+                return int(row["started"])
+            if column == "Last seen":
+                return row["last_seen"] or 0.0
+            if column == "Latency":
+                return row["latency"] if row["latency"] is not None else float("inf")
+            if column == "Host":
+                return row["host"]
+            return row["name"]
+        return None
+
+    def update(self, index, **changes):
+        # Safe to call for every event; only real changes schedule a repaint
+        row = self.rows[index]
+        changed = False
+        for key, value in changes.items():
+            if row[key] != value:
+                row[key] = value
+                changed = True
+        if changed:
+            self.dirty.add(index)
+            if not self.timer.isActive():
+                self.timer.start()
+
+    def flush(self):
+        if not self.dirty:
+            return
+        first, last = min(self.dirty), max(self.dirty)
+        self.dirty.clear()
+        self.repaints += 1
+        self.dataChanged.emit(self.index(first, 0), self.index(last, len(COLUMNS) - 1))
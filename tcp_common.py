@@ -1,21 +1,331 @@
-import numpy as np
+import os
+import struct
+import tempfile
 import time
+import zlib
+from enum import IntEnum
 
-class ProtocolHeader:
-    def __init__(self):
-        self.header_type = np.dtype([
-            ('TimeStamp', np.uint64),
-            ('MessageType', np.uint8),
-            ('SequenceNumber', np.uint64),
-            ('BodyLength', np.uint32)
-        ])
+class MessageType(IntEnum):
+    START = 1  # Optional body: ACTIVATION_STRUCT, when to switch on the backend's clock; empty = now
+    END = 2  # Same optional body as START
+    EVENT = 3
+    ERROR = 4
+    CONNECTION_FAIL = 5
+    READY = 6
+    EVENT_RECEIVED = 7  # No longer sent: EVENT frames are acknowledged with ACK like every other command
+    STATE_CHANGED = 8  # Body is one byte: 1 = STARTED, 0 = NOT STARTED; then ACTIVATION_STRUCT if scheduled
+    HELLO = 9  # Body is the controller identity used to key backend sessions
+    ACK = 10  # SequenceNumber is the frame being acknowledged, sent back on the same connection
+    DATA = 11  # Body is a payload for the backend (configuration, calibration blob), usually streamed
+    CLOCK = 12  # Clock offset probe; answered with a CLOCK frame of the same number, body CLOCK_STRUCT
+
+MESSAGE_NAMES = {message_type.value: message_type.name for message_type in MessageType}
+
+# Wire layout of ProtocolHeader: packed, little-endian, 21 bytes
+HEADER_STRUCT = struct.Struct("<QBQI")
+HEADER_SIZE = HEADER_STRUCT.size
+ACTIVATION_STRUCT = struct.Struct("<Q")  # time.time_ns() on the receiving backend's clock
+CLOCK_STRUCT = struct.Struct("<QQ")  # Probe's TimeStamp echoed back, backend time it was received
+MAX_BODY_LENGTH = 64 * 1024  # Bodies up to this size are read whole into the connection's buffer
+CHUNK_SIZE = 64 * 1024  # Larger ones are streamed through buffers of this size
+MAX_STREAM_LENGTH = 1 << 30  # Limit on a streamed body after decompression
+# Set in the MessageType byte when the body is zlib-compressed; the sender decides per message
+COMPRESSED = 0x80
+COMPRESS_MIN_LENGTH = 1024  # Smaller bodies are sent as they are
+
+class ProtocolError(Exception):
+    pass
 
+class ProtocolHeader:
     def get_header_message(self, timestamp, message_type, sequence_number, body_length):
-        ret = np.array((timestamp, message_type, sequence_number, body_length), dtype=self.header_type)
-        return ret
-    
+        return self.pack(timestamp, message_type, sequence_number, body_length)
+
+    # One precompiled struct, no objects per message beyond the bytes
+    def pack(self, timestamp, message_type, sequence_number, body_length):
+        return HEADER_STRUCT.pack(timestamp, message_type, sequence_number, body_length)
+
+    def unpack(self, buffer, offset=0):
+        return HEADER_STRUCT.unpack_from(buffer, offset)
+
+def encode_frame(message_type, body=b"", sequence_number=0, timestamp=None, compress=False):
+    if compress and len(body) >= COMPRESS_MIN_LENGTH:
+        compressed = zlib.compress(body, 1)
+        if len(compressed) < len(body):
+            body, message_type = compressed, message_type | COMPRESSED
+    if timestamp is None:
+        timestamp = time.time_ns()
+    return HEADER_STRUCT.pack(timestamp, message_type, sequence_number, len(body)) + body
+
+class BodyStream:
+    # A body read from the connection in chunks instead of whole: larger than the connection's body
+    # buffer, or compressed. Read it with chunks() or copy_to() before the next frame; the connection
+    # skips whatever the handler leaves unread.
+    def __init__(self, read_exactly, length, compressed, buffer, max_length=MAX_STREAM_LENGTH, close=None):
+        self.read_exactly = read_exactly  # Fills a memoryview completely or returns False on a clean close
+        self.length = length  # Bytes on the wire
+        self.remaining = length
+        self.compressed = compressed
+        self.buffer = buffer  # Reusable memoryview the raw chunks are read into
+        self.max_length = max_length
+        self.on_close = close
+
+    def raw_chunks(self):
+        while self.remaining:
+            view = self.buffer[:min(len(self.buffer), self.remaining)]
+            if not self.read_exactly(view):
+                raise ProtocolError("Connection closed in the middle of a frame")
+            self.remaining -= len(view)
+            yield view
+        self.close()
+
+    def chunks(self):
+        # Yields the body as memoryviews, decompressed, each valid until the next one
+        if not self.compressed:
+            produced = 0
+            for view in self.raw_chunks():
+                produced += len(view)
+                if produced > self.max_length:
+                    raise ProtocolError(f"Body exceeds limit of {self.max_length} bytes")
+                yield view
+            return
+        decompressor = zlib.decompressobj()
+        produced = 0
+        for data in self.raw_chunks():
+            while True:
+                # Output is capped per call, so a small compressed chunk cannot inflate into a huge buffer
+                out = decompressor.decompress(data, len(self.buffer))
+                data = decompressor.unconsumed_tail
+                produced += len(out)
+                if produced > self.max_length:
+                    raise ProtocolError(f"Body exceeds limit of {self.max_length} bytes")
+                if out:
+                    yield memoryview(out)
+                if not data and len(out) < len(self.buffer):
+                    break
+        if not decompressor.eof:
+            raise ProtocolError("Compressed body is truncated")
+
+    def copy_to(self, file):
+        # Returns the number of (decompressed) bytes written
+        written = 0
+        for chunk in self.chunks():
+            file.write(chunk)
+            written += len(chunk)
+        return written
+
+    def read(self, limit=MAX_BODY_LENGTH):
+        # Whole body as bytes, for handlers that need it in one piece
+        data = bytearray()
+        for chunk in self.chunks():
+            if len(data) + len(chunk) > limit:
+                raise ProtocolError(f"Body exceeds limit of {limit} bytes")
+            data += chunk
+        return bytes(data)
+
+    def skip(self):
+        for _ in self.raw_chunks():
+            pass
+        self.close()
+
+    def close(self):
+        if self.on_close is not None:
+            self.on_close()
+            self.on_close = None
+
+def body_bytes(body, limit=MAX_BODY_LENGTH):
+    # Frame body as bytes, whether it was read whole or streamed
+    return body.read(limit) if isinstance(body, BodyStream) else bytes(body)
+
+def buffer_sizes(memory_cap, chunk_size=CHUNK_SIZE):
+    # Splits a connection's memory cap into (max_body_length, chunk_size): one buffer for whole bodies
+    # plus the raw and decompressed chunks of a streamed one. None keeps the defaults.
+    if memory_cap is None:
+        return MAX_BODY_LENGTH, chunk_size
+    chunk_size = min(chunk_size, memory_cap // 4)
+    return memory_cap - 2 * chunk_size, chunk_size
+
+class FrameReader:
+    # Reads one header, then exactly BodyLength bytes, into buffers allocated once per connection.
+    # Bodies larger than max_body_length, or compressed, are returned as a BodyStream instead, so a
+    # connection holds at most max_body_length + 2 * chunk_size bytes however large the body.
+    # memory_cap, if given, sets both from that total.
+    def __init__(self, sock, max_body_length=MAX_BODY_LENGTH, chunk_size=CHUNK_SIZE,
+                 max_stream_length=MAX_STREAM_LENGTH, memory_cap=None):
+        if memory_cap is not None:
+            max_body_length, chunk_size = buffer_sizes(memory_cap, chunk_size)
+        self.sock = sock
+        self.header = bytearray(HEADER_SIZE)
+        self.header_view = memoryview(self.header)
+        self.body = bytearray(max_body_length)
+        self.body_view = memoryview(self.body)
+        self.chunk_size = chunk_size
+        self.chunk_view = None  # Allocated with the first streamed body
+        self.max_stream_length = max_stream_length
+
+    def read_exactly(self, view):
+        received = 0
+        size = len(view)
+        while received < size:
+            n = self.sock.recv_into(view[received:])
+            if n == 0:
+                if received == 0:
+                    return False
+                raise ProtocolError("Connection closed in the middle of a frame")
+            received += n
+        return True
+
+    def read_frame(self):
+        # Returns (timestamp, message_type, sequence_number, body) or None on a clean close.
+        # body is a memoryview into the reusable buffer, valid until the next read_frame call,
+        # or a BodyStream that has to be read before then.
+        if not self.read_exactly(self.header_view):
+            return None
+        timestamp, message_type, sequence_number, body_length = HEADER_STRUCT.unpack_from(self.header)
+        compressed = bool(message_type & COMPRESSED)
+        message_type &= ~COMPRESSED
+        if compressed or body_length > len(self.body):
+            if body_length > self.max_stream_length:
+                raise ProtocolError(f"Body of {body_length} bytes exceeds limit of {self.max_stream_length} bytes")
+            if self.chunk_view is None:
+                self.chunk_view = memoryview(bytearray(self.chunk_size))
+            return timestamp, message_type, sequence_number, BodyStream(
+                self.read_exactly, body_length, compressed, self.chunk_view, self.max_stream_length)
+        body = self.body_view[:body_length]
+        if body_length and not self.read_exactly(body):
+            raise ProtocolError("Connection closed in the middle of a frame")
+        return timestamp, message_type, sequence_number, body
+
+async def read_frame_async(reader, max_body_length=MAX_BODY_LENGTH, chunk_size=CHUNK_SIZE,
+                           max_stream_length=MAX_STREAM_LENGTH):
+    # asyncio counterpart of FrameReader.read_frame. A body that would be streamed there is
+    # spooled to a temporary file in chunks first, since handlers read it synchronously.
+    try:
+        header = await reader.readexactly(HEADER_SIZE)
+    except EOFError as e:
+        if e.partial:
+            raise ProtocolError("Connection closed in the middle of a frame")
+        return None
+    timestamp, message_type, sequence_number, body_length = HEADER_STRUCT.unpack(header)
+    compressed = bool(message_type & COMPRESSED)
+    message_type &= ~COMPRESSED
+    if compressed or body_length > max_body_length:
+        if body_length > max_stream_length:
+            raise ProtocolError(f"Body of {body_length} bytes exceeds limit of {max_stream_length} bytes")
+        spool = tempfile.TemporaryFile()
+        try:
+            remaining = body_length
+            while remaining:
+                chunk = await reader.readexactly(min(chunk_size, remaining))
+                spool.write(chunk)
+                remaining -= len(chunk)
+            spool.seek(0)
+        except BaseException:
+            spool.close()
+            raise
+        read_exactly = lambda view: spool.readinto(view) == len(view)
+        return timestamp, message_type, sequence_number, BodyStream(
+            read_exactly, body_length, compressed, memoryview(bytearray(chunk_size)), max_stream_length,
+            close=spool.close)
+    body = await reader.readexactly(body_length) if body_length else b""
+    return timestamp, message_type, sequence_number, memoryview(body)
+
+async def read_frame_sock_async(loop, sock, max_body_length=MAX_BODY_LENGTH):
+    # Reads exactly one frame from a raw non-blocking socket, leaving anything after it unread
+    buffer = bytearray(HEADER_SIZE)
+    if not await _recv_exactly(loop, sock, memoryview(buffer)):
+        return None
+    timestamp, message_type, sequence_number, body_length = HEADER_STRUCT.unpack(buffer)
+    if body_length > max_body_length or message_type & COMPRESSED:
+        raise ProtocolError(f"Body of {body_length} bytes cannot be read here")
+    body = bytearray(body_length)
+    if body_length and not await _recv_exactly(loop, sock, memoryview(body)):
+        raise ProtocolError("Connection closed in the middle of a frame")
+    return timestamp, message_type, sequence_number, memoryview(body)
+
+async def _recv_exactly(loop, sock, view):
+    # False if the connection closed before the first byte
+    received = 0
+    while received < len(view):
+        size = await loop.sock_recv_into(sock, view[received:])
+        if not size:
+            if received:
+                raise ProtocolError("Connection closed in the middle of a frame")
+            return False
+        received += size
+    return True
+
+class StreamedFrame:
+    # A frame whose body goes out straight from a file (socket.sendfile) or from the caller's buffer,
+    # never joined with its header, so a multi-MB body is not copied. send() may be repeated for
+    # retransmissions. With compress set the body is deflated once, in chunks, into a temporary file.
+    # body: bytes-like, a path, or a binary file object (read from its current position to the end).
+    def __init__(self, message_type, body, sequence_number=0, compress=False, chunk_size=CHUNK_SIZE):
+        self.message_type = message_type
+        self.sequence_number = sequence_number
+        self.chunk_size = chunk_size
+        self.buffer = None
+        self.file = None
+        self.owns_file = False
+        self.offset = 0
+        if isinstance(body, (str, os.PathLike)):
+            body, self.owns_file = open(body, "rb"), True
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            self.buffer = memoryview(body)
+            self.length = len(self.buffer)
+        else:
+            self.file = body
+            self.offset = body.tell()
+            self.length = os.fstat(body.fileno()).st_size - self.offset
+        if compress and self.length >= COMPRESS_MIN_LENGTH:
+            self.compress()
+
+    def chunks(self):
+        if self.buffer is not None:
+            for start in range(0, self.length, self.chunk_size):
+                yield self.buffer[start:start + self.chunk_size]
+            return
+        for start in range(self.offset, self.offset + self.length, self.chunk_size):
+            # pread leaves the file position alone, so several connections can send one frame at once
+            yield os.pread(self.file.fileno(), min(self.chunk_size, self.offset + self.length - start), start)
+
+    def compress(self):
+        spool = tempfile.TemporaryFile()
+        compressor = zlib.compressobj(1)
+        for chunk in self.chunks():
+            spool.write(compressor.compress(chunk))
+        spool.write(compressor.flush())
+        spool.flush()  # sendfile and pread go by the file descriptor, not the file object's buffer
+        if spool.tell() >= self.length:
+            spool.close()  # Incompressible, keep the original
+            return
+        self.close()
+        self.buffer, self.file, self.owns_file, self.offset = None, spool, True, 0
+        self.length = spool.tell()
+        self.message_type |= COMPRESSED
+
+    def send(self, sock, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time_ns()
+        sock.sendall(HEADER_STRUCT.pack(timestamp, self.message_type, self.sequence_number, self.length))
+        if self.file is not None and hasattr(sock, "sendfile"):
+            sock.sendfile(self.file, self.offset, self.length)
+            return
+        for chunk in self.chunks():
+            sock.sendall(chunk)
+
+    def close(self):
+        if self.owns_file:
+            self.file.close()
+            self.owns_file = False
+
 if __name__=="__main__":
     head_setter = ProtocolHeader()
     ret = head_setter.get_header_message(time.time_ns(), 1, 1, 0)
-    print(ret)
-    print(f"Size of ret: {ret.nbytes} bytes")
+    print(head_setter.unpack(ret))
+    print(f"Size of ret: {len(ret)} bytes")
+
+    count = 100000
+    start = time.perf_counter()
+    for i in range(count):
+        head_setter.pack(time.time_ns(), 1, i, 0)
+    print(f"Scalar pack: {count / (time.perf_counter() - start):.0f} headers/s")
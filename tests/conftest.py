@@ -0,0 +1,52 @@
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend_process import BackendProcess
+from log_pipeline import LogPipeline
+
+def free_ports(count):
+    sockets = [socket.socket() for _ in range(count)]
+    try:
+        for sock in sockets:
+            sock.bind(("localhost", 0))
+        return [sock.getsockname()[1] for sock in sockets]
+    finally:
+        for sock in sockets:
+            sock.close()
+
+def wait_listening(port, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("localhost", port), 0.5).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+@pytest.fixture(params=["threaded", "async"])
+def backend(request, tmp_path):
+    # A backend serving both ports from this process; yields it and a registry file pointing at it
+    process = BackendProcess(free_ports(2), log=LogPipeline(console=False))
+    start = process.start_server if request.param == "threaded" else process.start_async_server
+    threading.Thread(target=start, daemon=True).start()
+    wait_listening(process.ports[1])
+    registry = tmp_path / "backends.json"
+    registry.write_text(json.dumps([{"name": "test", "host": "localhost", "ports": process.ports}]))
+    yield process, str(registry)
+    process.draining = True
+    for server_socket in process.listeners:
+        try:
+            server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    process.timers.stop()
+    process.log.close()
@@ -0,0 +1,110 @@
+import socket
+import sys
+import threading
+import time
+import pytest
+from backend_process import BackendProcess
+from log_pipeline import LogPipeline
+from prefork import HELLO_TIMEOUT
+from tcp_common import HEADER_STRUCT, MessageType, FrameReader, ProtocolError, encode_frame
+
+def subscribe(process, hello=None):
+    sock = socket.create_connection(("localhost", process.ports[0]))
+    if hello is not None:
+        sock.sendall(encode_frame(MessageType.HELLO, hello.encode()))
+    return sock, FrameReader(sock)
+
+def test_subscription_waits_for_hello(backend):
+    # One state snapshot, for the session named in HELLO, and no session for the address
+    process, _ = backend
+    sock, reader = subscribe(process, "controller")
+    try:
+        sock.settimeout(2.0)
+        _, message_type, sequence_number, body = reader.read_frame()
+        assert (message_type, sequence_number, bytes(body)) == (MessageType.STATE_CHANGED, 1, b"\0")
+        sock.settimeout(HELLO_TIMEOUT * 2)
+        with pytest.raises(TimeoutError):
+            reader.read_frame()
+        assert "127.0.0.1" not in process.sessions.sessions
+    finally:
+        sock.close()
+
+def test_subscription_without_hello_goes_by_address(backend):
+    process, _ = backend
+    sock, reader = subscribe(process)
+    try:
+        sock.settimeout(HELLO_TIMEOUT + 2.0)
+        assert reader.read_frame()[1] == MessageType.STATE_CHANGED
+        assert "127.0.0.1" in process.sessions.sessions
+    finally:
+        sock.close()
+
+def test_stalled_subscriber_does_not_block_other_sessions(backend):
+    # A controller that stops reading holds up neither other sessions nor the timer wheel, and is dropped
+    # after send_timeout
+    process, _ = backend
+    if process.loop is not None:
+        pytest.skip("asyncio writers buffer instead of blocking")
+    process.send_timeout = 0.5
+    stalled, _ = subscribe(process, "stalled")
+    active, reader = subscribe(process, "active")
+    try:
+        active.settimeout(2.0)
+        assert reader.read_frame()[1] == MessageType.STATE_CHANGED
+        stalled_session = process.sessions.get("stalled")
+        while not stalled_session.subscribers:
+            time.sleep(0.01)
+        fired = threading.Event()
+        process.timers.schedule(0.01, lambda: [process.publish(stalled_session, MessageType.READY, bytes(65536))
+                                               for _ in range(64)])
+        scheduled = time.monotonic()
+        process.timers.schedule(0.05, fired.set)
+        assert fired.wait(2.0)
+        assert time.monotonic() - scheduled < 0.3
+        started = time.monotonic()
+        assert process.publish(process.sessions.get("active"), MessageType.READY)
+        assert reader.read_frame()[1] == MessageType.READY
+        assert time.monotonic() - started < 0.2
+        deadline = time.monotonic() + 3.0
+        while stalled_session.subscribers and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert not stalled_session.subscribers
+    finally:
+        stalled.close()
+        active.close()
+
+def test_cut_off_data_leaves_no_partial_file(tmp_path):
+    process = BackendProcess([0, 0], log=LogPipeline(console=False), data_dir=str(tmp_path))
+    a, b = socket.socketpair()
+    try:
+        a.sendall(HEADER_STRUCT.pack(0, MessageType.DATA, 1, 200000) + bytes(100000))
+        a.close()
+        body = FrameReader(b).read_frame()[3]
+        with pytest.raises(ProtocolError):
+            process.on_data(process.sessions.get("controller"), body, 1, None)
+        assert list(tmp_path.iterdir()) == []
+    finally:
+        b.close()
+        process.log.close()
+
+def test_concurrent_pushes_are_numbered_in_order(backend):
+    process, _ = backend
+    sock, reader = subscribe(process, "controller")
+    try:
+        sock.settimeout(2.0)
+        assert reader.read_frame()[1:3] == (MessageType.STATE_CHANGED, 1)
+        session = process.sessions.get("controller")
+        threads = [threading.Thread(target=lambda: [process.publish(session, MessageType.READY) for _ in range(200)])
+                   for _ in range(4)]
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # Switch threads as often as possible
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+        assert [reader.read_frame()[2] for _ in range(800)] == list(range(2, 802))
+    finally:
+        sock.close()
@@ -0,0 +1,63 @@
+import socket
+import time
+from controller_core import ConnectionPool, ControllerCore, load_backends
+from tcp_common import MessageType, encode_frame
+
+def test_new_controller_instance_is_not_a_duplicate(backend):
+    # Every instance restarts its sequence numbers at 1; the backend must not drop the second one's START #1
+    process, registry = backend
+    first = ControllerCore(load_backends(registry))
+    first.start()
+    try:
+        assert first.start_capture()[0]
+        assert first.end_capture()[0]
+    finally:
+        first.stop()
+    second = ControllerCore(load_backends(registry))
+    second.start()
+    try:
+        assert second.controller_id != first.controller_id
+        assert second.start_capture()[0]
+        assert process.sessions.get(second.controller_id).is_started
+    finally:
+        second.stop()
+
+def test_synchronized_end_queues_behind_pending_start(backend):
+    process, registry = backend
+    core = ControllerCore(load_backends(registry), synchronized=True, start_lead=0.3)
+    states = []
+    core.add_listener(lambda event, *args: states.append(args[1]) if event == "state_changed" else None)
+    core.start()
+    try:
+        assert core.wait_connected(2.0)
+        assert core.start_capture()[0]
+        start_ns = core.activation_ns
+        assert core.end_capture()[0]  # Sent while the START is still pending
+        assert core.activation_ns > start_ns
+        assert core.wait_activation() == []
+        assert states[-2:] == [True, False]
+        assert not process.sessions.get(core.controller_id).is_started
+    finally:
+        core.stop()
+
+def test_fan_out_stops_resending_at_the_deadline():
+    # Backends that never ACK; with one worker the second send only starts once the deadline has passed
+    listeners = [socket.create_server(("localhost", 0)) for _ in range(2)]
+    backends = [{"host": "localhost", "ports": [0, listener.getsockname()[1]], "transport": "tcp",
+                 "socket_dir": None, "sockets": [None, None]} for listener in listeners]
+    pool = ConnectionPool(max_workers=1)
+    try:
+        results = pool.fan_out(backends, 1, encode_frame(MessageType.START, sequence_number=1), 0.3, 1)
+        assert [sent for sent, _, _ in results] == [False, False]
+        started = time.monotonic()
+        pool.executor.submit(lambda: None).result(timeout=2.0)
+        assert time.monotonic() - started < 0.1
+        for backend in backends:
+            lock = pool.backend_lock(backend)
+            assert lock.acquire(timeout=0.1)
+            lock.release()
+    finally:
+        pool.executor.shutdown(wait=False)
+        pool.close_all(backends)
+        for listener in listeners:
+            listener.close()
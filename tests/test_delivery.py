@@ -0,0 +1,86 @@
+from delivery import DedupWindow, RetransmitWindow
+from timer_wheel import TimerWheel
+
+class ManualTimers:
+    # TimerWheel stand-in: records what is scheduled, and the test fires it by calling expire
+    def __init__(self):
+        self.wheel = TimerWheel()
+        self.delays = []
+        self.cancelled = []
+
+    def timer(self, callback, *args):
+        return self.wheel.timer(callback, *args)
+
+    def reschedule(self, handle, delay):
+        self.delays.append(delay)
+        self.wheel.reschedule(handle, delay)
+
+    def cancel(self, handle):
+        self.cancelled.append(handle)
+        return self.wheel.cancel(handle)
+
+def test_dedup_window_drops_duplicates_inside_the_window():
+    window = DedupWindow(size=8)
+    assert window.accept(1)
+    assert window.accept(3)
+    assert not window.accept(1)
+    assert window.accept(2)  # Arrived late but not seen before
+    assert not window.accept(2)
+    assert not window.accept(3)
+
+def test_dedup_window_treats_too_old_as_duplicate():
+    window = DedupWindow(size=8)
+    assert window.accept(1)
+    assert window.accept(20)
+    assert not window.accept(12)  # 8 below the highest, outside the window although never seen
+    assert window.accept(13)
+    assert not window.accept(13)
+
+def test_dedup_window_jump_past_the_window_forgets_the_old_mask():
+    window = DedupWindow(size=8)
+    for sequence_number in range(1, 6):
+        assert window.accept(sequence_number)
+    assert window.accept(100)
+    assert window.mask == 1
+    assert window.accept(99)
+
+def test_dedup_window_reset_starts_over():
+    window = DedupWindow()
+    assert window.accept(5)
+    window.reset()
+    assert window.accept(5)
+
+def test_retransmit_backs_off_and_gives_up_after_max_attempts():
+    timers = ManualTimers()
+    sent = []
+    window = RetransmitWindow(timers, sent.append, initial_rto=0.5, max_rto=2.0, max_attempts=4)
+    assert window.add(1, b"frame")
+    for _ in range(5):
+        window.expire(1)
+    assert sent == [b"frame"] * 3
+    assert timers.delays == [0.5, 1.0, 2.0, 2.0]
+    assert len(window) == 0
+
+def test_retransmit_ack_cancels_the_timer():
+    timers = ManualTimers()
+    sent = []
+    window = RetransmitWindow(timers, sent.append)
+    assert window.add(1, b"one")
+    assert window.add(2, b"two")
+    handle = window.pending[1][1]
+    assert window.ack(1)
+    assert not handle.scheduled
+    assert timers.cancelled == [handle]
+    assert not window.ack(1)  # Duplicate ACK
+    window.expire(1)
+    assert sent == []
+    assert window.frames() == [b"two"]
+
+def test_retransmit_window_full():
+    window = RetransmitWindow(ManualTimers(), lambda frame: None, capacity=2)
+    assert window.add(1, b"one")
+    assert window.add(2, b"two")
+    assert not window.add(3, b"three")
+    window.clear()
+    assert len(window) == 0
+    assert window.add(3, b"three")
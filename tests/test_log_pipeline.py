@@ -0,0 +1,13 @@
+from log_pipeline import INFO, WARNING, LogPipeline, read_binary_log
+
+def test_binary_log_round_trip(tmp_path):
+    path = str(tmp_path / "log.bin")
+    log = LogPipeline(console=False, binary_path=path)
+    log.info("%d frames in %.3f ms, %5.1f%% of %s", 12, 1.23456, 42.0, "budget")
+    log.warning("plain message")
+    log.info("%d frames in %.3f ms, %5.1f%% of %s", 7, 0.5, 100, "budget")
+    log.close()
+    assert [(level, message) for _, level, message in read_binary_log(path)] == [
+        (INFO, "12 frames in 1.235 ms,  42.0% of budget"),
+        (WARNING, "plain message"),
+        (INFO, "7 frames in 0.500 ms, 100.0% of budget")]
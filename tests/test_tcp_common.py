@@ -0,0 +1,108 @@
+import asyncio
+import os
+import socket
+import threading
+import zlib
+import pytest
+from tcp_common import (HEADER_STRUCT, MAX_BODY_LENGTH, CHUNK_SIZE, COMPRESSED, BodyStream, FrameReader, MessageType,
+                        ProtocolError, StreamedFrame, buffer_sizes, encode_frame, read_frame_async)
+
+def exchange(send, **reader_args):
+    # Runs send(sock) on a thread, so a body larger than the socket buffers does not block; returns a
+    # FrameReader on the other end and the thread
+    a, b = socket.socketpair()
+    def run():
+        try:
+            send(a)
+        finally:
+            a.close()
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    b.settimeout(5.0)
+    return FrameReader(b, **reader_args), thread
+
+@pytest.mark.parametrize("compress", [False, True])
+@pytest.mark.parametrize("from_file", [False, True])
+def test_streamed_body_round_trip(compress, from_file, tmp_path):
+    # Bytes are sent chunk by chunk, files with sendfile
+    body = b"".join(i.to_bytes(4, "little") + os.urandom(4) for i in range(25000))  # 200 KB, compressible
+    source = body
+    if from_file:
+        source = tmp_path / "body.bin"
+        source.write_bytes(body)
+    frame = StreamedFrame(MessageType.DATA, source, sequence_number=3, compress=compress)
+    assert bool(frame.message_type & COMPRESSED) == compress
+    reader, thread = exchange(frame.send, max_body_length=4096, chunk_size=1024)
+    _, message_type, sequence_number, stream = reader.read_frame()
+    assert (message_type, sequence_number) == (MessageType.DATA, 3)
+    assert isinstance(stream, BodyStream) and stream.compressed == compress
+    received = bytearray()
+    for chunk in stream.chunks():
+        assert len(chunk) <= 1024
+        received += chunk
+    assert received == body
+    assert reader.read_frame() is None
+    thread.join()
+    frame.close()
+
+def test_body_above_max_body_length_is_streamed():
+    reader, thread = exchange(lambda sock: sock.sendall(encode_frame(MessageType.DATA, b"a" * 4096) +
+                                                        encode_frame(MessageType.DATA, b"b" * 4097)),
+                              max_body_length=4096, chunk_size=1024)
+    body = reader.read_frame()[3]
+    assert isinstance(body, memoryview) and bytes(body) == b"a" * 4096
+    body = reader.read_frame()[3]
+    assert isinstance(body, BodyStream) and body.length == 4097
+    assert body.read(8192) == b"b" * 4097
+    thread.join()
+
+def test_inflated_body_over_the_limit_is_rejected():
+    compressed = zlib.compress(bytes(1 << 20))
+    header = HEADER_STRUCT.pack(0, MessageType.DATA | COMPRESSED, 0, len(compressed))
+    reader, thread = exchange(lambda sock: sock.sendall(header + compressed), max_stream_length=64 * 1024)
+    stream = reader.read_frame()[3]
+    with pytest.raises(ProtocolError, match="exceeds limit"):
+        for _ in stream.chunks():
+            pass
+    thread.join()
+
+def test_body_over_the_stream_limit_is_rejected_from_its_header():
+    header = HEADER_STRUCT.pack(0, MessageType.DATA, 0, 1 << 20)
+    reader, thread = exchange(lambda sock: sock.sendall(header), max_stream_length=64 * 1024)
+    with pytest.raises(ProtocolError, match="exceeds limit"):
+        reader.read_frame()
+    thread.join()
+    async def read():
+        stream = asyncio.StreamReader()
+        stream.feed_data(header)  # Rejected before anything is spooled, without waiting for the body
+        return await read_frame_async(stream, max_stream_length=64 * 1024)
+    with pytest.raises(ProtocolError, match="exceeds limit"):
+        asyncio.run(read())
+
+def test_truncated_compressed_body_is_rejected():
+    compressed = zlib.compress(os.urandom(4000) * 4)
+    header = HEADER_STRUCT.pack(0, MessageType.DATA | COMPRESSED, 0, len(compressed) - 10)
+    reader, thread = exchange(lambda sock: sock.sendall(header + compressed[:-10]))
+    stream = reader.read_frame()[3]
+    with pytest.raises(ProtocolError, match="truncated"):
+        stream.read(1 << 20)
+    thread.join()
+
+@pytest.mark.parametrize("length", [100, 10000])
+def test_connection_closed_mid_body(length):
+    header = HEADER_STRUCT.pack(0, MessageType.DATA, 0, length)
+    reader, thread = exchange(lambda sock: sock.sendall(header + bytes(50)), max_body_length=4096, chunk_size=1024)
+    with pytest.raises(ProtocolError, match="middle of a frame"):
+        frame = reader.read_frame()
+        frame[3].skip()
+    thread.join()
+
+def test_buffer_sizes_split_the_connection_memory():
+    assert buffer_sizes(None) == (MAX_BODY_LENGTH, CHUNK_SIZE)
+    for memory_cap in (4096, 16384, 192 * 1024, 1 << 20):
+        max_body_length, chunk_size = buffer_sizes(memory_cap)
+        assert max_body_length + 2 * chunk_size == memory_cap
+        assert 0 < chunk_size <= CHUNK_SIZE and max_body_length >= chunk_size
+    reader = FrameReader(socket.socketpair()[0], memory_cap=16384)
+    assert (len(reader.body), reader.chunk_size) == (8192, 4096)
+    reader.sock.close()
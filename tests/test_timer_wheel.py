@@ -0,0 +1,62 @@
+import threading
+from timer_wheel import TimerWheel
+
+def manual_wheel(slots=8):
+    # One-second ticks and no thread: the test advances the wheel by calling expire
+    return TimerWheel(tick=1.0, slots=slots)
+
+def fired(wheel, ticks):
+    return {tick: [handle.args[0] for handle in wheel.expire(tick)] for tick in ticks}
+
+def test_timers_past_one_lap_wait_for_their_tick():
+    wheel = manual_wheel()
+    wheel.schedule(3, None, "short")
+    wheel.schedule(20, None, "long")  # Shares slot 4 with ticks 4 and 12
+    wheel.schedule(12, None, "lap")
+    assert {tick: names for tick, names in fired(wheel, range(1, 21)).items() if names} == {
+        3: ["short"], 12: ["lap"], 20: ["long"]}
+
+def test_cancel():
+    wheel = manual_wheel()
+    handle = wheel.schedule(2, None, "cancelled")
+    assert handle.scheduled
+    assert wheel.cancel(handle)
+    assert not wheel.cancel(handle)
+    assert not wheel.cancel(None)
+    assert wheel.remaining(handle) is None
+    assert fired(wheel, range(1, 4)) == {1: [], 2: [], 3: []}
+
+def test_reschedule_moves_and_rearms():
+    wheel = manual_wheel()
+    handle = wheel.timer(None, "timer")
+    assert not handle.scheduled
+    wheel.reschedule(handle, 5)
+    assert 4.0 < wheel.remaining(handle) <= 5.0
+    wheel.reschedule(handle, 2)
+    assert 1.0 < wheel.remaining(handle) <= 2.0
+    assert fired(wheel, range(1, 3)) == {1: [], 2: ["timer"]}
+    assert wheel.remaining(handle) is None
+    wheel.reschedule(handle, 0)  # At least one tick
+    assert handle.expires_tick == 1
+
+def test_callback_failure_goes_to_the_log():
+    class Log:
+        def __init__(self):
+            self.errors = []
+            self.logged = threading.Event()
+
+        def error(self, fmt, *args):
+            self.errors.append(fmt % args)
+            self.logged.set()
+
+    log = Log()
+    wheel = TimerWheel(tick=0.001, log=log)
+    done = threading.Event()
+    wheel.start()
+    try:
+        wheel.schedule(0.001, lambda: 1 / 0)
+        wheel.schedule(0.005, done.set)
+        assert log.logged.wait(2.0) and done.wait(2.0)  # Later timers still run
+        assert "division by zero" in log.errors[0]
+    finally:
+        wheel.stop()
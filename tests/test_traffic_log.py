@@ -0,0 +1,64 @@
+import os
+import time
+from tcp_common import MessageType, encode_frame
+from traffic_log import FROM_BACKEND, TO_BACKEND, MAGIC, TrafficLog, TrafficRecorder
+
+def crash(recorder):
+    # Leaves the capture as a killed process would: no final truncate, preallocated space still zero
+    recorder.mm.flush()
+    recorder.mm.close()
+    recorder.file.close()
+    recorder.index_file.close()
+
+def read_all(path, **kwargs):
+    log = TrafficLog(path)
+    try:
+        return [(direction, peer, message_type, sequence_number, bytes(body))
+                for _, _, direction, peer, _, message_type, sequence_number, body in log.records(**kwargs)]
+    finally:
+        log.close()
+
+def test_record_reopen_and_seek(tmp_path):
+    path = str(tmp_path / "capture")
+    recorder = TrafficRecorder(path, chunk_size=4096, index_interval=0)
+    recorder.record(1, TO_BACKEND, "a", encode_frame(MessageType.START, sequence_number=1))
+    recorder.record(1, FROM_BACKEND, "a", encode_frame(MessageType.ACK, sequence_number=1))
+    recorder.close()
+    assert os.path.getsize(path) == recorder.offset
+    time.sleep(0.001)
+    recorder = TrafficRecorder(path, chunk_size=4096, index_interval=0)  # Appends
+    middle_ns = time.time_ns()
+    recorder.record(1, TO_BACKEND, "b", encode_frame(MessageType.EVENT, b"x" * 5000, 2))  # Grows the file
+    recorder.record(0, FROM_BACKEND, "b", encode_frame(MessageType.READY, sequence_number=1))
+    recorder.close()
+    assert [record[2] for record in read_all(path)] == [MessageType.START, MessageType.ACK, MessageType.EVENT,
+                                                        MessageType.READY]
+    assert read_all(path, start_ns=middle_ns) == [(TO_BACKEND, "b", MessageType.EVENT, 2, b"x" * 5000),
+                                                  (FROM_BACKEND, "b", MessageType.READY, 1, b"")]
+    log = TrafficLog(path)
+    try:
+        assert len(log.index_times) == 4
+        assert log.seek(middle_ns) == log.index_offsets[1]  # Last entry before the time, scanned from there
+        assert log.seek(0) == len(MAGIC)
+    finally:
+        log.close()
+
+def test_crashed_capture_ends_at_the_first_zero_capture_time(tmp_path):
+    path = str(tmp_path / "capture")
+    recorder = TrafficRecorder(path, chunk_size=4096)
+    recorder.record(1, TO_BACKEND, "a", encode_frame(MessageType.START, sequence_number=1))
+    end = recorder.offset
+    # A record that was being written when the process died: everything but its capture time
+    recorder.record(1, TO_BACKEND, "a", encode_frame(MessageType.END, sequence_number=2))
+    recorder.mm[end:end + 8] = bytes(8)
+    crash(recorder)
+    assert os.path.getsize(path) > end
+    log = TrafficLog(path)
+    assert log.end() == end
+    log.close()
+    assert [record[2] for record in read_all(path)] == [MessageType.START]
+    recorder = TrafficRecorder(path, chunk_size=4096)
+    assert recorder.offset == end
+    recorder.record(1, TO_BACKEND, "a", encode_frame(MessageType.EVENT, b"e", 3))
+    recorder.close()
+    assert read_all(path)[1:] == [(TO_BACKEND, "a", MessageType.EVENT, 3, b"e")]
@@ -0,0 +1,69 @@
+import os
+import select
+import socket
+import struct
+import time
+import pytest
+from transports import SHM_SUPPORTED, ShmConnection
+
+pytestmark = pytest.mark.skipif(not (hasattr(os, "memfd_create") and SHM_SUPPORTED),
+                                reason="shm transport is Linux on x86-64 only")
+
+@pytest.fixture
+def shm_pair():
+    # Both ends of a shared-memory connection with 64-byte rings, set up over a socketpair
+    a, b = socket.socketpair()
+    server = ShmConnection.accept(a, capacity=64)
+    client = ShmConnection.connect(b)
+    yield server, client
+    server.close()
+    client.close()
+
+def test_writes_wrap_around_the_ring_end(shm_pair):
+    server, client = shm_pair
+    buffer = bytearray(64)
+    for i in range(10):
+        data = bytes([i]) * 40  # Every other write crosses the end of the ring
+        server.sendall(data)
+        assert client.recv_into(buffer) == 40
+        assert buffer[:40] == data
+    assert server.tx.tail == 400 and server.tx.tail % server.tx.capacity == 16
+
+def test_full_ring_times_out(shm_pair):
+    server, client = shm_pair
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, struct.pack("@ll", 0, 100000))
+    server.sendall(bytes(60))
+    started = time.monotonic()
+    with pytest.raises(socket.timeout):
+        server.sendall(bytes(10))  # Never half written: the whole frame has to fit
+    assert 0.09 <= time.monotonic() - started < 1.0
+    assert server.tx.tail == 60
+    server.setblocking(False)
+    with pytest.raises(BlockingIOError):
+        server.sendall(bytes(10))
+    assert client.recv(64) == bytes(60)
+    server.sendall(bytes(10))
+
+def test_peer_close_is_detected(shm_pair):
+    server, client = shm_pair
+    client.sendall(b"last")
+    client.close()
+    assert server.wait_readable(1.0)
+    assert server.recv(64) == b"last"
+    assert server.recv(64) == b""
+    server.sendall(bytes(60))
+    with pytest.raises(BrokenPipeError):
+        server.sendall(bytes(10))
+
+def test_non_blocking_recv_into(shm_pair):
+    server, client = shm_pair
+    client.setblocking(False)
+    buffer = bytearray(16)
+    with pytest.raises(BlockingIOError):
+        client.recv_into(buffer)
+    server.sendall(b"wake")  # The reader is waiting, so this rings the doorbell
+    assert server.tx.consumer_waiting()
+    assert select.select([client], [], [], 1.0)[0]
+    assert client.recv_into(buffer) == 4 and buffer[:4] == b"wake"
+    with pytest.raises(BlockingIOError):
+        client.recv_into(buffer)
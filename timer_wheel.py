@@ -0,0 +1,102 @@
+import threading
+import time
+
+class TimerHandle:
+    __slots__ = ("callback", "args", "expires_tick", "slot")
+
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.expires_tick = None
+        self.slot = None  # Slot dict the handle currently sits in, None when not scheduled
+
+    @property
+    def scheduled(self):
+        return self.slot is not None
+
+class TimerWheel:
+    # Hashed timing wheel driven by one thread: schedule, cancel and reschedule are O(1).
+    # Callbacks run on the wheel thread and should hand off anything slow; their failures go to log.
+    def __init__(self, tick=0.01, slots=512, log=None):
+        self.tick = tick
+        self.log = log
+        self.slots = [dict() for _ in range(slots)]  # dict keeps insertion order and O(1) removal
+        self.lock = threading.Lock()
+        self.current_tick = 0
+        self.start_time = time.monotonic()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name="timer-wheel", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def timer(self, callback, *args):
+        # Unscheduled handle that can be (re)scheduled any number of times
+        return TimerHandle(callback, args)
+
+    def schedule(self, delay, callback, *args):
+        handle = TimerHandle(callback, args)
+        self.reschedule(handle, delay)
+        return handle
+
+    def reschedule(self, handle, delay):
+        # Moves a pending timer, or re-arms one that already fired or was cancelled
+        with self.lock:
+            self._remove(handle)
+            elapsed_ticks = int((time.monotonic() - self.start_time) / self.tick)
+            handle.expires_tick = max(elapsed_ticks, self.current_tick) + max(1, round(delay / self.tick))
+            handle.slot = self.slots[handle.expires_tick % len(self.slots)]
+            handle.slot[handle] = None
+
+    def remaining(self, handle):
+        # Seconds until a timer fires, None when it is not scheduled
+        with self.lock:
+            if handle.slot is None:
+                return None
+            return max(0.0, self.start_time + handle.expires_tick * self.tick - time.monotonic())
+
+    def cancel(self, handle):
+        if handle is None:
+            return False
+        with self.lock:
+            return self._remove(handle)
+
+    def _remove(self, handle):
+        if handle.slot is None:
+            return False
+        del handle.slot[handle]
+        handle.slot = None
+        return True
+
+    def run(self):
+        while not self.stopped.is_set():
+            target_tick = int((time.monotonic() - self.start_time) / self.tick)
+            while self.current_tick < target_tick:
+                self.current_tick += 1
+                for handle in self.expire(self.current_tick):
+                    try:
+                        handle.callback(*handle.args)
+                    except Exception as e:
+                        if self.log is not None:
+                            self.log.error("Timer callback %s failed: %s", handle.callback, e)
+                        else:
+                            print(f"Timer callback {handle.callback} failed: {str(e)}")
+            next_time = self.start_time + (self.current_tick + 1) * self.tick
+            self.stopped.wait(max(0, next_time - time.monotonic()))
+
+    def expire(self, tick):
+        with self.lock:
+            slot = self.slots[tick % len(self.slots)]
+            expired = [handle for handle in slot if handle.expires_tick <= tick]
+            for handle in expired:
+                self._remove(handle)
+        return expired
@@ -0,0 +1,198 @@
+import bisect
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from datetime import datetime
+from log_pipeline import format_time
+from tcp_common import HEADER_SIZE, HEADER_STRUCT, MESSAGE_NAMES
+
+# Capture file: MAGIC, then records back to back. A record is RECORD_STRUCT, the peer name, then the frame
+# exactly as it went over the wire. The file grows in preallocated chunks, so the first record with a zero
+# capture time marks the end of a capture that was not closed cleanly.
+MAGIC = b"CTLTRAF1"
+RECORD_STRUCT = struct.Struct("<QBBH")  # capture time ns, port index, direction, peer name length
+INDEX_ENTRY = struct.Struct("<QQ")  # capture time ns, file offset; in the ".idx" file next to the capture
+
+TO_BACKEND = 0  # Frame sent by a controller
+FROM_BACKEND = 1  # ACKs and pushes sent by the backend
+DIRECTION_NAMES = {TO_BACKEND: "in", FROM_BACKEND: "out"}
+
+def index_path(path):
+    return path + ".idx"
+
+class TrafficRecorder:
+    # Appends frames to a memory-mapped capture file; a write is a copy into the mapping, so recording
+    # can stay on in the message path. An index entry is added at most every index_interval seconds.
+    # An existing capture is continued, so restarting a backend after a crash keeps what led up to it.
+    def __init__(self, path, chunk_size=16 * 1024 * 1024, index_interval=1.0):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.index_interval_ns = int(index_interval * 1e9)
+        self.lock = threading.Lock()
+        self.offset = len(MAGIC)
+        if os.path.exists(path) and os.path.getsize(path):
+            log = TrafficLog(path)
+            self.offset = log.end()
+            log.close()
+            self.file = open(path, "r+b")
+        else:
+            self.file = open(path, "w+b")
+        self.size = self.offset + chunk_size
+        self.file.truncate(self.offset)  # Zero whatever a crashed writer left after its last complete record
+        self.file.truncate(self.size)
+        self.mm = mmap.mmap(self.file.fileno(), self.size)
+        self.mm[:len(MAGIC)] = MAGIC
+        self.index_file = open(index_path(path), "ab")
+        self.last_indexed_ns = 0
+        self.records = 0
+
+    def record(self, port_index, direction, peer, frame):
+        # frame is an encoded frame, header included
+        timestamp, message_type, sequence_number, body_length = HEADER_STRUCT.unpack_from(frame)
+        self.record_frame(port_index, direction, peer, timestamp, message_type, sequence_number,
+                          memoryview(frame)[HEADER_SIZE:HEADER_SIZE + body_length])
+
+    def record_frame(self, port_index, direction, peer, timestamp, message_type, sequence_number, body):
+        peer = peer.encode()
+        size = RECORD_STRUCT.size + len(peer) + HEADER_SIZE + len(body)
+        with self.lock:
+            if self.mm is None:
+                return
+            if self.offset + size > self.size:
+                self.grow(size)
+            capture_ns = time.time_ns()
+            if capture_ns - self.last_indexed_ns >= self.index_interval_ns:
+                self.index_file.write(INDEX_ENTRY.pack(capture_ns, self.offset))
+                self.index_file.flush()  # Readers of a live or crashed capture seek with what is on disk
+                self.last_indexed_ns = capture_ns
+            at = self.offset + RECORD_STRUCT.size
+            self.mm[at:at + len(peer)] = peer
+            at += len(peer)
+            HEADER_STRUCT.pack_into(self.mm, at, timestamp, message_type, sequence_number, len(body))
+            at += HEADER_SIZE
+            self.mm[at:at + len(body)] = body
+            # The record header goes in last: a reader never sees a capture time on a half-written record
+            RECORD_STRUCT.pack_into(self.mm, self.offset, capture_ns, port_index, direction, len(peer))
+            self.offset += size
+            self.records += 1
+
+    def grow(self, needed):
+        self.mm.close()
+        self.size += max(self.chunk_size, needed)
+        self.file.truncate(self.size)
+        self.mm = mmap.mmap(self.file.fileno(), self.size)
+
+    def close(self):
+        with self.lock:
+            if self.mm is None:
+                return
+            self.mm.close()
+            self.mm = None
+            self.file.truncate(self.offset)  # Drop the unused part of the last chunk
+            self.file.close()
+            self.index_file.close()
+
+class TrafficLog:
+    # Read side of a capture, also while it is still being written. Records are
+    # (capture_ns, port_index, direction, peer, timestamp, message_type, sequence_number, body);
+    # body is a view into the mapping, copy it to keep it past close().
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a traffic capture")
+        self.view = memoryview(self.mm)
+        self.index_times = []
+        self.index_offsets = []
+        if os.path.exists(index_path(path)):
+            with open(index_path(path), "rb") as f:
+                data = f.read()
+            for capture_ns, offset in INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]):
+                self.index_times.append(capture_ns)
+                self.index_offsets.append(offset)
+
+    def seek(self, start_ns):
+        # Offset of the last indexed record at or before start_ns; records are scanned from there
+        position = bisect.bisect_right(self.index_times, start_ns) - 1
+        return self.index_offsets[position] if position >= 0 else len(MAGIC)
+
+    def walk(self, offset=len(MAGIC)):
+        # Yields (offset, frame offset, next offset) of each complete record
+        end = len(self.mm)
+        while offset + RECORD_STRUCT.size + HEADER_SIZE <= end:
+            capture_ns, _, _, peer_length = RECORD_STRUCT.unpack_from(self.mm, offset)
+            if capture_ns == 0:
+                return  # Preallocated space after the last record
+            frame_at = offset + RECORD_STRUCT.size + peer_length
+            if frame_at + HEADER_SIZE > end:
+                return
+            next_offset = frame_at + HEADER_SIZE + HEADER_STRUCT.unpack_from(self.mm, frame_at)[3]
+            if next_offset > end:
+                return
+            yield offset, frame_at, next_offset
+            offset = next_offset
+
+    def end(self):
+        offset = len(MAGIC)
+        for _, _, offset in self.walk():
+            pass
+        return offset
+
+    def records(self, start_ns=None, end_ns=None):
+        for offset, frame_at, next_offset in self.walk(len(MAGIC) if start_ns is None else self.seek(start_ns)):
+            capture_ns, port_index, direction, _ = RECORD_STRUCT.unpack_from(self.mm, offset)
+            if end_ns is not None and capture_ns > end_ns:
+                return
+            if start_ns is None or capture_ns >= start_ns:
+                timestamp, message_type, sequence_number, _ = HEADER_STRUCT.unpack_from(self.mm, frame_at)
+                peer = bytes(self.view[offset + RECORD_STRUCT.size:frame_at]).decode()
+                yield (capture_ns, port_index, direction, peer, timestamp, message_type, sequence_number,
+                       self.view[frame_at + HEADER_SIZE:next_offset])
+
+    def first_time(self):
+        for record in self.records():
+            return record[0]
+        return None
+
+    def close(self):
+        if getattr(self, "view", None) is not None:
+            self.view.release()
+            self.view = None
+        try:
+            self.mm.close()
+        except BufferError:
+            pass  # A caller still holds a body; the mapping goes away with it
+        self.file.close()
+
+def parse_time(text, first_ns):
+    # "+12.5" is seconds after the first record, anything else a local date and time
+    if text is None:
+        return None
+    if text.startswith("+"):
+        return first_ns + int(float(text[1:]) * 1e9)
+    return int(datetime.fromisoformat(text).timestamp() * 1e9)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Print a traffic capture written by backend_process.py --record")
+    parser.add_argument("path")
+    parser.add_argument("--start", help="'+SECONDS' after the first record or 'YYYY-MM-DD HH:MM:SS[.fff]'")
+    parser.add_argument("--end", help="same formats as --start")
+    args = parser.parse_args()
+    log = TrafficLog(args.path)
+    first_ns = log.first_time()
+    if first_ns is None:
+        print("Empty capture")
+        sys.exit(0)
+    try:
+        for capture_ns, port_index, direction, peer, timestamp, message_type, sequence_number, body in log.records(
+                parse_time(args.start, first_ns), parse_time(args.end, first_ns)):
+            print(f"[{format_time(capture_ns)}] {DIRECTION_NAMES.get(direction, direction):3} port {port_index} "
+                  f"{peer} {MESSAGE_NAMES.get(message_type, message_type)} #{sequence_number}"
+                  + (f" {bytes(body)!r}" if len(body) else ""))
+    finally:
+        log.close()
@@ -0,0 +1,342 @@
+import errno
+import mmap
+import os
+import platform
+import select
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+# How a controller reaches a backend port: "tcp" works across hosts, "unix" and "shm" only on the same host
+TRANSPORTS = ("tcp", "unix", "shm")
+DEFAULT_SOCKET_DIR = tempfile.gettempdir()
+# The shm rings need stores to the shared mapping to reach the other process in order, which only x86-64
+# guarantees from Python; see fence()
+SHM_SUPPORTED = platform.machine().lower() in ("x86_64", "amd64")
+
+def unix_path(transport, port, socket_dir=None):
+    # Local transports are addressed by the backend's TCP port number, so one registry entry covers all three
+    return os.path.join(socket_dir or DEFAULT_SOCKET_DIR, f"control-backend-{port}.{transport}")
+
+def connect(backend, port_index, timeout):
+    # Opens a connection to one backend port over the transport named in its registry entry
+    transport = backend.get("transport", "tcp")
+    port = backend["ports"][port_index]
+    if transport == "tcp":
+        sock = socket.create_connection((backend["host"], port), timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(unix_path(transport, port, backend.get("socket_dir")))
+        if transport == "shm":
+            return ShmConnection.connect(sock)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+def listen(transport, host, port, socket_dir=None, backlog=128, reuse_port=False):
+    # reuse_port lets several worker processes bind the same TCP port; the kernel spreads connections over them
+    if transport == "tcp":
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind((host, port))
+    else:
+        path = unix_path(transport, port, socket_dir)
+        if os.path.exists(path):
+            os.unlink(path)  # Left over from a backend that did not shut down cleanly
+        server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server_socket.bind(path)
+    server_socket.listen(backlog)
+    return server_socket
+
+def accept_connection(transport, sock):
+    # Finishes setting up an accepted connection; run it on the connection's own thread
+    if transport == "shm":
+        return ShmConnection.accept(sock)
+    if transport == "tcp":
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # ACKs go out as small back-to-back writes
+    return sock
+
+def wait_readable(sock, timeout):
+    # select() for sockets; shared-memory connections poll their ring before sleeping
+    if isinstance(sock, ShmConnection):
+        return sock.wait_readable(timeout)
+    ready, _, _ = select.select([sock], [], [], timeout)
+    return bool(ready)
+
+def has_buffered(sock):
+    # Data already delivered that will not make the connection's fd readable again
+    return isinstance(sock, ShmConnection) and sock.rx.available() > 0
+
+def usable_cpus():
+    # CPUs this process may run on; sched_getaffinity is Linux only
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+_fence_lock = threading.Lock()
+
+def fence():
+    # CPython has no memory barrier primitive. x86-64 keeps stores in order, and the locked instruction in
+    # an uncontended Lock also orders the waiting flag against the ring counters. Elsewhere a lock is no
+    # barrier for another process, and a reordered counter would hand out stale ring bytes, which no
+    # timeout can undo, so shm is refused there (SHM_SUPPORTED).
+    with _fence_lock:
+        pass
+
+COUNTER = struct.Struct("<Q")
+RING_HEADER_SIZE = 192  # head, tail and waiting flag, each on its own cache line
+DEFAULT_RING_CAPACITY = 256 * 1024
+
+class ShmRing:
+    # Single-producer single-consumer byte ring. head and tail are byte counters that only grow;
+    # each side caches the counter it owns and reads the other one from shared memory.
+    def __init__(self, buf, offset, capacity):
+        self.buf = buf
+        self.head_at = offset
+        self.tail_at = offset + 64
+        self.waiting_at = offset + 128  # Set by a consumer about to sleep on the doorbell
+        self.data_at = offset + RING_HEADER_SIZE
+        self.capacity = capacity
+        self.head = COUNTER.unpack_from(buf, self.head_at)[0]
+        self.tail = COUNTER.unpack_from(buf, self.tail_at)[0]
+
+    # Producer side
+    def free(self):
+        return self.capacity - (self.tail - COUNTER.unpack_from(self.buf, self.head_at)[0])
+
+    def write(self, data):
+        # Caller checked free(); the bytes become visible to the consumer when tail is stored
+        size = len(data)
+        start = self.tail % self.capacity
+        first = min(size, self.capacity - start)
+        self.buf[self.data_at + start:self.data_at + start + first] = data[:first]
+        if first < size:
+            self.buf[self.data_at:self.data_at + size - first] = data[first:]
+        self.tail += size
+        COUNTER.pack_into(self.buf, self.tail_at, self.tail)
+
+    def consumer_waiting(self):
+        return self.buf[self.waiting_at] == 1
+
+    # Consumer side
+    def available(self):
+        return COUNTER.unpack_from(self.buf, self.tail_at)[0] - self.head
+
+    def read_into(self, view):
+        size = min(len(view), self.available())
+        if not size:
+            return 0
+        start = self.head % self.capacity
+        first = min(size, self.capacity - start)
+        view[:first] = self.buf[self.data_at + start:self.data_at + start + first]
+        if first < size:
+            view[first:size] = self.buf[self.data_at:self.data_at + size - first]
+        self.head += size
+        COUNTER.pack_into(self.buf, self.head_at, self.head)
+        return size
+
+    def set_waiting(self, waiting):
+        self.buf[self.waiting_at] = 1 if waiting else 0
+
+class ShmConnection:
+    # Socket-like connection over two rings in a shared memfd. The Unix socket it was set up on stays
+    # open as the doorbell (one byte wakes a sleeping reader) and reports the peer closing.
+    # A blocking reader polls its ring for `spin` seconds before sleeping, so a reply that comes back
+    # quickly costs neither side a system call; spinning holds the GIL, so keep it short.
+    # A non-blocking reader is woken for every write, which keeps fileno() usable with select/selectors.
+    backstop = 0.01  # Longest sleep between ring checks, in case a wake-up is missed
+
+    def __init__(self, sock, buf, mm, capacity, is_server):
+        self.sock = sock
+        self.mm = mm
+        self.spin = 50e-6 if usable_cpus() > 1 else 0  # Spinning only delays the peer on one CPU
+        self.buf = buf
+        rings = [ShmRing(buf, 0, capacity), ShmRing(buf, RING_HEADER_SIZE + capacity, capacity)]
+        self.tx, self.rx = rings if is_server else rings[::-1]
+        self.timeout = sock.gettimeout()
+        sock.setblocking(False)  # Doorbell reads and writes never wait; waits go through select()
+        self.send_timeout = None  # SO_SNDTIMEO: how long a blocking sendall waits for room in the ring
+        self.peer_closed = False
+        self.closed = False
+        self.rx.set_waiting(self.timeout == 0)
+
+    @classmethod
+    def accept(cls, sock, capacity=DEFAULT_RING_CAPACITY):
+        # Server side: create the rings and hand the memory to the client over the Unix socket
+        if not SHM_SUPPORTED:
+            raise OSError(errno.EOPNOTSUPP, f"shm transport needs x86-64, not {platform.machine()}")
+        size = 2 * (RING_HEADER_SIZE + capacity)
+        fd = os.memfd_create("control-shm")
+        try:
+            os.ftruncate(fd, size)
+            mm = mmap.mmap(fd, size)
+            socket.send_fds(sock, [struct.pack("<I", capacity)], [fd])
+        finally:
+            os.close(fd)
+        return cls(sock, memoryview(mm), mm, capacity, True)
+
+    @classmethod
+    def connect(cls, sock):
+        if not SHM_SUPPORTED:
+            raise OSError(errno.EOPNOTSUPP, f"shm transport needs x86-64, not {platform.machine()}")
+        data, fds, _, _ = socket.recv_fds(sock, 4, 1)
+        if len(data) != 4 or len(fds) != 1:
+            for fd in fds:
+                os.close(fd)
+            raise ConnectionError("Shared-memory handshake failed")
+        capacity = struct.unpack("<I", data)[0]
+        try:
+            mm = mmap.mmap(fds[0], 2 * (RING_HEADER_SIZE + capacity))
+        finally:
+            os.close(fds[0])
+        return cls(sock, memoryview(mm), mm, capacity, False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def gettimeout(self):
+        return self.timeout
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+        self.rx.set_waiting(timeout == 0)
+
+    def setblocking(self, flag):
+        self.settimeout(None if flag else 0)
+
+    def setsockopt(self, level, option, value):
+        # Only the send timeout applies to the rings; there are no TCP options to set
+        if (level, option) == (socket.SOL_SOCKET, socket.SO_SNDTIMEO):
+            seconds, microseconds = struct.unpack("@ll", value)
+            self.send_timeout = seconds + microseconds / 1e6 or None
+
+    def getsockopt(self, *args):
+        return self.sock.getsockopt(*args)
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def sendall(self, data):
+        if self.closed:
+            raise OSError(errno.EBADF, "Connection closed")
+        if len(data) > self.tx.capacity:
+            raise ValueError(f"{len(data)} bytes do not fit in a {self.tx.capacity} byte ring")
+        # Wait for room for the whole buffer, so a frame never shows up half written
+        timeout = self.timeout if self.timeout is not None else self.send_timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.tx.free() < len(data):
+            if self.peer_closed or self.sock_closed_by_peer():
+                raise BrokenPipeError(errno.EPIPE, "Connection closed by peer")
+            if deadline is not None and time.monotonic() >= deadline:
+                raise socket.timeout("timed out") if timeout else BlockingIOError(errno.EAGAIN, "Ring full")
+            time.sleep(0.0005)
+        self.tx.write(data)
+        fence()
+        if self.tx.consumer_waiting():
+            try:
+                self.sock.send(b"\0")
+            except BlockingIOError:
+                pass  # Doorbell bytes already queued, the reader is waking up anyway
+
+    def send(self, data, flags=0):
+        self.sendall(data)
+        return len(data)
+
+    def sock_closed_by_peer(self):
+        try:
+            return self.sock.recv(1, socket.MSG_PEEK) == b""
+        except BlockingIOError:
+            return False
+
+    def drain(self):
+        # Swallows doorbell bytes; an empty read means the peer closed the connection
+        try:
+            while True:
+                data = self.sock.recv(4096)
+                if not data:
+                    self.peer_closed = True
+                    return
+                if len(data) < 4096:
+                    return
+        except BlockingIOError:
+            pass
+
+    def wait_readable(self, timeout):
+        # True once the ring has data or the peer has closed, False on timeout
+        if self.rx.available() or self.peer_closed:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self.timeout != 0:
+            if self.spin:
+                spin_until = time.monotonic() + (self.spin if timeout is None else min(self.spin, timeout))
+                while time.monotonic() < spin_until:
+                    if self.rx.available():
+                        return True
+            self.rx.set_waiting(True)
+        try:
+            fence()
+            while not (self.rx.available() or self.peer_closed):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                wait = self.backstop if remaining is None else min(remaining, self.backstop)
+                if select.select([self.sock], [], [], wait)[0]:
+                    self.drain()
+            return True
+        finally:
+            if self.timeout != 0:
+                self.rx.set_waiting(False)
+
+    def recv_into(self, buffer, nbytes=0):
+        view = memoryview(buffer)
+        if nbytes:
+            view = view[:nbytes]
+        while True:
+            size = self.rx.read_into(view)
+            if size:
+                return size
+            if self.peer_closed:
+                return 0
+            if self.timeout == 0:
+                # Only the doorbell made this readable: drain it, then look at the ring once more
+                self.drain()
+                fence()
+                if self.rx.available() or self.peer_closed:
+                    continue
+                raise BlockingIOError(errno.EAGAIN, "No data in ring")
+            if not self.wait_readable(self.timeout):
+                raise socket.timeout("timed out")
+
+    def recv(self, bufsize, flags=0):
+        if flags & socket.MSG_PEEK:
+            # Only used for liveness checks, which the doorbell socket answers: b"" once the peer closed
+            return self.sock.recv(bufsize, flags)
+        buffer = bytearray(bufsize)
+        size = self.recv_into(buffer)
+        return bytes(buffer[:size])
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)  # The reader sees the doorbell socket close, the peer too
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.sock.close()
+        self.rx.buf = self.tx.buf = None
+        self.buf.release()
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()